@@ -1,46 +1,156 @@
 import itertools
+import uuid
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from datetime import timedelta
 from operator import itemgetter
 from statistics import mean
 from urllib.parse import urlparse
 import analytics.logger
 from analytics import db
+from analytics.cloudwatch import FetchCounters, fetch_log_messages, \
+    get_log_page_cache, get_throttled_client
 from analytics.models import *
+from analytics.sketch import HyperLogLog, QuantileSketch, get_sketches
 from analytics.utils import *
 import logging
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 logger = logging.getLogger('bot_analytics_runner')
 
+# one scan for the page crawled, log stats and page crawl error lines,
+# routed to their parser by log line type. the log stats term leaves out
+# the scrapy engine's "Crawled (200)" debug lines
+COMBINED_FILTER_PATTERN = '?PAGE_CRAWLED ?"logstats:Crawled" ?PAGE_CRAWL_ERROR'
+LOG_ROUTES = {
+    LogLineType.PAGE_CRAWLED: 'info',
+    LogLineType.CRAWLER_FREQUENCY: 'frequency',
+    LogLineType.PAGE_CRAWL_ERROR: 'error',
+}
+
+PAGE_LOAD_SPEED_BUCKETS = ('fast', 'medium', 'slow')
+PAGE_LOAD_SPEED_BUCKET_EDGES = (500, 1500)
+
+
+def _page_crawled_fields(group):
+    return decode_log_timestamp(group[0]), group[1], float(group[2]), int(
+        group[3])
+
+
+def _page_crawl_error_fields(group):
+    return decode_log_timestamp(group[0]), group[1], group[2]
+
+
+def _crawler_frequency_fields(group):
+    return int(group[2])
+
+
+def _recommendation_engine_fields(group):
+    return decode_log_timestamp(group[1]), float(group[2]), float(
+        group[3]), float(group[4])
+
 
 # extract attributes from page crawled log line
 def get_page_crawled_attributes(line):
     group = get_re_match_group(line, PAGE_CRAWLED_RE_PATTERN,
                                PAGE_CRAWLED_LOG_LINE_GROUP_LENGTH)
-    return datetime.strptime(group[0].split(".")[0],
-                             '%Y-%m-%d %H:%M:%S'), group[1], float(
-        group[2]), int(group[3])
+    return _page_crawled_fields(group)
 
 
 # extract crawler frequency from log stats line
 def get_crawler_frequency(line):
     group = get_re_match_group(line, CRAWLER_FREQUENCY_RE_PATTERN,
                                CRAWLER_FREQUENCY_LOG_LINE_GROUP_LENGTH)
-    return int(group[2])
+    return _crawler_frequency_fields(group)
 
 
 # extract attributes from page crawl error log line
 def get_page_crawl_error_attributes(line):
     group = get_re_match_group(line, PAGE_CRAWL_ERROR_RE_PATTERN,
                                PAGE_CRAWL_ERROR_LOG_LINE_GROUP_LENGTH)
-    return datetime.strptime(group[0].split(".")[0],
-                             '%Y-%m-%d %H:%M:%S'), group[1], group[2]
+    return _page_crawl_error_fields(group)
 
 
 # extract score from recommendation engine log line
 def get_recommendation_engine_attributes(line):
     group = get_re_match_group(line, RECOMMENDATION_ENGINE_RE_PATTERN,
                                RECOMMENDATION_LOG_LINE_GROUP_LENGTH)
-    return float(group[2]), float(group[3]), float(group[4])
+    return _recommendation_engine_fields(group)[1:]
+
+
+# marker checked before running the line type's pattern, in dispatch order
+LOG_LINE_PARSERS = (
+    (PAGE_CRAWLED_MARKER, LogLineType.PAGE_CRAWLED, PAGE_CRAWLED_RE_PATTERN,
+     _page_crawled_fields),
+    (PAGE_CRAWL_ERROR_MARKER, LogLineType.PAGE_CRAWL_ERROR,
+     PAGE_CRAWL_ERROR_RE_PATTERN, _page_crawl_error_fields),
+    (CRAWLER_FREQUENCY_MARKER, LogLineType.CRAWLER_FREQUENCY,
+     CRAWLER_FREQUENCY_RE_PATTERN, _crawler_frequency_fields),
+    (RECOMMENDATION_ENGINE_MARKER, LogLineType.RECOMMENDATION_ENGINE,
+     RECOMMENDATION_ENGINE_RE_PATTERN, _recommendation_engine_fields),
+)
+
+
+# classify log line by marker and extract its typed attributes in one match
+def parse_log_line(line):
+    for marker, line_type, re_pattern, get_fields in LOG_LINE_PARSERS:
+        if marker not in line:
+            continue
+        match = re_pattern.match(line)
+        if match:
+            return line_type, get_fields(match.groups())
+    return None, None
+
+
+# page crawled events of info log lines in columnar batches, also counting
+# crawler frequencies per minute when a counter is given
+def _get_page_crawled_batches(info_lines, minute_frequencies=None):
+    batch = LogEventBatch()
+    for line in info_lines:
+        line_type, attributes = parse_log_line(line)
+        if line_type == LogLineType.PAGE_CRAWLED:
+            timestamp, url, page_load_speed, page_size = attributes
+            batch.append(url, get_epoch_seconds(timestamp), page_load_speed,
+                         page_size)
+            if len(batch) == LOG_EVENT_BATCH_SIZE:
+                yield batch
+                batch = LogEventBatch()
+        if minute_frequencies is not None:
+            _count_crawler_frequency(minute_frequencies, line, line_type,
+                                     attributes)
+    if len(batch):
+        yield batch
+
+
+# page crawl error events of error log lines in columnar batches
+def _get_page_crawl_error_batches(error_lines):
+    batch = LogEventBatch()
+    for line in error_lines:
+        line_type, attributes = parse_log_line(line)
+        if line_type == LogLineType.PAGE_CRAWL_ERROR:
+            timestamp, compliant_reason, url = attributes
+            batch.append(url, get_epoch_seconds(timestamp), 0, 0,
+                         compliant_reason)
+            if len(batch) == LOG_EVENT_BATCH_SIZE:
+                yield batch
+                batch = LogEventBatch()
+    if len(batch):
+        yield batch
+
+
+# log item views of batched events
+def _get_log_items(batches):
+    for batch in batches:
+        urls, reasons = batch.urls.values, batch.reasons.values
+        for url_id, timestamp, page_load_speed, page_size, reason_code in zip(
+                batch.url_ids, batch.timestamps, batch.page_load_speeds,
+                batch.page_sizes, batch.reason_codes):
+            yield LogItem(urls[url_id], from_epoch_seconds(timestamp),
+                          page_load_speed, page_size, reasons[reason_code])
 
 
 # read info log file
@@ -48,44 +158,60 @@ def get_info_logs_summary(info_logs_file_path=None,
                           info_lines=None,
                           *args,
                           **kwargs):
-    page_crawled_attributes = []
-
     if info_logs_file_path:
         info_lines = read_lines_from_file(info_logs_file_path)
 
-    for line in info_lines:
-        if is_page_crawled_log_line(line):
-            timestamp, url, page_load_speed, page_size = get_page_crawled_attributes(
-                line)
-            page_crawled_attributes.append(
-                InfoItem(url, timestamp, page_load_speed, page_size))
-    return page_crawled_attributes
+    return list(_get_log_items(_get_page_crawled_batches(info_lines)))
+
+
+# minute of the log line, every minute seen counts towards crawl frequency
+def get_minute_key(line):
+    return ':'.join(line.split(":", 2)[:2])
+
+
+# add log line to per minute crawler frequency counter, returns its minute
+def _count_crawler_frequency(minute_frequencies, line, line_type, attributes):
+    key = get_minute_key(line)
+    frequency = attributes if line_type == LogLineType.CRAWLER_FREQUENCY else 0
+    minute_frequencies[key] = minute_frequencies.get(key, 0) + frequency
+    return key
+
+
+def _get_crawler_frequencies(minute_frequencies):
+    return [frequency for _, frequency in sorted(minute_frequencies.items())]
 
 
 def get_frequency_logs_summary(frequency_logs_file_path=None,
                                frequency_lines=None,
                                *args,
                                **kwargs):
-    crawler_frequencies = []
+    minute_frequencies = {}
 
     if frequency_logs_file_path:
         frequency_lines = read_lines_from_file(frequency_logs_file_path)
 
-    grouped_messages = {}
     for line in frequency_lines:
-        key = ':'.join(line.split(":")[:2])
-        if key not in grouped_messages:
-            grouped_messages[key] = []
-        grouped_messages[key].append(line)
+        _count_crawler_frequency(minute_frequencies, line,
+                                 *parse_log_line(line))
 
-    for _, messages in sorted(grouped_messages.items()):
-        crawler_frequencies.append(
-            sum([
-                get_crawler_frequency(line) for line in messages
-                if is_log_stats_log_line(line)
-            ]))
+    return _get_crawler_frequencies(minute_frequencies)
 
-    return crawler_frequencies
+
+# read info log file once for page crawled attributes and crawler frequencies
+def get_info_and_frequency_logs_summary(info_logs_file_path=None,
+                                        info_lines=None,
+                                        *args,
+                                        **kwargs):
+    minute_frequencies = {}
+
+    if info_logs_file_path:
+        info_lines = read_lines_from_file(info_logs_file_path)
+
+    page_crawled_attributes = list(
+        _get_log_items(
+            _get_page_crawled_batches(info_lines, minute_frequencies)))
+    return page_crawled_attributes, _get_crawler_frequencies(
+        minute_frequencies)
 
 
 # read error log file
@@ -93,40 +219,122 @@ def get_error_logs_summary(error_logs_file_path=None,
                            error_lines=None,
                            *args,
                            **kwargs):
-    page_crawl_error_attributes = []
-
     if error_logs_file_path:
         error_lines = read_lines_from_file(error_logs_file_path)
 
-    for line in error_lines:
-        if is_page_crawl_error_log_line(line):
-            timestamp, compliant_reason, url = get_page_crawl_error_attributes(
-                line)
-            page_crawl_error_attributes.append(
-                ErrorItem(url, timestamp, compliant_reason))
-    return page_crawl_error_attributes
+    return list(_get_log_items(_get_page_crawl_error_batches(error_lines)))
 
 
-# build page items from log attributes and return
+# single pass over the lines of the combined filter routed by log line type,
+# page crawled and page crawl error events are accumulated apart then merged
+# so ties resolve as with separate filters, log stats lines are counted per
+# minute. lines per route are added to route_counts when given
+def get_routed_logs_summary(lines, route_counts=None):
+    accumulators = {
+        LogLineType.PAGE_CRAWLED: PageAccumulator(epoch_timestamps=True),
+        LogLineType.PAGE_CRAWL_ERROR: PageAccumulator(epoch_timestamps=True)
+    }
+    batches = {line_type: LogEventBatch() for line_type in accumulators}
+    minute_frequencies = {}
+    for line in lines:
+        line_type, attributes = parse_log_line(line)
+        if route_counts is not None:
+            route_counts[LOG_ROUTES.get(line_type, 'unrouted')] += 1
+        if line_type == LogLineType.CRAWLER_FREQUENCY:
+            _count_crawler_frequency(minute_frequencies, line, line_type,
+                                     attributes)
+            continue
+        batch = batches.get(line_type)
+        if batch is None:
+            continue
+        if line_type == LogLineType.PAGE_CRAWLED:
+            timestamp, url, page_load_speed, page_size = attributes
+            batch.append(url, get_epoch_seconds(timestamp), page_load_speed,
+                         page_size)
+        else:
+            timestamp, compliant_reason, url = attributes
+            batch.append(url, get_epoch_seconds(timestamp), 0, 0,
+                         compliant_reason)
+        if len(batch) == LOG_EVENT_BATCH_SIZE:
+            accumulators[line_type].add_batch(batch)
+            batches[line_type] = LogEventBatch()
+
+    for line_type, batch in batches.items():
+        accumulators[line_type].add_batch(batch)
+    return accumulators[LogLineType.PAGE_CRAWLED].merge(
+        accumulators[LogLineType.PAGE_CRAWL_ERROR]), _get_crawler_frequencies(
+            minute_frequencies)
+
+
+# parse byte range of a log file into a page accumulator, counting crawler
+# frequencies per minute when it is the info log
+def _get_byte_range_summary(file_path, start, end, line_type):
+    accumulator = PageAccumulator(epoch_timestamps=True)
+    minute_frequencies = {}
+
+    lines = read_lines_from_byte_range(file_path, start, end)
+    if line_type == LogLineType.PAGE_CRAWLED:
+        accumulator.update_batches(
+            _get_page_crawled_batches(lines, minute_frequencies))
+    else:
+        accumulator.update_batches(_get_page_crawl_error_batches(lines))
+    return accumulator, minute_frequencies
+
+
+# parse info and error log files split in byte ranges on a process pool,
+# partial accumulators are merged in file order
+def get_logs_summary_in_parallel(info_logs_file_path,
+                                 error_logs_file_path,
+                                 workers=None,
+                                 *args,
+                                 **kwargs):
+    workers = workers or os.cpu_count()
+    jobs = [(info_logs_file_path, start, end, LogLineType.PAGE_CRAWLED)
+            for start, end in get_file_byte_ranges(info_logs_file_path,
+                                                   workers)]
+    jobs.extend((error_logs_file_path, start, end,
+                 LogLineType.PAGE_CRAWL_ERROR)
+                for start, end in get_file_byte_ranges(error_logs_file_path,
+                                                       workers))
+
+    accumulator = PageAccumulator(epoch_timestamps=True)
+    minute_frequencies = {}
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for partial_accumulator, partial_frequencies in executor.map(
+                _get_byte_range_summary, *zip(*jobs)):
+            accumulator.merge(partial_accumulator)
+            for key, frequency in partial_frequencies.items():
+                minute_frequencies[key] = minute_frequencies.get(
+                    key, 0) + frequency
+
+    return accumulator, _get_crawler_frequencies(minute_frequencies)
+
+
+# build page items from log attributes in any order and return
 def get_page_items(attributes):
     if not isinstance(attributes, list):
         raise ValueError('attributes must be list type')
-    page_items = []
-    for url, group in itertools.groupby(attributes, lambda x: x.url):
-        group = list(group)
-        first_crawled_item, last_crawled_item = min(group,
-                                                    key=lambda x: x.timestamp), \
-                                                max(group,
-                                                    key=lambda x: x.timestamp)
-        page_items.append(
-            PageItem(url, len(group),
-                     urlparse(url).netloc,
-                     float(last_crawled_item.page_load_speed),
-                     int(last_crawled_item.page_size),
-                     first_crawled_item.timestamp, last_crawled_item.timestamp,
-                     last_crawled_item.compliant,
-                     last_crawled_item.non_compliance_reason))
-    return page_items
+    return get_accumulated_page_items(PageAccumulator().update(attributes))
+
+
+# build page items from accumulated log attributes and return, epoch
+# timestamps are only decoded here
+def get_accumulated_page_items(accumulator):
+    if not isinstance(accumulator, PageAccumulator):
+        raise ValueError('accumulator must be PageAccumulator type')
+    decode_timestamp = from_epoch_seconds if accumulator.epoch_timestamps \
+        else (lambda timestamp: timestamp)
+    return [
+        PageItem(url, visit_count,
+                 urlparse(url).netloc,
+                 page_load_speed, page_size,
+                 decode_timestamp(first_crawled_at),
+                 decode_timestamp(last_crawled_at),
+                 non_compliance_reason is None,
+                 non_compliance_reason)
+        for url, visit_count, first_crawled_at, last_crawled_at,
+        page_load_speed, page_size, non_compliance_reason in accumulator
+    ]
 
 
 # build domain items from page items and return
@@ -135,6 +343,8 @@ def get_domain_items(page_items, date):
         raise ValueError('page_items must be list type')
     if not isinstance(date, datetime):
         raise ValueError('date must be datetime.datetime type')
+    if numpy is not None and page_items:
+        return _get_domain_items_vectorized(page_items, date)
     domain_items = []
     for domain, group in itertools.groupby(
             sorted(page_items, key=lambda x: x.domain), lambda x: x.domain):
@@ -161,6 +371,113 @@ def get_domain_items(page_items, date):
     return domain_items
 
 
+# page item attribute as numpy array
+def _get_page_column(page_items, index, dtype):
+    return numpy.fromiter(map(itemgetter(index), page_items), dtype=dtype,
+                          count=len(page_items))
+
+
+# same domain items as get_domain_items, pages are grouped by sorted domain
+# id once and every per domain total is a grouped numpy reduction
+def _get_domain_items_vectorized(page_items, date):
+    domains = sorted(set(map(itemgetter(2), page_items)))
+    domain_ids = dict(zip(domains, itertools.count()))
+    page_domain_ids = numpy.fromiter(
+        map(domain_ids.__getitem__, map(itemgetter(2), page_items)),
+        dtype=numpy.int64, count=len(page_items))
+    compliant = _get_page_column(page_items, 7, bool)
+
+    order = numpy.argsort(page_domain_ids, kind='stable')
+    page_counts = numpy.bincount(page_domain_ids, minlength=len(domains))
+    starts = numpy.concatenate(([0], numpy.cumsum(page_counts)[:-1]))
+    visit_counts = numpy.add.reduceat(
+        _get_page_column(page_items, 1, numpy.int64)[order], starts)
+    total_page_sizes = numpy.add.reduceat(
+        _get_page_column(page_items, 4, numpy.int64)[order], starts)
+    compliance_counts = numpy.bincount(page_domain_ids[compliant],
+                                       minlength=len(domains))
+    # float64 sums per domain divided once, the means may differ from
+    # statistics.mean in the last bits
+    avg_page_load_speeds = numpy.add.reduceat(
+        _get_page_column(page_items, 3, numpy.float64)[order],
+        starts) / page_counts
+
+    # (domain id, reason id) keys of non compliant pages, counted in order
+    non_compliant = numpy.flatnonzero(~compliant)
+    reasons = [page_items[_].non_compliance_reason for _ in non_compliant]
+    reason_names = sorted(set(reasons))
+    reason_ids = dict(zip(reason_names, itertools.count()))
+    reason_keys, reason_counts = numpy.unique(
+        page_domain_ids[non_compliant] * len(reason_names) + numpy.fromiter(
+            map(reason_ids.__getitem__, reasons), dtype=numpy.int64,
+            count=len(reasons)), return_counts=True)
+    non_compliance_reasons = [[] for _ in domains]
+    for key, count in zip(reason_keys.tolist(), reason_counts.tolist()):
+        domain_id, reason_id = divmod(key, len(reason_names))
+        non_compliance_reasons[domain_id].append({
+            "reason": reason_names[reason_id],
+            "count": count
+        })
+
+    return [
+        DomainItem(date, domain, page_count, visit_count,
+                   avg_page_load_speed, total_page_size, compliance_count,
+                   page_count - compliance_count, reasons_count)
+        for domain, page_count, avg_page_load_speed, visit_count,
+        total_page_size, compliance_count, reasons_count in zip(
+            domains, page_counts.tolist(), avg_page_load_speeds.tolist(),
+            visit_counts.tolist(), total_page_sizes.tolist(),
+            compliance_counts.tolist(), non_compliance_reasons)
+    ]
+
+
+# page load speed sketch of every domain
+def get_page_load_speed_sketches(page_items):
+    return get_sketches([_.domain for _ in page_items],
+                        [_.page_load_speed for _ in page_items])
+
+
+# p50, p90 and p99 page load speed of a domain between start and end dates,
+# from the sketches of its daily documents
+def get_page_load_speed_quantiles(domain, start, end):
+    sketch = QuantileSketch()
+    for document in db.get_domain_documents_between(domain, start, end):
+        sketch.merge(QuantileSketch.from_document(
+            document.get('page_load_speed_sketch')))
+    return sketch.get_quantiles()
+
+
+# approximate number of distinct urls crawled between start and end dates,
+# from the url sketches of the daily overview documents
+def get_distinct_url_count(start, end):
+    sketch = HyperLogLog()
+    for document in db.get_overview_documents_between(start, end):
+        sketch.merge(HyperLogLog.from_document(document.get('urls_hll')))
+    return len(sketch)
+
+
+# fast, medium and slow page counts
+def get_page_load_speed_count(page_items):
+    if numpy is None:
+        speed_dict = dict.fromkeys(PAGE_LOAD_SPEED_BUCKETS, 0)
+        for page in page_items:
+            speed_dict[get_page_load_speed_bucket(page.page_load_speed)] += 1
+        return speed_dict
+    buckets = numpy.searchsorted(
+        PAGE_LOAD_SPEED_BUCKET_EDGES,
+        _get_page_column(page_items, 3, numpy.float64), side='right')
+    return dict(zip(PAGE_LOAD_SPEED_BUCKETS,
+                    numpy.bincount(buckets, minlength=3).tolist()))
+
+
+def get_page_load_speed_bucket(page_load_speed):
+    if page_load_speed < 500:
+        return 'fast'
+    elif 500 <= page_load_speed < 1500:
+        return 'medium'
+    return 'slow'
+
+
 # build overview item from domain and page items then return
 def get_overview_item(domain_items, page_items, crawler_frequencies, date):
     if not isinstance(domain_items, list):
@@ -173,15 +490,7 @@ def get_overview_item(domain_items, page_items, crawler_frequencies, date):
         raise ValueError('date must be datetime.datetime type')
     urls_per_domain = mean([_.page_count for _ in domain_items])
     page_count = sum([_.page_count for _ in domain_items])
-    speed_dict = {'fast': 0, 'medium': 0, 'slow': 0}
-    for page in page_items:
-        page_load_speed = page.page_load_speed
-        if page_load_speed < 500:
-            speed_dict['fast'] += 1
-        elif 500 <= page_load_speed < 1500:
-            speed_dict['medium'] += 1
-        else:
-            speed_dict['slow'] += 1
+    speed_dict = get_page_load_speed_count(page_items)
 
     # build non compliant reasons
     all_non_compliant_reasons = [
@@ -225,54 +534,205 @@ def get_overview_item(domain_items, page_items, crawler_frequencies, date):
             speed_dict,
         "non_compliance_reasons_count":
             non_compliant_reasons_count,
+        "urls_hll":
+            HyperLogLog().update([_.url for _ in page_items]).to_document(),
     }
 
 
-def get_cloudwatch_logs(aws_client, log_group_name, date_string, filters):
+def _get_reasons_count(reasons_count):
+    return {_['reason']: _['count'] for _ in reasons_count}
+
+
+def _get_reasons_count_list(reasons_count):
+    return [{
+        "reason": reason,
+        "count": count
+    } for reason, count in sorted(reasons_count.items()) if count]
+
+
+# page attributes replace the stored ones unless an earlier run already
+# stored a later crawl, same as create_or_update_pages_documents
+def _is_latest_crawl(page, previous):
+    return not previous or page.last_crawled_at >= previous['last_crawled_at']
+
+
+# merge page items parsed since the last checkpoint into the day's domain
+# documents, previous_pages maps urls already crawled earlier that day to
+# their stored crawled_pages document so they are not counted twice
+def merge_domain_documents(domain_documents, page_items, previous_pages,
+                           date):
+    documents = {_['domain']: dict(_) for _ in domain_documents}
+    reasons = {
+        domain: _get_reasons_count(document['non_compliance_reasons'])
+        for domain, document in documents.items()
+    }
+    # documents written before sketches were kept get none
+    sketches = {
+        domain: QuantileSketch.from_document(
+            document.get('page_load_speed_sketch'))
+        for domain, document in documents.items()
+        if 'page_load_speed_sketch' in document or not document['page_count']
+    }
+    changed_domains = set()
+    for page in page_items:
+        document = documents.get(page.domain)
+        if document is None:
+            document = documents[page.domain] = {
+                "domain": page.domain,
+                "date": date,
+                "page_count": 0,
+                "total_page_size": 0,
+                "visit_count": 0,
+                "compliance_count": 0,
+                "non_compliance_count": 0,
+                "avg_page_load_speed": 0,
+                "non_compliance_reasons": []
+            }
+            reasons[page.domain] = {}
+            sketches[page.domain] = QuantileSketch()
+        if 'total_page_load_speed' not in document:
+            document['total_page_load_speed'] = document[
+                'avg_page_load_speed'] * document['page_count']
+        changed_domains.add(page.domain)
+
+        previous = previous_pages.get(page.url)
+        document['visit_count'] += page.visit_count
+        document['page_count'] += 0 if previous else 1
+        if not _is_latest_crawl(page, previous):
+            continue
+        document['total_page_size'] += page.page_size - (
+            previous['page_size'] if previous else 0)
+        document['total_page_load_speed'] += page.page_load_speed - (
+            previous['page_load_speed'] if previous else 0)
+        sketch = sketches.get(page.domain)
+        if sketch is not None:
+            sketch.add(page.page_load_speed)
+            if previous:
+                sketch.remove(previous['page_load_speed'])
+        if previous:
+            if previous['compliant']:
+                document['compliance_count'] -= 1
+            else:
+                document['non_compliance_count'] -= 1
+                domain_reasons = reasons[page.domain]
+                domain_reasons[previous['non_compliance_reason']] = \
+                    domain_reasons.get(previous['non_compliance_reason'], 0) - 1
+        if page.compliant:
+            document['compliance_count'] += 1
+        else:
+            document['non_compliance_count'] += 1
+            domain_reasons = reasons[page.domain]
+            domain_reasons[page.non_compliance_reason] = domain_reasons.get(
+                page.non_compliance_reason, 0) + 1
+
+    for domain in changed_domains:
+        document = documents[domain]
+        document['avg_page_load_speed'] = document[
+            'total_page_load_speed'] / document['page_count']
+        document['non_compliance_reasons'] = _get_reasons_count_list(
+            reasons[domain])
+        if domain in sketches:
+            document['page_load_speed_sketch'] = sketches[domain].to_document()
+    return [documents[domain] for domain in sorted(changed_domains)], list(
+        documents.values())
+
+
+# merge page items parsed since the last checkpoint into the day's overview
+# document, totals are rebuilt from all of the day's domain documents
+def merge_overview_document(overview_document, domain_documents, page_items,
+                            previous_pages, crawl_frequency_total,
+                            crawl_frequency_minutes, date):
+    overview_document = overview_document or {}
+    speed_dict = dict(
+        overview_document.get('page_load_speed_count', {
+            'fast': 0,
+            'medium': 0,
+            'slow': 0
+        }))
+    for page in page_items:
+        previous = previous_pages.get(page.url)
+        if not _is_latest_crawl(page, previous):
+            continue
+        if previous:
+            speed_dict[get_page_load_speed_bucket(
+                previous['page_load_speed'])] -= 1
+        speed_dict[get_page_load_speed_bucket(page.page_load_speed)] += 1
+
+    reasons = {}
+    for document in domain_documents:
+        for reason, count in _get_reasons_count(
+                document['non_compliance_reasons']).items():
+            reasons[reason] = reasons.get(reason, 0) + count
+
+    crawl_frequency_total += overview_document.get('crawl_frequency_total', 0)
+    crawl_frequency_minutes += overview_document.get('crawl_frequency_minutes',
+                                                     0)
+    page_count = sum([_['page_count'] for _ in domain_documents])
+    return {
+        "date":
+            date,
+        "page_count":
+            page_count,
+        "visit_count":
+            sum([_['visit_count'] for _ in domain_documents]),
+        "urls_per_domain_mean":
+            mean([_['page_count'] for _ in domain_documents])
+            if domain_documents else 0,
+        "total_page_size":
+            sum([_['total_page_size'] for _ in domain_documents]),
+        "compliance_count":
+            sum([_['compliance_count'] for _ in domain_documents]),
+        "non_compliance_count":
+            sum([_['non_compliance_count'] for _ in domain_documents]),
+        "crawl_frequency":
+            crawl_frequency_total / crawl_frequency_minutes
+            if crawl_frequency_minutes else 0,
+        "crawl_frequency_total":
+            crawl_frequency_total,
+        "crawl_frequency_minutes":
+            crawl_frequency_minutes,
+        "avg_page_load_speed":
+            sum([_['avg_page_load_speed'] * _['page_count']
+                 for _ in domain_documents]) / page_count
+            if page_count > 0 else 0,
+        "page_load_speed_count":
+            speed_dict,
+        "non_compliance_reasons_count":
+            _get_reasons_count_list(reasons),
+        "urls_hll":
+            HyperLogLog.from_document(overview_document.get('urls_hll')).update(
+                [_.url for _ in page_items]).to_document(),
+    }
+
+
+# messages of every filter for the day, as generators fetching pages while
+# they are parsed
+def get_cloudwatch_logs(aws_client, log_group_name, date_string, filters,
+                        counters=None, cache=None):
     if not isinstance(filters, dict):
         raise ValueError("Invalid filters value")
-    logs_ = {}
     start_time = datetime.strptime(date_string, DATE_FORMAT)
     end_time = start_time + timedelta(hours=23, minutes=59, seconds=59)
     logger.info(
         f'Getting logs from {start_time} to {end_time} on {log_group_name}')
 
-    for filter_key, filter_string in filters.items():
-        next_token = True
-        responses = []
-
-        while next_token:
-            logger.info(f"querying {filter_key} logs")
-            query_args = {
-                "logGroupName": log_group_name,
-                "startTime": int(start_time.timestamp() * 1000),
-                "endTime": int(end_time.timestamp() * 1000),
-                "filterPattern": filter_string,
-                "limit": int(os.getenv('LOG_ITEMS_LIMIT', 10000))
-            }
-
-            if isinstance(next_token, str):
-                logger.info("paginating...")
-                query_args["nextToken"] = next_token
-
-            response = aws_client.filter_log_events(**query_args)
-            next_token = response.get("nextToken")
-
-            responses.extend(
-                event.get("message") for event in response.get("events"))
-
-        logs_[f"{filter_key}_lines"] = responses
-
-    return logs_
+    messages = fetch_log_messages(get_throttled_client(aws_client),
+                                  log_group_name, start_time,
+                                  end_time, filters, counters=counters,
+                                  cache=cache or get_log_page_cache())
+    return {
+        f"{filter_key}_lines": lines for filter_key, lines in messages.items()
+    }
 
 
 # get recommendation engine logs summary
 def get_recommendation_engine_summary(re_lines=None):
     scores = []
 
-    for line in re_lines:
-        if is_recommendation_engine_log_line(line):
-            top1, top10, top50 = get_recommendation_engine_attributes(line)
+    for line in re_lines or []:
+        line_type, attributes = parse_log_line(line)
+        if line_type == LogLineType.RECOMMENDATION_ENGINE:
+            _, top1, top10, top50 = attributes
             scores.append((top1, top10, top50,))
     return scores
 
@@ -304,41 +764,80 @@ def start_process(mode="local",
                   logs_path=None,
                   log_group_name=None,
                   aws_client=None,
-                  adv_log_group_name=None):
+                  adv_log_group_name=None,
+                  parse_workers=None,
+                  combined_filter=None):
     args, adv_args = {}, {}
+    counters = FetchCounters()
+    if combined_filter is None:
+        combined_filter = os.getenv('LOG_COMBINED_FILTER') == 'true'
     if db.get_overview_doc_from_db(datetime.strptime(date_string, DATE_FORMAT)):
         logger.info(f'Overview document already exists for {date_string}')
         return
     if mode == "local":
         logger.info("running in local mode")
-        args["info_logs_file_path"] = args[
-            "frequency_logs_file_path"] = get_log_file_path(
+        args["info_logs_file_path"] = get_log_file_path(
             date_string, logs_path)
         args["error_logs_file_path"] = get_log_file_path(
             date_string, logs_path, log_level=LogLevel.ERROR)
 
     elif mode == "cloudwatch":
         logger.info("running in cloudwatch mode")
-        filters = {
-            "info": "INFO PAGE_CRAWLED",
-            "frequency": "INFO Crawled",
-            "error": "ERROR PAGE_CRAWL_ERROR"
-        }
+        aws_client = get_throttled_client(aws_client)
+        cache = get_log_page_cache()
+        if combined_filter:
+            filters = {"combined": COMBINED_FILTER_PATTERN}
+        else:
+            filters = {
+                "info": "INFO PAGE_CRAWLED",
+                "frequency": "INFO Crawled",
+                "error": "ERROR PAGE_CRAWL_ERROR"
+            }
         args = get_cloudwatch_logs(aws_client, log_group_name, date_string,
-                                   filters)
+                                   filters, counters, cache)
         adv_filters = {
             "re": "INFO recommendation_engine"
         }
         adv_args = get_cloudwatch_logs(aws_client, adv_log_group_name,
-                                       date_string, adv_filters)
-
-    page_crawled_attributes = get_info_logs_summary(**args)
-    crawler_frequencies = get_frequency_logs_summary(**args)
-    page_crawl_error_attributes = get_error_logs_summary(**args)
-
-    all_page_items = get_page_items(page_crawled_attributes +
-                                    page_crawl_error_attributes)
+                                       date_string, adv_filters, counters,
+                                       cache)
+
+    # columnar event batches are folded into per url accumulators as they
+    # are parsed
+    if mode == "local" and parse_workers and not any(
+            map(is_compressed_file, args.values())):
+        accumulator, crawler_frequencies = get_logs_summary_in_parallel(
+            workers=parse_workers, **args)
+    elif mode == "local":
+        accumulator = PageAccumulator(epoch_timestamps=True)
+        minute_frequencies = {}
+        accumulator.update_batches(
+            _get_page_crawled_batches(
+                read_lines_from_file(args["info_logs_file_path"]),
+                minute_frequencies))
+        accumulator.update_batches(
+            _get_page_crawl_error_batches(
+                read_lines_from_file(args["error_logs_file_path"])))
+        crawler_frequencies = _get_crawler_frequencies(minute_frequencies)
+    elif "combined_lines" in args:
+        accumulator, crawler_frequencies = get_routed_logs_summary(
+            args["combined_lines"], counters.routes)
+    else:
+        accumulator = PageAccumulator(epoch_timestamps=True)
+        accumulator.update_batches(
+            _get_page_crawled_batches(args["info_lines"]))
+        crawler_frequencies = get_frequency_logs_summary(**args)
+        accumulator.update_batches(
+            _get_page_crawl_error_batches(args["error_lines"]))
+
+    all_page_items = get_accumulated_page_items(accumulator)
     stats = get_recommendation_engine_summary(**adv_args)
+    if mode == "cloudwatch":
+        logger.info(f'cloudwatch fetch report\n{counters.get_report()}\n'
+                    f'{aws_client.get_counters()}')
+        if cache:
+            logger.info(f'{cache.hits} time slices replayed from '
+                        f'{cache.directory}, {cache.misses} fetched')
     stats_item = get_advertiser_dashboard_stats_item(stats, datetime.strptime(
         date_string, DATE_FORMAT))
     if stats_item:
@@ -351,11 +850,118 @@ def start_process(mode="local",
 
     domain_items = get_domain_items(all_page_items,
                                     datetime.strptime(date_string, '%Y-%m-%d'))
+    sketches = get_page_load_speed_sketches(all_page_items)
+    domain_documents = [_.to_dict() for _ in domain_items]
+    for document in domain_documents:
+        document['page_load_speed_sketch'] = sketches[
+            document['domain']].to_document()
     # write domain_items to mongodb
-    db.create_or_update_domains([_.to_dict() for _ in domain_items])
+    db.create_or_update_domains(domain_documents)
 
     overview_item = get_overview_item(
         domain_items, all_page_items, crawler_frequencies,
         datetime.strptime(date_string, '%Y-%m-%d'))
     # write overview to mongodb
     db.create_or_update_overview_document(overview_item)
+
+
+# ingest only log lines appended since the last run of the day, the partial
+# aggregates are merged into crawled_pages, crawled_domains and overview.
+# the byte range and an id of the run are stored in the checkpoints before
+# anything is merged, and every merged document records the run. a run
+# that did not complete is read again over the same range and only merged
+# into the documents it did not reach: domains and overview are written
+# before pages, so pages read before they are merged still hold the state
+# the run started from
+def start_incremental_process(date_string=None, logs_path=None, **kwargs):
+    date = datetime.strptime(date_string, DATE_FORMAT)
+    info_checkpoint = db.get_log_checkpoint(date, LogLevel.INFO)
+    error_checkpoint = db.get_log_checkpoint(date, LogLevel.ERROR)
+    if not info_checkpoint and db.get_overview_doc_from_db(date):
+        logger.info(f'Overview document already exists for {date_string}')
+        return
+    info_lines = AppendedLogLines(get_log_file_path(date_string, logs_path),
+                                  info_checkpoint)
+    error_lines = AppendedLogLines(
+        get_log_file_path(date_string, logs_path, log_level=LogLevel.ERROR),
+        error_checkpoint)
+    run = info_lines.end is not None and info_checkpoint.get('pending_run') \
+        or uuid.uuid4().hex
+    started_checkpoints = (info_lines.get_checkpoint(),
+                           error_lines.get_checkpoint())
+    logger.info(f'running incremental local mode from info offset '
+                f'{info_lines.offset} and error offset {error_lines.offset}')
+
+    accumulator = PageAccumulator(epoch_timestamps=True)
+    minute_frequencies = {}
+    # appended lines are folded in batches of LOG_EVENT_BATCH_SIZE events
+    # like a full run, the minute of the last one is kept for the next run
+    last_lines = deque(maxlen=1)
+    accumulator.update_batches(_get_page_crawled_batches(
+        _remember_last_line(info_lines, last_lines), minute_frequencies))
+    accumulator.update_batches(_get_page_crawl_error_batches(error_lines))
+    minute_key = get_minute_key(last_lines[0]) if last_lines else (
+        info_checkpoint and info_checkpoint.get('minute_key'))
+
+    page_items = get_accumulated_page_items(accumulator)
+    if page_items or minute_frequencies:
+        for log_level, checkpoint, lines in zip(
+                (LogLevel.INFO, LogLevel.ERROR), started_checkpoints,
+                (info_lines, error_lines)):
+            db.update_log_checkpoint(date, log_level, dict(
+                checkpoint, pending_offset=lines.offset, pending_run=run))
+        _merge_incremental_run(date, run, accumulator, page_items,
+                               minute_frequencies, info_checkpoint)
+    logger.info(f'{len(page_items)} pages merged for {date_string}')
+
+    db.update_log_checkpoint(date, LogLevel.INFO,
+                             dict(info_lines.get_checkpoint(),
+                                  minute_key=minute_key, pending_offset=None,
+                                  pending_run=None))
+    db.update_log_checkpoint(date, LogLevel.ERROR,
+                             dict(error_lines.get_checkpoint(),
+                                  pending_offset=None, pending_run=None))
+
+
+def _remember_last_line(lines, last_lines):
+    for line in lines:
+        last_lines.append(line)
+        yield line
+
+
+def _merge_incremental_run(date, run, accumulator, page_items,
+                           minute_frequencies, info_checkpoint):
+    previous_pages = {
+        _['url']: _
+        for _ in db.get_pages_crawled_between(
+            accumulator.urls.values, date, date + timedelta(days=1))
+    }
+    domain_documents = db.get_domain_documents(date)
+    merged_domains = {
+        _['domain'] for _ in domain_documents if _.get('ingest_run') == run
+    }
+    changed_domain_documents, domain_documents = merge_domain_documents(
+        domain_documents,
+        [_ for _ in page_items if _.domain not in merged_domains],
+        previous_pages, date)
+    for document in changed_domain_documents:
+        document['ingest_run'] = run
+    if changed_domain_documents and \
+            db.replace_domain_documents(changed_domain_documents) is None:
+        raise RuntimeError(f'Failed to merge domains of run {run}')
+
+    overview_document = db.get_overview_doc_from_db(date)
+    if not (overview_document and overview_document.get('ingest_run') == run):
+        # a minute split across two runs is only counted once
+        crawl_frequency_minutes = len(minute_frequencies) - (
+            info_checkpoint is not None and
+            info_checkpoint.get('minute_key') in minute_frequencies)
+        overview_document = merge_overview_document(
+            overview_document, domain_documents, page_items, previous_pages,
+            sum(minute_frequencies.values()), crawl_frequency_minutes, date)
+        overview_document['ingest_run'] = run
+        db.replace_overview_document(overview_document)
+
+    if page_items and \
+            db.create_or_update_pages_documents(page_items, run) is None:
+        raise RuntimeError(f'Failed to merge pages of run {run}')
@@ -1,94 +1,178 @@
 import os
-import json
 import logging
-import asyncio, random
+import asyncio
+import functools
+import multiprocessing
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime, timedelta
-from json.decoder import JSONDecodeError
+from analytics.models import BidAccumulator
+from analytics.bidstream_parser import BID_REQUEST_PREFIX, get_bid_request_fields, \
+    parse_bidstream_page
+from analytics.sketch import HyperLogLog, QuantileSketch
 from analytics.utils import DATE_FORMAT
-from analytics.db import aggregate_bidstream_records, create_or_update_bidstream_records, BID_STREAM
+from analytics.cloudwatch import get_log_queries, get_throttled_client, \
+    get_timestamp_milliseconds, iter_log_event_pages
+from analytics.db import aggregate_bidstream_records, create_or_update_bidstream_records, BID_STREAM, \
+    delete_bidstream_domains, delete_empty_bidstream_rolling_totals, get_bidstream_records, \
+    get_bidstream_rolling_totals, has_bidstream_rolling_totals, replace_bidstream_domains, \
+    set_bidstream_records_applied, set_bidstream_records_pending, \
+    update_bidstream_rolling_totals, get_bidstream_daily_documents, update_bidstream_daily_documents
 from dotenv import load_dotenv
 
 load_dotenv()
 logger = logging.getLogger('bidstream')
-records = {}
+records = BidAccumulator()
+# sketches of the domains bid on every ingestion day of the run, kept
+# across flushes
+domain_sketches = {}
+daily_sketches_lock = threading.Lock()
 
+# put pages of the day's bid requests on the queue, pages are fetched ahead
+# on the cloudwatch thread pool and handed over from an executor so the
+# event loop is never blocked. at most BIDSTREAM_PAGE_BUDGET pages when it
+# is set, returns the number of records fetched
 async def fetch_bidstream(aws_client, log_group_name, date_string, queue, **kwargs):
 
     logger.info("Fetching from cloudwatch logs...")
+    aws_client = get_throttled_client(aws_client)
+    loop = asyncio.get_running_loop()
+    page_budget = int(os.getenv('BIDSTREAM_PAGE_BUDGET', 0))
 
     start_time = datetime.strptime(date_string, DATE_FORMAT)
     end_time = start_time + timedelta(hours=23, minutes=59, seconds=59)
 
-    count = 0
-    next_token = True
-    while next_token:
-        query_args = {
-            "logGroupName": log_group_name,
-            "startTime": int(start_time.timestamp() * 1000),
-            "endTime": int(end_time.timestamp() * 1000),
-            # "limit": 100
-        }
+    # time slices of the group, or per batch of active log streams
+    queries = await loop.run_in_executor(
+        None, functools.partial(get_log_queries, aws_client, log_group_name,
+                                get_timestamp_milliseconds(start_time),
+                                get_timestamp_milliseconds(end_time)))
+    pages = iter_log_event_pages(aws_client, log_group_name, queries, None)
 
-        if isinstance(next_token, str):
-            query_args["nextToken"] = next_token
+    count, records_count = 0, 0
+    try:
+        while True:
+            result = await loop.run_in_executor(None, next, pages, None)
+            if result is None:
+                break
+            await queue.put(result)
+            count += 1
+            records_count += len(result)
+            logger.info(f"Fetched {len(result)} records")
 
-        response = aws_client.filter_log_events(**query_args)
-        next_token = response.get("nextToken")
-        result = response.get("events")
-        
-        await queue.put(result)
-        logger.info(f"Fetched {len(result)} records")
+            if count == page_budget:
+                logger.warning(f"Page budget of {page_budget} pages reached, "
+                               f"remaining bid requests are not fetched")
+                break
+    finally:
+        # closing waits for the fetches in progress, and their throttle
+        # backoffs, to return
+        await loop.run_in_executor(None, pages.close)
 
-        await asyncio.sleep(random.random())
+    logger.info(f"Cloudwatch client counters: {aws_client.get_counters()}")
+    return records_count
 
-        count += 1
+# write the accumulated records and start over, so records held in memory
+# are bounded by the flush thresholds whatever the number of bids. records
+# of a failed write are merged back for the next flush and the failure is
+# raised
+async def flush_bidstream_records():
+    if not len(records):
+        return
+    flushed = BidAccumulator().merge(records)
+    records.clear()
+    documents = flushed.get_documents()
+    days = {}
+    for ingested_on, domain, _ in documents:
+        if ingested_on is not None and domain is not None:
+            days.setdefault(ingested_on, []).append(domain)
+    for ingested_on, domains in days.items():
+        domain_sketches.setdefault(ingested_on, HyperLogLog()).update(domains)
 
-        if count == 100:
-            break
+    loop = asyncio.get_running_loop()
+    acknowledgement = await loop.run_in_executor(
+        None, create_or_update_bidstream_records, documents)
+    if not acknowledgement:
+        records.merge(flushed)
+        raise RuntimeError(f"Failed to write {len(documents)} bidstream records")
+    logger.info(f"Bidstream records -> added: {acknowledgement.upserted_count} | updated: {acknowledgement.modified_count}")
+    await loop.run_in_executor(None, update_bidstream_daily_sketches, {
+        ingested_on: HyperLogLog(domain_sketches[ingested_on].registers)
+        for ingested_on in days
+    })
 
-async def parse_bidstream(queue):
 
-    while True:
-        data = await queue.get()
+# union the domain sketches of days with the stored ones. a union adds
+# nothing twice, so writing the run's sketches on every flush is safe, the
+# lock keeps concurrent flushes from overwriting each other's union
+def update_bidstream_daily_sketches(sketches):
+    with daily_sketches_lock:
+        for document in get_bidstream_daily_documents(
+                {"ingested_on": {"$in": list(sketches)}}):
+            sketches[document["ingested_on"]].merge(
+                HyperLogLog.from_document(document.get("domains_hll")))
+        if sketches:
+            update_bidstream_daily_documents({
+                ingested_on: {"domains_hll": sketch.to_document()}
+                for ingested_on, sketch in sketches.items()
+            })
+
+
+# approximate number of distinct domains bid on from start_date to end_date
+# inclusive, from the daily domain sketches
+def get_distinct_domain_count(start_date, end_date):
+    sketch = HyperLogLog()
+    for document in get_bidstream_daily_documents(
+            {"ingested_on": {"$gte": start_date, "$lte": end_date}}):
+        sketch.merge(HyperLogLog.from_document(document.get("domains_hll")))
+    return len(sketch)
 
-        await asyncio.sleep(random.random())
 
-        for record in data:
+# flush records every interval seconds until stopped is set, stopping
+# instead of cancelling lets a flush in progress finish its write
+async def flush_bidstream(interval, stopped):
+    while not stopped.is_set():
+        try:
+            await asyncio.wait_for(stopped.wait(), interval)
+        except asyncio.TimeoutError:
             try:
-                message = json.loads(record.get("message"))
-            except JSONDecodeError:
-                continue
-
-            imp = message.get("imp")
-            if not (imp and isinstance(imp, list)):
-                continue
-            
-            # url = message["site"].get("page")
-            domain = message["site"].get("domain")
-            geo = message["device"]["geo"].get("country")
-
-            timestamp = record.get("ingestionTime")
-            ingested_on = str(datetime.fromtimestamp(timestamp / 1000)).split(" ")[0] if isinstance(timestamp, int) else None
-
-            record_key = f"{ingested_on}|{domain}|{geo}"
-            record_data = records.get(record_key, {})
-            ad_slots = set(record_data.get("ad_slots", []))
-            banner = imp[0].get("banner")
-            ad_slots.add("{}x{}".format(banner.get("w", 0), banner.get("h", 0)))
-
-            total_cpm = record_data.get("total_cpm", 0) + imp[0].get("bidfloor", 0)
-            bids_count = record_data.get("bids_count", 0) + 1
-            
-            record_data.update({
-                "ad_slots": list(ad_slots),
-                "total_cpm": round(total_cpm, 4),
-                "bids_count": bids_count
-            })
-        
-            records[record_key] = record_data
+                await flush_bidstream_records()
+            except Exception:
+                logger.exception("Failed to flush bidstream records")
+    domain_sketches.clear()
+
 
-        logger.info(f"Parsed {len(data)} records\n")
-        queue.task_done()
+# parse pages from the queue, on the process pool when one is given, and
+# merge them into records on the event loop. records are flushed once they
+# hold flush_keys keys, before the page is done so joining the queue waits
+# for the write
+async def parse_bidstream(queue, executor=None, flush_keys=None):
+
+    loop = asyncio.get_running_loop()
+    if flush_keys is None:
+        flush_keys = int(os.getenv('BIDSTREAM_FLUSH_KEYS', 50000))
+    while True:
+        data = await queue.get()
+
+        try:
+            if executor:
+                partial_records = await loop.run_in_executor(executor, parse_bidstream_page, data)
+            else:
+                partial_records = parse_bidstream_page(data)
+            records.merge(partial_records)
+            logger.info(f"Parsed {len(data)} records\n")
+        except Exception:
+            logger.exception(f"Failed to parse page of {len(data)} records")
+
+        try:
+            if len(records) >= flush_keys:
+                await flush_bidstream_records()
+        except Exception:
+            logger.exception("Failed to flush bidstream records")
+        finally:
+            queue.task_done()
 
 
 def aggregate_n_days_records(n=28):
@@ -172,24 +256,163 @@ def aggregate_n_days_records(n=28):
     return aggregate_bidstream_records(aggregate_query)
 
 
-async def process_bidstream(aggregate_for_n_days=0, **kwargs):
+# p50, p90 and p99 bid floor of a domain, or of one of its geos, over the
+# days ingested from start_date to end_date inclusive
+def get_bidfloor_quantiles(domain, start_date, end_date, geo=None):
+    query = {"domain": domain, "ingested_on": {"$gte": start_date, "$lte": end_date}}
+    if geo is not None:
+        query["geo"] = geo
+    sketch = QuantileSketch()
+    for document in get_bidstream_records(query):
+        sketch.merge(QuantileSketch.from_document(document.get("bidfloor_sketch")))
+    return sketch.get_quantiles()
+
+
+BIDSTREAM_DOMAINS_CHUNK = 1000
+NOT_APPLIED = {"bids_count": 0, "total_cpm": 0, "ad_slots": []}
+
 
-    queue = asyncio.Queue()
-    producer = asyncio.create_task(fetch_bidstream(**kwargs, queue=queue))
-    consumer = asyncio.create_task(parse_bidstream(queue))
+# totals a bidstream_datewise record adds to its domain and geo in the
+# aggregation pipeline, where $unwind repeats it once per ad slot
+def get_bidstream_contribution(document):
+    ad_slots = document.get("ad_slots") or []
+    return {
+        "bids_count": len(ad_slots) * document.get("bids_count", 0),
+        "total_cpm": len(ad_slots) * document.get("total_cpm", 0),
+        "ad_slots": ad_slots
+    }
 
-    await asyncio.gather(producer)
-    await queue.join()
-    consumer.cancel()
 
-    acknowledgement = create_or_update_bidstream_records(records)
-    if acknowledgement:
-        logger.info(f"Bidstream records -> added: {acknowledgement.upserted_count} | updated: {acknowledgement.modified_count}")
-        records.clear()
+# bidstream document of a domain from its rolling totals per geo, as
+# aggregate_n_days_records projects it: cpm average weighted like $unwind,
+# number of distinct ad slot sets of its geos and top 5 geos by bids count
+def get_bidstream_domain_document(domain, rolling_totals):
+    rolling_totals = [_ for _ in rolling_totals if _.get("unwound", 0) > 0]
+    if not rolling_totals:
+        return None
+    rolling_totals.sort(key=lambda _: _["bids_count"], reverse=True)
+    ad_slots = {
+        frozenset(ad_slot for ad_slot, count in _.get("ad_slots", {}).items() if count > 0)
+        for _ in rolling_totals
+    }
+    return {
+        "domain": domain,
+        "avg_cpm": sum(_["total_cpm"] for _ in rolling_totals) /
+                   sum(_["bids_count"] for _ in rolling_totals),
+        "ad_slots": len(ad_slots),
+        "geo": [_["geo"] for _ in rolling_totals[:5]]
+    }
+
+
+# same bidstream collection as aggregate_n_days_records, updated from
+# rolling per domain and geo totals instead of rebuilt. records updated
+# since the last run are added, minus what they added before, and records
+# that fell out of the window are subtracted. only the domains of these
+# records are rewritten
+def update_n_days_records(n=28):
+
+    target_date = (datetime.now() - timedelta(days=n)).strftime('%Y-%m-%d')
+    logger.info(f"Updating rolling {n} days aggregates. i.e., from {target_date} till today...")
+
+    # records of the window flushed before the rolling aggregation was
+    # switched on carry no pending flag, they are marked while no rolling
+    # totals exist yet instead of being looked for on every run
+    if not has_bidstream_rolling_totals():
+        set_bidstream_records_pending(target_date)
+
+    deltas, applied_records = {}, []
+    for document in get_bidstream_records({"$or": [
+            {"pending": True},
+            {"ingested_on": {"$lt": target_date}, "applied": {"$exists": True}}]}):
+        ingested_on = document.get("ingested_on")
+        contribution = get_bidstream_contribution(document) \
+            if isinstance(ingested_on, str) and ingested_on >= target_date else NOT_APPLIED
+        applied = document.get("applied") or NOT_APPLIED
+
+        delta = deltas.setdefault((document["domain"], document["geo"]), Counter())
+        for field in ("bids_count", "total_cpm"):
+            delta[field] += contribution[field] - applied[field]
+        delta["unwound"] += len(contribution["ad_slots"]) - len(applied["ad_slots"])
+        delta.update(f"ad_slots.{_}" for _ in contribution["ad_slots"])
+        delta.subtract(f"ad_slots.{_}" for _ in applied["ad_slots"])
+        applied_records.append(
+            (document, contribution if contribution is not NOT_APPLIED else None))
+
+    if not applied_records:
+        logger.info("Rolling aggregates are up to date")
+        return 0
+
+    deltas = {key: {field: value for field, value in delta.items() if value}
+              for key, delta in deltas.items()}
+    deltas = {key: delta for key, delta in deltas.items() if delta}
+    if deltas:
+        update_bidstream_rolling_totals(deltas)
+    set_bidstream_records_applied(applied_records)
+
+    domains = sorted({domain for domain, _ in deltas})
+    for start in range(0, len(domains), BIDSTREAM_DOMAINS_CHUNK):
+        chunk = domains[start:start + BIDSTREAM_DOMAINS_CHUNK]
+        rolling_totals = {}
+        for document in get_bidstream_rolling_totals(chunk):
+            rolling_totals.setdefault(document["domain"], []).append(document)
+        documents = [get_bidstream_domain_document(domain, rolling_totals.get(domain, []))
+                     for domain in chunk]
+        replaced = [_ for _ in documents if _ is not None]
+        if replaced:
+            replace_bidstream_domains(replaced)
+        deleted = [domain for domain, document in zip(chunk, documents) if document is None]
+        if deleted:
+            delete_bidstream_domains(deleted)
+        delete_empty_bidstream_rolling_totals(chunk)
+
+    logger.info(f"Bidstream rolling aggregates updated from {len(applied_records)} records, "
+                f"{len(domains)} domains changed")
+    return len(domains)
+
+
+async def process_bidstream(aggregate_for_n_days=0, **kwargs):
+
+    # bounded so fetching waits for parsing instead of buffering the day
+    queue = asyncio.Queue(maxsize=int(os.getenv('BIDSTREAM_QUEUE_PAGES', 8)))
+    workers = int(os.getenv('BIDSTREAM_PARSE_WORKERS', os.cpu_count() or 1))
+    started_at = time.perf_counter()
+    # records parsed before the fetch or the parsing fails are still
+    # written, a failed final write is raised
+    try:
+        # one consumer per parse worker keeps every worker busy with a page
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as executor:
+            producer = asyncio.create_task(fetch_bidstream(**kwargs, queue=queue))
+            consumers = [
+                asyncio.create_task(parse_bidstream(queue, executor))
+                for _ in range(workers)
+            ]
+            stopped = asyncio.Event()
+            flusher = asyncio.create_task(flush_bidstream(
+                int(os.getenv('BIDSTREAM_FLUSH_SECONDS', 60)), stopped))
+
+            try:
+                records_count, = await asyncio.gather(producer)
+                await queue.join()
+            finally:
+                for consumer in consumers:
+                    consumer.cancel()
+                stopped.set()
+                await flusher
+        elapsed = time.perf_counter() - started_at
+        logger.info(f"Fetched and parsed {records_count} records in {elapsed:.2f} "
+                    f"seconds, {records_count / elapsed:.0f} records/sec")
+    finally:
+        try:
+            await flush_bidstream_records()
+        finally:
+            domain_sketches.clear()
 
     if aggregate_for_n_days:
         try:
-            aggregate_n_days_records(aggregate_for_n_days)
+            if os.getenv('BIDSTREAM_INCREMENTAL_AGGREGATION') == 'true':
+                update_n_days_records(aggregate_for_n_days)
+            else:
+                aggregate_n_days_records(aggregate_for_n_days)
             logger.info(f"Bidstream records aggregated for {aggregate_for_n_days} days")
         except Exception as e:
             print("Exception at aggregation - bidstream: ", str(e))
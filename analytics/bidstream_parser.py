@@ -0,0 +1,79 @@
+import re
+import json
+from datetime import datetime
+from analytics.models import BidAccumulator
+
+try:
+    import simdjson
+except ImportError:
+    simdjson = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# bid requests are logged as json objects, other lambda lines such as
+# LambdaContext(...) dumps are skipped before any decoding
+BID_REQUEST_PREFIX = re.compile(r'\s*\{')
+
+
+# ad slot width and height, bid floor, domain and geo of a bid request
+# message, None when it is not a json bid request. with simdjson only these
+# fields are materialized from the parsed document
+def get_bid_request_fields(message, parser=None):
+    if not (message and '"imp"' in message and BID_REQUEST_PREFIX.match(message)):
+        return None
+    try:
+        if simdjson is not None:
+            return _get_bid_request_fields_lazy(
+                (parser or simdjson.Parser()).parse(message.encode()))
+        if orjson is not None:
+            return _get_bid_request_fields(orjson.loads(message))
+        return _get_bid_request_fields(json.loads(message))
+    except (ValueError, TypeError, KeyError, IndexError, AttributeError):
+        return None
+
+
+def _get_bid_request_fields(message):
+    imp = message.get("imp")
+    if not (imp and isinstance(imp, list)):
+        return None
+    banner = imp[0].get("banner")
+    return (banner.get("w", 0), banner.get("h", 0), imp[0].get("bidfloor", 0),
+            message["site"].get("domain"), message["device"]["geo"].get("country"))
+
+
+# the banner, site and geo objects are read without a default, so a bid
+# request missing one of them, or with null, is dropped as it is by
+# _get_bid_request_fields. only their leaf fields default
+def _get_bid_request_fields_lazy(document):
+    imp = document.get("imp")
+    if not (imp and isinstance(imp, simdjson.Array)):
+        return None
+    banner = document.at_pointer("/imp/0/banner")
+    site = document.at_pointer("/site")
+    geo = document.at_pointer("/device/geo")
+    return (banner.get("w", 0), banner.get("h", 0), imp[0].get("bidfloor", 0),
+            site.get("domain"), geo.get("country"))
+
+
+# bid requests of a page of log events accumulated per ingestion date,
+# domain and geo. runs in parse workers, which is why this module stays
+# clear of analytics.db and the cloudwatch client
+def parse_bidstream_page(data):
+    partial_records = BidAccumulator()
+    # a parser is reused across the page, its buffers only grow once
+    parser = simdjson.Parser() if simdjson is not None else None
+    for record in data:
+        fields = get_bid_request_fields(record.get("message"), parser)
+        if fields is None:
+            continue
+        width, height, bidfloor, domain, geo = fields
+
+        timestamp = record.get("ingestionTime")
+        ingested_on = str(datetime.fromtimestamp(timestamp / 1000)).split(" ")[0] if isinstance(timestamp, int) else None
+
+        partial_records.add(ingested_on, domain, geo, width, height, bidfloor)
+
+    return partial_records
@@ -0,0 +1,574 @@
+import gzip
+import functools
+import hashlib
+import itertools
+import json
+import logging
+import os
+import queue
+import random
+import threading
+import time
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger('cloudwatch')
+
+LOG_FETCH_SLICES = int(os.getenv('LOG_FETCH_SLICES', 24))
+LOG_FETCH_WORKERS = int(os.getenv('LOG_FETCH_WORKERS', 8))
+LOG_FETCH_QUEUE_PAGES = int(os.getenv('LOG_FETCH_QUEUE_PAGES', 2))
+# FilterLogEvents requests per second allowed for the account and region
+LOG_FETCH_RATE = float(os.getenv('LOG_FETCH_RATE', 5))
+LOG_FETCH_BURST = int(os.getenv('LOG_FETCH_BURST', 5))
+LOG_FETCH_MAX_RETRIES = int(os.getenv('LOG_FETCH_MAX_RETRIES', 8))
+LOG_FETCH_BACKOFF_SECONDS = 0.25
+LOG_FETCH_MAX_BACKOFF_SECONDS = 30
+# successful calls before another concurrent call is allowed
+LOG_FETCH_INCREASE_CALLS = 20
+# query each active log stream, or batch of streams, of the group apart
+LOG_FETCH_PER_STREAM = os.getenv('LOG_FETCH_PER_STREAM') == 'true'
+LOG_STREAMS_PER_QUERY = min(100, int(os.getenv('LOG_STREAMS_PER_QUERY', 1)))
+# a stream's last event timestamp may be updated up to an hour late
+LOG_STREAM_LAG_MILLISECONDS = 3600 * 1000
+LOG_CACHE_DIR = os.getenv('LOG_CACHE_DIR')
+LOG_CACHE_MAX_BYTES = int(os.getenv('LOG_CACHE_MAX_BYTES', 1024 ** 3))
+# windows ending less than this long ago may still receive events
+LOG_CACHE_MIN_AGE_SECONDS = int(os.getenv('LOG_CACHE_MIN_AGE_SECONDS', 3600))
+THROTTLING_ERROR_CODES = ('ThrottlingException', 'TooManyRequestsException',
+                          'RequestLimitExceeded')
+QUEUE_POLL_SECONDS = 0.1
+
+_END_OF_PAGES = object()
+
+
+# api calls made and events fetched per filter, and events per route when
+# the messages of a combined filter are routed to their parsers
+class FetchCounters:
+    def __init__(self):
+        self.api_calls = Counter()
+        self.events = Counter()
+        self.routes = Counter()
+
+    def add_page(self, filter_key, events_count):
+        self.api_calls[filter_key] += 1
+        self.events[filter_key] += events_count
+
+    def get_report(self):
+        lines = [f"{'filter':<12} {'api calls':>10} {'events':>10}"]
+        for filter_key in self.api_calls:
+            lines.append(f"{filter_key:<12} {self.api_calls[filter_key]:>10} "
+                         f"{self.events[filter_key]:>10}")
+        lines.append(f"{'total':<12} {sum(self.api_calls.values()):>10} "
+                     f"{sum(self.events.values()):>10}")
+        if self.routes:
+            lines.append(f"{'route':<12} {'':>10} {'events':>10}")
+            for route, count in self.routes.items():
+                lines.append(f"{route:<12} {'':>10} {count:>10}")
+        return '\n'.join(lines)
+
+
+# blocks callers so no more than rate calls per second are made on
+# average, with bursts of up to capacity calls
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(
+                    self.capacity,
+                    self.tokens + (now - self.updated_at) * self.rate)
+                self.updated_at = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+def is_throttling_error(error):
+    response = getattr(error, 'response', None) or {}
+    return response.get('Error', {}).get('Code') in THROTTLING_ERROR_CODES
+
+
+# logs client shared by every fetch of a run. calls are rate limited by a
+# token bucket and throttled calls are retried after a jittered exponential
+# backoff. the number of concurrent calls is halved on every throttle and
+# grows by one after LOG_FETCH_INCREASE_CALLS successful calls. other
+# client methods are passed through
+class ThrottledLogsClient:
+    def __init__(self, aws_client, rate=None, burst=None, max_concurrency=None,
+                 max_retries=None):
+        self.aws_client = aws_client
+        self.token_bucket = TokenBucket(rate or LOG_FETCH_RATE,
+                                        burst or LOG_FETCH_BURST)
+        self.max_concurrency = max_concurrency or LOG_FETCH_WORKERS
+        self.max_retries = LOG_FETCH_MAX_RETRIES if max_retries is None \
+            else max_retries
+        self.concurrency = self.max_concurrency
+        self.running = 0
+        self.successful_calls = 0
+        self.condition = threading.Condition()
+        self.calls = 0
+        self.throttles = 0
+        self.retry_seconds = 0.0
+        self.bytes = 0
+
+    def __getattr__(self, name):
+        return getattr(self.aws_client, name)
+
+    def _start_call(self):
+        with self.condition:
+            while self.running >= self.concurrency:
+                self.condition.wait()
+            self.running += 1
+            self.calls += 1
+
+    def _end_call(self, throttled):
+        with self.condition:
+            self.running -= 1
+            if throttled:
+                self.throttles += 1
+                self.successful_calls = 0
+                self.concurrency = max(1, self.concurrency // 2)
+            else:
+                self.successful_calls += 1
+                if self.successful_calls >= LOG_FETCH_INCREASE_CALLS and \
+                        self.concurrency < self.max_concurrency:
+                    self.successful_calls = 0
+                    self.concurrency += 1
+            self.condition.notify_all()
+
+    def filter_log_events(self, **query_args):
+        return self._call(self.aws_client.filter_log_events, query_args)
+
+    def describe_log_streams(self, **query_args):
+        return self._call(self.aws_client.describe_log_streams, query_args)
+
+    def _call(self, method, query_args):
+        for attempt in itertools.count():
+            self._start_call()
+            self.token_bucket.acquire()
+            try:
+                response = method(**query_args)
+            except Exception as e:
+                throttled = is_throttling_error(e)
+                self._end_call(throttled)
+                if not throttled or attempt >= self.max_retries:
+                    raise
+                backoff = random.uniform(
+                    0,
+                    min(LOG_FETCH_MAX_BACKOFF_SECONDS,
+                        LOG_FETCH_BACKOFF_SECONDS * 2 ** attempt))
+                logger.info(f'throttled, retrying in {backoff:.2f} seconds '
+                            f'with {self.concurrency} concurrent calls')
+                with self.condition:
+                    self.retry_seconds += backoff
+                time.sleep(backoff)
+                continue
+            self._end_call(False)
+            with self.condition:
+                self.bytes += sum(
+                    len(event.get('message', '').encode())
+                    for event in response.get('events', []))
+            return response
+
+    def get_counters(self):
+        return {
+            "calls": self.calls,
+            "throttles": self.throttles,
+            "retry_seconds": round(self.retry_seconds, 2),
+            "bytes": self.bytes,
+            "concurrency": self.concurrency
+        }
+
+
+# wrap client unless it already is
+def get_throttled_client(aws_client):
+    if isinstance(aws_client, ThrottledLogsClient):
+        return aws_client
+    return ThrottledLogsClient(aws_client)
+
+
+def get_timestamp_milliseconds(date):
+    return int(date.timestamp() * 1000)
+
+
+# split the inclusive [start_time, end_time] millisecond window into
+# consecutive inclusive slices that do not overlap
+def get_time_slices(start_time, end_time, slices_count):
+    slices_count = max(1, min(slices_count, end_time - start_time + 1))
+    bounds = [
+        start_time + (end_time - start_time + 1) * i // slices_count
+        for i in range(slices_count + 1)
+    ]
+    return [(bounds[i], bounds[i + 1] - 1) for i in range(slices_count)]
+
+
+# gzipped json lines of the event pages of a log group, filter pattern and
+# time window, replayed instead of calling filter_log_events again. windows
+# still receiving events are not cached, files are evicted least recently
+# used first once the directory grows over max_bytes
+class LogPageCache:
+    def __init__(self, directory, max_bytes=None):
+        self.directory = directory
+        self.max_bytes = max_bytes or LOG_CACHE_MAX_BYTES
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def get_path(self, log_group_name, filter_pattern, start_time, end_time,
+                 log_stream_names=None):
+        key = json.dumps([log_group_name, filter_pattern, start_time, end_time]
+                         + ([log_stream_names] if log_stream_names else []))
+        return os.path.join(self.directory,
+                            hashlib.sha1(key.encode()).hexdigest() + '.json.gz')
+
+    def is_cacheable(self, end_time):
+        return end_time < (time.time() - LOG_CACHE_MIN_AGE_SECONDS) * 1000
+
+    # cached pages of the window, else the pages of fetch_pages() written to
+    # the cache as they are read once all of them were
+    def get_pages(self, log_group_name, filter_pattern, start_time, end_time,
+                  fetch_pages, log_stream_names=None):
+        path = self.get_path(log_group_name, filter_pattern, start_time,
+                             end_time, log_stream_names)
+        try:
+            cached_file = gzip.open(path, 'rt')
+        except FileNotFoundError:
+            cached_file = None
+        else:
+            try:
+                os.utime(path)
+            except FileNotFoundError:
+                pass
+        with self.lock:
+            if cached_file:
+                self.hits += 1
+            else:
+                self.misses += 1
+        if cached_file:
+            with cached_file:
+                for line in cached_file:
+                    yield json.loads(line)
+            return
+        if not self.is_cacheable(end_time):
+            yield from fetch_pages()
+            return
+
+        temporary_path = '%s.%d.tmp' % (path, threading.get_ident())
+        try:
+            with gzip.open(temporary_path, 'wt') as cache_file:
+                for page in fetch_pages():
+                    cache_file.write(json.dumps(page) + '\n')
+                    yield page
+            os.replace(temporary_path, path)
+        finally:
+            if os.path.exists(temporary_path):
+                os.remove(temporary_path)
+        self.evict()
+
+    def evict(self):
+        with self.lock:
+            paths = [
+                entry for entry in os.scandir(self.directory)
+                if entry.name.endswith('.json.gz')
+            ]
+            paths.sort(key=lambda entry: entry.stat().st_mtime)
+            total_bytes = sum(entry.stat().st_size for entry in paths)
+            for entry in paths:
+                if total_bytes <= self.max_bytes:
+                    break
+                total_bytes -= entry.stat().st_size
+                os.remove(entry.path)
+
+
+# page cache of LOG_CACHE_DIR, None when it is not set
+def get_log_page_cache():
+    return LogPageCache(LOG_CACHE_DIR) if LOG_CACHE_DIR else None
+
+
+# (name, first event time, last event time) of the log streams of the group
+# with events between start_time and end_time, streams are listed by last
+# event time so older ones are not paged through. the last event time is
+# pushed LOG_STREAM_LAG_MILLISECONDS later since it may be updated late
+def get_active_log_streams(aws_client, log_group_name, start_time, end_time):
+    log_streams = []
+    query_args = {
+        "logGroupName": log_group_name,
+        "orderBy": "LastEventTime",
+        "descending": True
+    }
+    while True:
+        response = aws_client.describe_log_streams(**query_args)
+        for log_stream in response.get("logStreams", []):
+            first_event_time = log_stream.get("firstEventTimestamp", 0)
+            last_event_time = max(
+                log_stream.get("lastEventTimestamp", 0) + LOG_STREAM_LAG_MILLISECONDS,
+                log_stream.get("lastIngestionTime", 0))
+            if first_event_time <= end_time and last_event_time >= start_time:
+                log_streams.append((log_stream["logStreamName"],
+                                    first_event_time, last_event_time))
+            if log_stream.get("lastEventTimestamp", start_time) < \
+                    start_time - LOG_STREAM_LAG_MILLISECONDS:
+                return log_streams
+        next_token = response.get("nextToken")
+        if not next_token:
+            return log_streams
+        query_args["nextToken"] = next_token
+
+
+# (start, end, log stream names) of every query covering the window, one
+# per time slice or, per stream, one per time slice and batch of the active
+# streams with events in the slice. log stream names are None when the
+# whole group is queried
+def get_log_queries(aws_client, log_group_name, start_time, end_time,
+                    slices_count=None, per_stream=None):
+    time_slices = get_time_slices(start_time, end_time,
+                                  slices_count or LOG_FETCH_SLICES)
+    if not (LOG_FETCH_PER_STREAM if per_stream is None else per_stream):
+        return [(slice_start, slice_end, None)
+                for slice_start, slice_end in time_slices]
+    log_streams = get_active_log_streams(aws_client, log_group_name,
+                                         start_time, end_time)
+    logger.info(f'{len(log_streams)} active log streams in '
+                f'{log_group_name}')
+    queries = []
+    for slice_start, slice_end in time_slices:
+        log_stream_names = [
+            log_stream_name
+            for log_stream_name, first_event_time, last_event_time in log_streams
+            if first_event_time <= slice_end and last_event_time >= slice_start
+        ]
+        queries.extend(
+            (slice_start, slice_end, log_stream_names[i:i + LOG_STREAMS_PER_QUERY])
+            for i in range(0, len(log_stream_names), LOG_STREAMS_PER_QUERY))
+    return queries
+
+
+# pages of filter_log_events for one filter, time slice and log streams,
+# the filter pattern and log streams are optional
+def get_log_event_pages(aws_client, log_group_name, start_time, end_time,
+                        filter_pattern, log_stream_names=None):
+    next_token = True
+    while next_token:
+        query_args = {
+            "logGroupName": log_group_name,
+            "startTime": start_time,
+            "endTime": end_time,
+            "limit": int(os.getenv('LOG_ITEMS_LIMIT', 10000))
+        }
+        if filter_pattern is not None:
+            query_args["filterPattern"] = filter_pattern
+        if log_stream_names:
+            query_args["logStreamNames"] = log_stream_names
+        if isinstance(next_token, str):
+            query_args["nextToken"] = next_token
+
+        response = aws_client.filter_log_events(**query_args)
+        next_token = response.get("nextToken")
+        yield response.get("events")
+
+
+# put item on bounded queue unless the consumer stopped, returns whether
+# it was put
+def _put_page(pages_queue, item, stopped):
+    while not stopped.is_set():
+        try:
+            pages_queue.put(item, timeout=QUEUE_POLL_SECONDS)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+# fetch the pages of one time slice into its queue, followed by the end
+# marker or the exception raised while fetching
+def _produce_pages(pages, pages_queue, stopped):
+    try:
+        # queued before the consumer stopped, nothing is fetched
+        if stopped.is_set():
+            return
+        for page in pages:
+            if not _put_page(pages_queue, page, stopped):
+                return
+        item = _END_OF_PAGES
+    except Exception as e:
+        item = e
+    finally:
+        pages.close()
+    _put_page(pages_queue, item, stopped)
+
+
+# pages of one filter as they arrive, in query order. fetching starts as
+# soon as it is created: up to workers queries are fetched ahead of the
+# consumer on executor, each into a queue of at most LOG_FETCH_QUEUE_PAGES
+# pages, so memory stays bounded by a few pages per query. executor needs
+# a thread for each of these queries
+class LogEventPages:
+    def __init__(self, aws_client, log_group_name, queries, filter_pattern,
+                 executor, workers=None, cache=None):
+        self.aws_client = aws_client
+        self.log_group_name = log_group_name
+        self.queries = iter(queries)
+        self.filter_pattern = filter_pattern
+        self.executor = executor
+        self.cache = cache
+        self.pages_queues = deque()
+        self.stopped = threading.Event()
+        for _ in range(workers or LOG_FETCH_WORKERS):
+            self.start_next_query()
+
+    def start_next_query(self):
+        for slice_start, slice_end, log_stream_names in itertools.islice(
+                self.queries, 1):
+            pages_queue = queue.Queue(maxsize=LOG_FETCH_QUEUE_PAGES)
+            self.pages_queues.append(pages_queue)
+            fetch_pages = functools.partial(get_log_event_pages,
+                                            self.aws_client,
+                                            self.log_group_name, slice_start,
+                                            slice_end, self.filter_pattern,
+                                            log_stream_names)
+            pages = self.cache.get_pages(
+                self.log_group_name, self.filter_pattern, slice_start,
+                slice_end, fetch_pages, log_stream_names) if self.cache \
+                else fetch_pages()
+            self.executor.submit(_produce_pages, pages, pages_queue,
+                                 self.stopped)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        while self.pages_queues:
+            page = self.pages_queues[0].get()
+            if page is _END_OF_PAGES:
+                self.pages_queues.popleft()
+                self.start_next_query()
+            elif isinstance(page, Exception):
+                self.close()
+                raise page
+            else:
+                return page
+        raise StopIteration
+
+    # stop the producers, pages fetched ahead are dropped
+    def close(self):
+        self.stopped.set()
+
+    def __del__(self):
+        self.stopped.set()
+
+
+# pages of one filter fetched on a thread pool of its own once they are
+# iterated
+def iter_log_event_pages(aws_client, log_group_name, queries,
+                         filter_pattern, workers=None, cache=None):
+    workers = workers or LOG_FETCH_WORKERS
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pages = LogEventPages(aws_client, log_group_name, queries,
+                              filter_pattern, executor, workers, cache)
+        try:
+            yield from pages
+        finally:
+            pages.close()
+
+
+# messages of one filter as its pages arrive
+def iter_log_messages(pages, log_group_name, filter_key, counters=None):
+    count = 0
+    try:
+        for page in pages:
+            count += len(page)
+            if counters is not None:
+                counters.add_page(filter_key, len(page))
+            for event in page:
+                yield event.get("message")
+    finally:
+        pages.close()
+    logger.info(f'fetched {count} {filter_key} log events from '
+                f'{log_group_name}')
+
+
+# thread pool shared by the filters of a fetch, shut down once each of them
+# released it. producers are stopped by their filters beforehand so
+# shutting down does not wait for them
+class SharedExecutor(ThreadPoolExecutor):
+    def __init__(self, max_workers, users):
+        super().__init__(max_workers=max_workers)
+        self.users = users
+        self.users_lock = threading.Lock()
+
+    def release(self):
+        with self.users_lock:
+            self.users -= 1
+            if self.users:
+                return
+        self.shutdown(wait=False)
+
+
+# messages of one filter, its fetch is stopped and the shared thread pool
+# released once they are exhausted or closed, even before being iterated
+class LogMessages:
+    def __init__(self, pages, log_group_name, filter_key, counters, executor):
+        self.pages = pages
+        self.messages = iter_log_messages(pages, log_group_name, filter_key,
+                                          counters)
+        self.executor = executor
+        self.closed = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        try:
+            return next(self.messages)
+        except BaseException:
+            self.close()
+            raise
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.messages.close()
+        self.pages.close()
+        self.executor.release()
+
+    def __del__(self):
+        self.close()
+
+
+# messages of every filter between start_time and end_time, the window is
+# split in time slices, and per stream in batches of active streams. every
+# filter starts fetching right away, so the next filters' first pages are
+# fetched while the current one is parsed. the thread pool has a thread for
+# every query fetched ahead of every filter, so a filter not read yet never
+# holds the threads of the one being read. concurrent calls are still
+# capped by the throttled client. the pool is shut down once the messages
+# of every filter are exhausted or closed
+def fetch_log_messages(aws_client, log_group_name, start_time, end_time,
+                       filters, slices_count=None, workers=None,
+                       counters=None, cache=None, per_stream=None):
+    workers = workers or LOG_FETCH_WORKERS
+    queries = get_log_queries(aws_client, log_group_name,
+                              get_timestamp_milliseconds(start_time),
+                              get_timestamp_milliseconds(end_time),
+                              slices_count, per_stream)
+    logger.info(f'fetching {len(filters)} filters in {len(queries)} '
+                f'queries from {log_group_name}')
+    executor = SharedExecutor(workers * max(1, len(filters)), len(filters))
+    return {
+        filter_key: LogMessages(
+            LogEventPages(aws_client, log_group_name, queries, filter_pattern,
+                          executor, workers, cache),
+            log_group_name, filter_key, counters, executor)
+        for filter_key, filter_pattern in filters.items()
+    }
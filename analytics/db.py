@@ -1,11 +1,13 @@
 import os
+import multiprocessing
 from datetime import datetime
 from statistics import mean
 import logging
 
+from analytics.sketch import HyperLogLog
 from analytics.utils import is_production_environment, DATE_FORMAT
 from pymongo import MongoClient, ASCENDING, DESCENDING
-from pymongo import UpdateOne
+from pymongo import UpdateOne, ReplaceOne
 
 logger = logging.getLogger('db')
 DATABASE = 'cygnus_bot_analytics'
@@ -15,12 +17,14 @@ CA_BUNDLE_PATH = os.path.abspath(
 
 RE_DATABASE = 'test'
 RE_COLLECTION = "data"
+REPORT_WATERMARKS = "report_watermarks"
 
 # collection names
 CRAWLED_PAGES = 'crawled_pages'
 CRAWLED_DOMAINS = 'crawled_domains'
 OVERVIEW = 'overview'
 ADVERTISER_DASHBOARD_STATS = 'advertiser_dashboard_stats'
+LOG_CHECKPOINTS = 'log_checkpoints'
 
 TAXONOMY_COUNT = "taxonomy_count"
 INTENT_COUNT = "intent_count"
@@ -28,10 +32,19 @@ DOMAINS_DATA = "domains_data"
 
 BID_STREAM = "bidstream"
 BID_STREAM_DATEWISE = "bidstream_datewise"
+BID_STREAM_ROLLING = "bidstream_rolling"
+BID_STREAM_DAILY = "bidstream_daily"
+
+# urls per query of get_pages_crawled_between, and ingestion runs of the
+# incremental mode remembered on every page
+URLS_QUERY_CHUNK = 10000
+INGEST_RUNS_KEPT = 8
 
 ALL_COLLECTIONS = [CRAWLED_DOMAINS, CRAWLED_PAGES, OVERVIEW,
                    ADVERTISER_DASHBOARD_STATS, TAXONOMY_COUNT, INTENT_COUNT,
-                   BID_STREAM, BID_STREAM_DATEWISE, RE_COLLECTION]
+                   BID_STREAM, BID_STREAM_DATEWISE, BID_STREAM_ROLLING,
+                   BID_STREAM_DAILY, RE_COLLECTION, REPORT_WATERMARKS,
+                   LOG_CHECKPOINTS]
 
 
 def _get_production_uri(creds):
@@ -54,8 +67,10 @@ def _get_mongo_uri(r_engine=None):
     ) else _get_local_uri()
 
 
-_m_client = MongoClient(_get_mongo_uri())
-re_m_client = MongoClient(_get_mongo_uri(r_engine=True))
+# clients connect on their first operation, so importing this module from
+# a worker process that never queries opens no connection
+_m_client = MongoClient(_get_mongo_uri(), connect=False)
+re_m_client = MongoClient(_get_mongo_uri(r_engine=True), connect=False)
 
 
 def _setup_db():
@@ -78,21 +93,46 @@ def _setup_db():
     _m_client[DATABASE][INTENT_COUNT].create_index([
         ('date', DESCENDING)
     ], unique=True)
+    _m_client[DATABASE][LOG_CHECKPOINTS].create_index([
+        ('date', DESCENDING), ('log_level', ASCENDING)
+    ], unique=True)
     
     re_m_client[RE_DATABASE][RE_COLLECTION].create_index('lang')
+    re_m_client[RE_DATABASE][REPORT_WATERMARKS].create_index([
+        ('report', ASCENDING)
+    ], unique=True)
     re_m_client[RE_DATABASE][BID_STREAM_DATEWISE].create_index([
         ('ingested_on', DESCENDING), 
         ('domain', ASCENDING), 
         ('geo', ASCENDING)
     ], unique=True)
+    # records update_n_days_records reads: updated since the last run, and
+    # applied ones that may have left the window. partial so each run only
+    # walks these records instead of the whole history
+    re_m_client[RE_DATABASE][BID_STREAM_DATEWISE].create_index([
+        ('pending', ASCENDING)
+    ], partialFilterExpression={'pending': True})
+    re_m_client[RE_DATABASE][BID_STREAM_DATEWISE].create_index([
+        ('ingested_on', DESCENDING)
+    ], partialFilterExpression={'applied': {'$exists': True}})
     re_m_client[RE_DATABASE][BID_STREAM].create_index([
         ('domain', ASCENDING)
     ], unique=True)
+    re_m_client[RE_DATABASE][BID_STREAM_ROLLING].create_index([
+        ('domain', ASCENDING),
+        ('geo', ASCENDING)
+    ], unique=True)
+    re_m_client[RE_DATABASE][BID_STREAM_DAILY].create_index([
+        ('ingested_on', DESCENDING)
+    ], unique=True)
 
     logger.info("database setup completed")
 
 
-_setup_db()
+# indexes are set up by the main process only, spawned workers such as the
+# bidstream parse workers import this module through the analytics package
+if multiprocessing.parent_process() is None:
+    _setup_db()
 
 
 def _is_valid_collection_name(collection_name):
@@ -131,6 +171,11 @@ def _bulk_update(collection_name, update_requests, db_name=DATABASE):
         print(_bulk_update.__name__, e)
 
 
+# $inc of the bucket counts of a serialized quantile sketch into field
+def _get_sketch_increments(field, sketch):
+    return {f'{field}.{index}': count for index, count in (sketch or {}).items()}
+
+
 def create_overview_document(document):
     return _insert_one(OVERVIEW, document)
 
@@ -164,6 +209,8 @@ def update_overview_document(old_doc, document):
                                          old_doc['avg_page_load_speed']]),
             'urls_per_domain_mean': mean([document['urls_per_domain_mean'],
                                           old_doc['urls_per_domain_mean']]),
+            'urls_hll': HyperLogLog.from_document(old_doc.get('urls_hll')).merge(
+                HyperLogLog.from_document(document.get('urls_hll'))).to_document(),
         },
         '$push': {
             'non_compliance_reasons_count': {
@@ -180,6 +227,14 @@ def get_overview_doc_from_db(_date):
     logger.debug('failed to get overview document due to invalid date')
 
 
+def get_overview_documents_between(start, end):
+    return _m_client[DATABASE][OVERVIEW].find(
+        {'date': {
+            '$gte': start,
+            '$lt': end
+        }}, {'urls_hll': 1})
+
+
 def create_or_update_overview_document(document):
     result_doc = _m_client[DATABASE][OVERVIEW].find_one(
         {'date': document['date']})
@@ -188,6 +243,34 @@ def create_or_update_overview_document(document):
     return create_overview_document(document)
 
 
+def replace_overview_document(document):
+    return _m_client[DATABASE][OVERVIEW].replace_one(
+        {'date': document['date']}, document, upsert=True)
+
+
+def get_domain_documents_between(domain, start, end):
+    return _m_client[DATABASE][CRAWLED_DOMAINS].find({
+        'domain': domain,
+        'date': {
+            '$gte': start,
+            '$lt': end
+        }
+    })
+
+
+def get_domain_documents(_date):
+    return list(_m_client[DATABASE][CRAWLED_DOMAINS].find({'date': _date}))
+
+
+def replace_domain_documents(documents):
+    return _bulk_update(CRAWLED_DOMAINS, [
+        ReplaceOne({
+            'date': document['date'],
+            'domain': document['domain']
+        }, document, upsert=True) for document in documents
+    ])
+
+
 def create_domain_documents(documents):
     return _insert_many(CRAWLED_DOMAINS, documents)
 
@@ -205,6 +288,9 @@ def create_or_update_domains(documents):
                 'visit_count': document['visit_count'],
                 'compliance_count': document['compliance_count'],
                 'non_compliance_count': document['non_compliance_count'],
+                **_get_sketch_increments(
+                    'page_load_speed_sketch',
+                    document.get('page_load_speed_sketch'))
             },
             '$set': {
                 'avg_page_load_speed': document['avg_page_load_speed'],
@@ -218,30 +304,105 @@ def create_or_update_domains(documents):
     return _bulk_update(CRAWLED_DOMAINS, update_requests)
 
 
-def create_or_update_pages_documents(documents):
-    update_requests = []
+def _get_page_latest_crawl(document):
+    return {
+        'compliant': document.compliant,
+        'page_load_speed': document.page_load_speed,
+        'page_size': document.page_size,
+        'non_compliance_reason': document.non_compliance_reason
+    }
+
+
+# pages are upserted first, latest crawl attributes are then only set when
+# not older than the stored ones, so days written concurrently or out of
+# order leave the most recent crawl in place. with a run, pages are created
+# first and counts are only added to pages the run was not applied to yet,
+# so writing a run again after a crash adds nothing twice
+def create_or_update_pages_documents(documents, run=None):
+    created_requests, upsert_requests, latest_crawl_requests = [], [], []
     for document in documents:
-        update_requests.append(
-            UpdateOne({
-                'url': document.url,
-                'domain': document.domain
-            }, {
-                '$inc': {
-                    'visit_count': document.visit_count
-                },
-                '$setOnInsert': {
-                    'first_crawled_at': document.first_crawled_at
-                },
-                '$set': {
-                    'last_crawled_at': document.last_crawled_at,
-                    'compliant': document.compliant,
-                    'page_load_speed': document.page_load_speed,
-                    'page_size': document.page_size,
-                    'non_compliance_reason': document.non_compliance_reason
+        page = {
+            'url': document.url,
+            'domain': document.domain
+        }
+        update = {
+            '$inc': {
+                'visit_count': document.visit_count
+            },
+            '$min': {
+                'first_crawled_at': document.first_crawled_at
+            },
+            '$max': {
+                'last_crawled_at': document.last_crawled_at
+            }
+        }
+        if run is None:
+            update['$setOnInsert'] = _get_page_latest_crawl(document)
+            upsert_requests.append(UpdateOne(page, update, upsert=True))
+        else:
+            created_requests.append(UpdateOne(page, {
+                '$setOnInsert': dict(
+                    _get_page_latest_crawl(document),
+                    visit_count=0,
+                    first_crawled_at=document.first_crawled_at,
+                    last_crawled_at=document.last_crawled_at)
+            }, upsert=True))
+            update['$push'] = {
+                'ingest_runs': {
+                    '$each': [run],
+                    '$slice': -INGEST_RUNS_KEPT
                 }
+            }
+            upsert_requests.append(UpdateOne(
+                dict(page, ingest_runs={'$ne': run}), update))
+        latest_crawl_requests.append(
+            UpdateOne(dict(page, last_crawled_at={
+                '$lte': document.last_crawled_at
+            }), {
+                '$set': _get_page_latest_crawl(document)
+            }))
+    if not upsert_requests:
+        return
+    if created_requests and \
+            _bulk_update(CRAWLED_PAGES, created_requests) is None:
+        return
+    result = _bulk_update(CRAWLED_PAGES, upsert_requests)
+    _bulk_update(CRAWLED_PAGES, latest_crawl_requests)
+    return result
+
+
+# pages among urls whose last crawl falls within [start, end), queried in
+# chunks of urls so no query grows past the document size limit
+def get_pages_crawled_between(urls, start, end):
+    urls = list(urls)
+    pages = []
+    for chunk_start in range(0, len(urls), URLS_QUERY_CHUNK):
+        pages.extend(_m_client[DATABASE][CRAWLED_PAGES].find({
+            'url': {
+                '$in': urls[chunk_start:chunk_start + URLS_QUERY_CHUNK]
             },
-                upsert=True))
-    return _bulk_update(CRAWLED_PAGES, update_requests)
+            'last_crawled_at': {
+                '$gte': start,
+                '$lt': end
+            }
+        }))
+    return pages
+
+
+def get_log_checkpoint(_date, log_level):
+    return _m_client[DATABASE][LOG_CHECKPOINTS].find_one({
+        'date': _date,
+        'log_level': log_level
+    })
+
+
+def update_log_checkpoint(_date, log_level, checkpoint):
+    return _m_client[DATABASE][LOG_CHECKPOINTS].update_one(
+        {
+            'date': _date,
+            'log_level': log_level
+        }, {'$set': checkpoint},
+        upsert=True)
 
 
 def create_or_update_count_document(collection_name, document):
@@ -257,13 +418,25 @@ create_or_update_intent_count_document = lambda document: create_or_update_count
 create_or_update_urls_count_document = lambda document: create_or_update_count_document(DOMAINS_DATA, document)
 
 
+# counts and cpm are added to the stored ones and ad slots to the stored
+# set, so flushes of a run and runs of the same day add up. updated records
+# are pending until the rolling aggregation has applied them
 def create_or_update_bidstream_records(records):
 
     return _bulk_update(BID_STREAM_DATEWISE, 
         [
             UpdateOne(
-                dict(zip(["ingested_on", "domain", "geo"], key.split("|"))),
-                { '$set': values },
+                dict(zip(["ingested_on", "domain", "geo"], key)),
+                {
+                    '$inc': {
+                        'total_cpm': values['total_cpm'],
+                        'bids_count': values['bids_count'],
+                        **_get_sketch_increments('bidfloor_sketch',
+                                                 values.get('bidfloor_sketch'))
+                    },
+                    '$addToSet': {'ad_slots': {'$each': values['ad_slots']}},
+                    '$set': {'pending': True}
+                },
                 upsert=True
             ) for key, values in records.items()
         ],
@@ -272,4 +445,114 @@ def create_or_update_bidstream_records(records):
 
 def aggregate_bidstream_records(aggregate_query):
 
-    return re_m_client[RE_DATABASE][BID_STREAM_DATEWISE].aggregate(aggregate_query, allowDiskUse=True)
\ No newline at end of file
+    return re_m_client[RE_DATABASE][BID_STREAM_DATEWISE].aggregate(aggregate_query, allowDiskUse=True)
+
+
+def get_bidstream_records(query):
+
+    return re_m_client[RE_DATABASE][BID_STREAM_DATEWISE].find(query)
+
+
+# applied is the contribution of each record to the rolling totals, None
+# once it is out of the window. pending is only cleared on records that
+# have not been updated since they were read
+def set_bidstream_records_applied(records):
+
+    update_requests = []
+    for document, applied in records:
+        update_requests.append(UpdateOne(
+            {'_id': document['_id']},
+            {'$set': {'applied': applied}} if applied else
+            {'$unset': {'applied': ''}}))
+        update_requests.append(UpdateOne(
+            {'_id': document['_id'], 'bids_count': document['bids_count']},
+            {'$unset': {'pending': ''}}))
+    return _bulk_update(BID_STREAM_DATEWISE, update_requests, RE_DATABASE)
+
+
+def update_bidstream_rolling_totals(deltas):
+
+    return _bulk_update(BID_STREAM_ROLLING,
+        [
+            UpdateOne({'domain': domain, 'geo': geo}, {'$inc': delta}, upsert=True)
+            for (domain, geo), delta in deltas.items()
+        ],
+        RE_DATABASE
+    )
+
+
+def get_bidstream_rolling_totals(domains):
+
+    return re_m_client[RE_DATABASE][BID_STREAM_ROLLING].find(
+        {'domain': {'$in': domains}})
+
+
+def has_bidstream_rolling_totals():
+
+    return re_m_client[RE_DATABASE][BID_STREAM_ROLLING].find_one(
+        {}, {'_id': 1}) is not None
+
+
+# one time backfill of records flushed before they were marked pending,
+# walks the records of the window through the ingested_on index prefix
+def set_bidstream_records_pending(start_date):
+
+    return re_m_client[RE_DATABASE][BID_STREAM_DATEWISE].update_many(
+        {'ingested_on': {'$gte': start_date}, 'applied': {'$exists': False}},
+        {'$set': {'pending': True}})
+
+
+def delete_empty_bidstream_rolling_totals(domains):
+
+    return re_m_client[RE_DATABASE][BID_STREAM_ROLLING].delete_many(
+        {'domain': {'$in': domains}, 'unwound': {'$lte': 0}})
+
+
+def replace_bidstream_domains(documents):
+
+    return _bulk_update(BID_STREAM,
+        [
+            ReplaceOne({'domain': document['domain']}, document, upsert=True)
+            for document in documents
+        ],
+        RE_DATABASE
+    )
+
+
+def delete_bidstream_domains(domains):
+
+    return re_m_client[RE_DATABASE][BID_STREAM].delete_many(
+        {'domain': {'$in': domains}})
+
+def get_bidstream_daily_documents(query):
+
+    return re_m_client[RE_DATABASE][BID_STREAM_DAILY].find(query)
+
+
+def update_bidstream_daily_documents(documents):
+
+    return _bulk_update(BID_STREAM_DAILY,
+        [
+            UpdateOne({'ingested_on': ingested_on}, {'$set': document}, upsert=True)
+            for ingested_on, document in documents.items()
+        ],
+        RE_DATABASE
+    )
+
+
+def get_report_watermark(report):
+
+    return re_m_client[RE_DATABASE][REPORT_WATERMARKS].find_one({'report': report})
+
+
+# counters of a report are kept in its watermark document, so the counts
+# and the watermark they were counted up to are written at once
+def update_report_watermark(report, watermark, counts=None):
+
+    if counts is not None:
+        watermark = dict(watermark, counters=[
+            {'key': key, 'lang': lang, 'count': count}
+            for (key, lang), count in counts.items() if count
+        ])
+    return re_m_client[RE_DATABASE][REPORT_WATERMARKS].update_one(
+        {'report': report}, {'$set': watermark}, upsert=True)
@@ -1,3 +1,8 @@
+from array import array
+
+from analytics.sketch import get_index
+
+
 class PageItem(tuple):
     def __new__(cls, url, visit_count, domain, page_load_speed, page_size,
                 first_crawled_at, last_crawled_at, compliant,
@@ -123,6 +128,9 @@ class LogItem(tuple):
         return tuple.__new__(LogItem, (url, timestamp, page_load_speed,
                                        page_size, non_compliance_reason))
 
+    def __getnewargs__(self):
+        return tuple(self)
+
     @property
     def url(self):
         return self[0]
@@ -156,3 +164,264 @@ class ErrorItem(LogItem):
 class InfoItem(LogItem):
     def __new__(cls, url, timestamp, page_load_speed, page_size):
         return LogItem(url, timestamp, page_load_speed, page_size, None)
+
+
+# dictionary encoded ids of the values added to it
+class _Dictionary:
+    def __init__(self, values=()):
+        self.values = []
+        self.ids = {}
+        for value in values:
+            self.get_id(value)
+
+    def __len__(self):
+        return len(self.values)
+
+    def __getstate__(self):
+        return self.values
+
+    def __setstate__(self, values):
+        self.__init__(values)
+
+    def get_id(self, value):
+        value_id = self.ids.get(value)
+        if value_id is None:
+            value_id = self.ids[value] = len(self.values)
+            self.values.append(value)
+        return value_id
+
+
+# columnar batch of page crawled and page crawl error events, urls and
+# non compliance reasons are dictionary encoded and timestamps are epoch
+# seconds, reason code 0 stands for a compliant page
+class LogEventBatch:
+    def __init__(self):
+        self.urls = _Dictionary()
+        self.reasons = _Dictionary([None])
+        self.url_ids = array('I')
+        self.timestamps = array('q')
+        self.page_load_speeds = array('d')
+        self.page_sizes = array('i')
+        self.reason_codes = array('I')
+
+    def __len__(self):
+        return len(self.url_ids)
+
+    def append(self, url, timestamp, page_load_speed, page_size,
+               non_compliance_reason=None):
+        self.url_ids.append(self.urls.get_id(url))
+        self.timestamps.append(timestamp)
+        self.page_load_speeds.append(page_load_speed)
+        self.page_sizes.append(page_size)
+        self.reason_codes.append(self.reasons.get_id(non_compliance_reason))
+
+
+_MAX_TIMESTAMP = 2 ** 63 - 1
+_MIN_TIMESTAMP = -2 ** 63
+
+
+# visit count, first and last crawled timestamp with the attributes of the
+# last crawl of every url, kept in columns indexed by url id and updated in
+# constant time per event whatever the input order. epoch second timestamps
+# come from LogEventBatch, otherwise log item timestamps are kept as they
+# are. partial accumulators of the same logs in log order can be merged
+class PageAccumulator:
+    def __init__(self, epoch_timestamps=False):
+        self.epoch_timestamps = epoch_timestamps
+        self.urls = _Dictionary()
+        self.reasons = _Dictionary([None])
+        self.visit_counts = array('I')
+        self.first_timestamps = array('q') if epoch_timestamps else []
+        self.last_timestamps = array('q') if epoch_timestamps else []
+        self.page_load_speeds = array('d')
+        self.page_sizes = array('i')
+        self.reason_codes = array('I')
+
+    def __len__(self):
+        return len(self.urls)
+
+    def _get_url_id(self, url, first_timestamp, last_timestamp):
+        url_id = self.urls.get_id(url)
+        if url_id == len(self.visit_counts):
+            self.visit_counts.append(0)
+            self.first_timestamps.append(first_timestamp)
+            self.last_timestamps.append(last_timestamp)
+            self.page_load_speeds.append(0)
+            self.page_sizes.append(0)
+            self.reason_codes.append(0)
+        return url_id
+
+    def _add(self, url_id, visit_count, first_timestamp, last_timestamp,
+             page_load_speed, page_size, reason_code, is_new):
+        self.visit_counts[url_id] += visit_count
+        if is_new or first_timestamp < self.first_timestamps[url_id]:
+            self.first_timestamps[url_id] = first_timestamp
+        if is_new or last_timestamp > self.last_timestamps[url_id]:
+            self.last_timestamps[url_id] = last_timestamp
+            self.page_load_speeds[url_id] = page_load_speed
+            self.page_sizes[url_id] = page_size
+            self.reason_codes[url_id] = reason_code
+
+    def add(self, log_item):
+        if self.epoch_timestamps:
+            raise ValueError('log items can not be added to accumulator '
+                             'with epoch timestamps')
+        is_new = log_item.url not in self.urls.ids
+        url_id = self._get_url_id(log_item.url, log_item.timestamp,
+                                  log_item.timestamp)
+        self._add(url_id, 1, log_item.timestamp, log_item.timestamp,
+                  float(log_item.page_load_speed), int(log_item.page_size),
+                  self.reasons.get_id(log_item.non_compliance_reason), is_new)
+
+    def update(self, log_items):
+        for log_item in log_items:
+            self.add(log_item)
+        return self
+
+    def add_batch(self, batch):
+        if not self.epoch_timestamps:
+            raise ValueError('batches need accumulator with epoch timestamps')
+        url_ids = [
+            self._get_url_id(url, _MAX_TIMESTAMP, _MIN_TIMESTAMP)
+            for url in batch.urls.values
+        ]
+        reason_codes = [self.reasons.get_id(_) for _ in batch.reasons.values]
+        visit_counts, first_timestamps, last_timestamps = \
+            self.visit_counts, self.first_timestamps, self.last_timestamps
+        page_load_speeds, page_sizes = self.page_load_speeds, self.page_sizes
+        accumulated_reason_codes = self.reason_codes
+        for url_id, timestamp, page_load_speed, page_size, reason_code in zip(
+                batch.url_ids, batch.timestamps, batch.page_load_speeds,
+                batch.page_sizes, batch.reason_codes):
+            url_id = url_ids[url_id]
+            visit_counts[url_id] += 1
+            if timestamp < first_timestamps[url_id]:
+                first_timestamps[url_id] = timestamp
+            if timestamp > last_timestamps[url_id]:
+                last_timestamps[url_id] = timestamp
+                page_load_speeds[url_id] = page_load_speed
+                page_sizes[url_id] = page_size
+                accumulated_reason_codes[url_id] = reason_codes[reason_code]
+        return self
+
+    def update_batches(self, batches):
+        for batch in batches:
+            self.add_batch(batch)
+        return self
+
+    def merge(self, other):
+        if other.epoch_timestamps != self.epoch_timestamps:
+            raise ValueError('accumulators timestamps should be of same type')
+        for other_url_id, url in enumerate(other.urls.values):
+            is_new = url not in self.urls.ids
+            url_id = self._get_url_id(url, other.first_timestamps[other_url_id],
+                                      other.last_timestamps[other_url_id])
+            self._add(url_id, other.visit_counts[other_url_id],
+                      other.first_timestamps[other_url_id],
+                      other.last_timestamps[other_url_id],
+                      other.page_load_speeds[other_url_id],
+                      other.page_sizes[other_url_id],
+                      self.reasons.get_id(other.reasons.values[
+                          other.reason_codes[other_url_id]]), is_new)
+        return self
+
+    # url, visit count, first and last crawled timestamp, page load speed,
+    # page size and non compliance reason of every accumulated url
+    def __iter__(self):
+        reasons = self.reasons.values
+        return zip(self.urls.values, self.visit_counts, self.first_timestamps,
+                   self.last_timestamps, self.page_load_speeds,
+                   self.page_sizes, (reasons[_] for _ in self.reason_codes))
+
+
+# ad slots, unrounded cpm sum, bid count and bid floor quantile sketch
+# buckets of the bid requests of a day, domain and geo. documents round the
+# cpm and list the slots
+class BidRecord:
+    __slots__ = ('ad_slots', 'total_cpm', 'bids_count', 'bidfloor_buckets')
+
+    def __init__(self, ad_slots=frozenset()):
+        self.ad_slots = ad_slots
+        self.total_cpm = 0.0
+        self.bids_count = 0
+        self.bidfloor_buckets = {}
+
+    def get_document(self):
+        return {
+            "ad_slots": ["{}x{}".format(*_) for _ in self.ad_slots],
+            "total_cpm": round(self.total_cpm, 4),
+            "bids_count": self.bids_count,
+            "bidfloor_sketch": {str(index): count for index, count
+                                in self.bidfloor_buckets.items()}
+        }
+
+
+# bid records keyed by (ingested on, domain, geo) tuples. key values, ad
+# slots and ad slot sets are interned so the many records of a day share
+# their dates, domains, geos and the few distinct sets of slots. sketch
+# buckets of bid floors are looked up once per distinct bid floor
+class BidAccumulator:
+    __slots__ = ('records', '_values', '_bucket_indices')
+
+    def __init__(self):
+        self.records = {}
+        self._values = {}
+        self._bucket_indices = {}
+
+    def __len__(self):
+        return len(self.records)
+
+    def __getstate__(self):
+        return self.records
+
+    def __setstate__(self, records):
+        self.__init__()
+        self.records = records
+
+    def _intern(self, value):
+        return self._values.setdefault(value, value)
+
+    def _get_record(self, key):
+        record = self.records.get(key)
+        if record is None:
+            key = tuple([self._intern(_) for _ in key])
+            record = self.records[key] = BidRecord()
+        return record
+
+    def _add_ad_slots(self, record, ad_slots):
+        if not ad_slots <= record.ad_slots:
+            record.ad_slots = self._intern(record.ad_slots | ad_slots)
+
+    def add(self, ingested_on, domain, geo, width, height, cpm):
+        record = self._get_record((ingested_on, domain, geo))
+        ad_slot = (width, height)
+        if ad_slot not in record.ad_slots:
+            self._add_ad_slots(record, frozenset([self._intern(ad_slot)]))
+        record.total_cpm += cpm
+        record.bids_count += 1
+        index = self._bucket_indices.get(cpm)
+        if index is None:
+            index = self._bucket_indices[cpm] = get_index(cpm)
+        buckets = record.bidfloor_buckets
+        buckets[index] = buckets.get(index, 0) + 1
+
+    def merge(self, other):
+        for key, other_record in other.records.items():
+            record = self._get_record(key)
+            self._add_ad_slots(record, other_record.ad_slots)
+            record.total_cpm += other_record.total_cpm
+            record.bids_count += other_record.bids_count
+            buckets = record.bidfloor_buckets
+            for index, count in other_record.bidfloor_buckets.items():
+                buckets[index] = buckets.get(index, 0) + count
+        return self
+
+    def clear(self):
+        self.records.clear()
+        self._values.clear()
+        self._bucket_indices.clear()
+
+    # documents of the records by key, built only when they are written
+    def get_documents(self):
+        return {key: record.get_document()
+                for key, record in self.records.items()}
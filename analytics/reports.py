@@ -1,52 +1,142 @@
-from datetime import datetime
+import os
+import logging
+from datetime import datetime, timedelta
+from bson import ObjectId
 from analytics.utils import DATE_FORMAT
 from analytics.db import (RE_DATABASE, RE_COLLECTION,
     re_m_client,
     create_or_update_taxonomy_count_document,
     create_or_update_intent_count_document,
-    create_or_update_urls_count_document
+    create_or_update_urls_count_document,
+    get_report_watermark,
+    update_report_watermark
 )
 
+logger = logging.getLogger('reports')
 db = re_m_client[RE_DATABASE]
 LANGUAGE_OPTIONS = ["en", "es"]
 
 
-def get_taxonomy_report():
+# unwound field and group key of the counted reports
+COUNTED_REPORTS = {
+    "taxonomy": ("$taxonomy", "$taxonomy.label"),
+    "intent": ("$intent", "$intent"),
+}
+
+
+# documents count per (key, lang) of a report, of the documents matching
+# match. lang is kept as stored, null and "" are different counters. a key
+# or lang that is an object or an array can't be a counter and is skipped
+def get_report_counts(report, match):
 
+    field, key = COUNTED_REPORTS[report]
     aggregate_query = [
         {
-            "$unwind": "$taxonomy"
+            "$match": match
+        }, {
+            "$unwind": field
         }, {
             "$group": {
                 "_id": {
-                    "taxonomy": "$taxonomy.label",
+                    "key": key,
                     "lang": "$lang"
-                }, 
+                },
                 "total": {
                     "$sum": 1
                 }
             }
-        }, 
-        {
-            "$group": {
-                "_id": "$_id.taxonomy",
-                "total": {
-                    "$push": {
-                        "lang": { "$ifNull": [ "$_id.lang", "" ] },
-                        "count": "$total"
-                    }
-                }
-            }
         }
     ]
 
-    db_response = db[RE_COLLECTION].aggregate(aggregate_query)
+    counts, skipped = {}, 0
+    for record in db[RE_COLLECTION].aggregate(aggregate_query):
+        try:
+            counts[record["_id"].get("key"), record["_id"].get("lang")] = record["total"]
+        except TypeError:
+            skipped += record["total"]
+    if skipped:
+        logger.warning(f"{report} counters skip {skipped} values with an object "
+                       f"or array key or lang")
+    return counts
+
+
+# counters of a report stored with its watermark
+def _get_report_counters(watermark):
+
+    return {
+        (counter["key"], counter["lang"]): counter["count"]
+        for counter in watermark.get("counters", [])
+    }
+
+
+# counters of a report brought up to date. documents inserted since the
+# watermark, an _id, are counted and added. the watermark stays a few
+# seconds behind now since other writers' ids can arrive slightly out of
+# order. counters and watermark are written together, so a run that fails
+# in between adds nothing twice. every REPORT_FULL_RECOUNT_DAYS days, or
+# without a watermark, everything is recounted, compared with the counters
+# and replaces them, which also catches updated and deleted documents
+def update_report_counters(report):
+
+    now = datetime.utcnow()
+    upper = ObjectId.from_datetime(
+        now - timedelta(seconds=int(os.getenv('REPORT_WATERMARK_LAG_SECONDS', 60))))
+    watermark = get_report_watermark(report)
+    # watermarks stored without their counters are recounted
+    if watermark and "counters" not in watermark:
+        watermark = None
+
+    if watermark:
+        counters = _get_report_counters(watermark)
+        counts = get_report_counts(
+            report, {"_id": {"$gt": watermark["watermark"], "$lte": upper}})
+        for key, count in counts.items():
+            counters[key] = counters.get(key, 0) + count
+        update_report_watermark(report, {"watermark": upper}, counters)
+        logger.info(f"{report} counters updated from {sum(counts.values())} new values")
+
+    recount_days = int(os.getenv('REPORT_FULL_RECOUNT_DAYS', 7))
+    if watermark and watermark["recounted_at"] > now - timedelta(days=recount_days):
+        return counters
+
+    counts = get_report_counts(report, {"_id": {"$lte": upper}})
+    if watermark:
+        mismatches = [key for key in counts.keys() | counters.keys()
+                      if counts.get(key, 0) != counters.get(key, 0)]
+        if mismatches:
+            logger.warning(f"{report} counters differ from the full recount for "
+                           f"{len(mismatches)} keys, replacing them")
+        else:
+            logger.info(f"{report} counters verified by a full recount")
+    update_report_watermark(report, {"watermark": upper, "recounted_at": now}, counts)
+    return counts
+
+
+# counters grouped like the report pipelines did: per key, its count per
+# lang with a missing lang as ""
+def _get_counted_records(counts):
+
+    records = {}
+    for (key, lang), count in sorted(counts.items(), key=lambda item: (
+            str(item[0][0]), str(item[0][1]))):
+        if count:
+            records.setdefault(key, []).append({
+                "lang": "" if lang is None else lang,
+                "count": count
+            })
+    return records.items()
+
+
+def get_taxonomy_report():
+
     languages = set([])
     report = {}
 
-    for record in db_response:
+    for taxonomy, total in _get_counted_records(update_report_counters("taxonomy")):
+        if taxonomy is None:
+            continue
 
-        parent_taxonomy, *extras = record["_id"].split("_")
+        parent_taxonomy, *extras = taxonomy.split("_")
         child_taxonomy = "_".join(extras)
 
         if parent_taxonomy not in report:
@@ -58,7 +148,7 @@ def get_taxonomy_report():
 
         temp_total = report[parent_taxonomy].get("total", {})
 
-        for item in record["total"]:
+        for item in total:
             lang = item["lang"]
             if lang not in temp_total:
                 temp_total[lang] = 0
@@ -73,7 +163,7 @@ def get_taxonomy_report():
 
         report[parent_taxonomy]["sub_categories"].append({
             "taxonomy": child_taxonomy,
-            "total": record["total"]
+            "total": total
         })
 
     for item in report.values():
@@ -92,43 +182,13 @@ def get_taxonomy_report():
 
 def get_intent_report():
 
-    aggregate_query = [
-        {
-            "$unwind": "$intent"
-        }, {
-            "$group": {
-                "_id": {
-                    "intent": "$intent", 
-                    "lang": "$lang"                    
-                }, 
-                "total": {
-                    "$sum": 1
-                }
-            }
-        }, {
-            "$group": {
-                "_id": "$_id.intent", 
-                "total": {
-                    "$push": {
-                        "lang": {"$ifNull": ["$_id.lang", ""]}, 
-                        "count": "$total"
-                    }
-                }
-            }
-        }, {
-            '$project': {
-                '_id': 0, 
-                'intent': '$_id', 
-                'total': '$total'
-            }
-        }
-    ]
-
-    db_response = db[RE_COLLECTION].aggregate(aggregate_query)
     today = datetime.strptime(datetime.today().date().isoformat(), DATE_FORMAT) 
     document = {
         "date": today, 
-        "intents": list(db_response)
+        "intents": [
+            {"intent": intent, "total": total}
+            for intent, total in _get_counted_records(update_report_counters("intent"))
+        ]
     }
 
     return create_or_update_intent_count_document(document)
@@ -0,0 +1,214 @@
+import math
+from hashlib import blake2b
+from itertools import count
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# values are counted in logarithmic buckets of relative width 2% so any
+# quantile is within 1% of the true value. bucket indices are clamped to a
+# fixed range, sketches hold at most MAX_INDEX - MIN_INDEX + 2 buckets
+RELATIVE_ACCURACY = 0.01
+GAMMA = (1 + RELATIVE_ACCURACY) / (1 - RELATIVE_ACCURACY)
+LOG_GAMMA = math.log(GAMMA)
+MIN_VALUE = 1e-4
+MIN_INDEX = math.ceil(math.log(MIN_VALUE) / LOG_GAMMA)
+MAX_INDEX = math.ceil(math.log(1e7) / LOG_GAMMA)
+# values below MIN_VALUE, zero included
+ZERO_INDEX = MIN_INDEX - 1
+QUANTILES = (0.5, 0.9, 0.99)
+
+
+def get_index(value):
+    if value < MIN_VALUE:
+        return ZERO_INDEX
+    return min(math.ceil(math.log(value) / LOG_GAMMA), MAX_INDEX)
+
+
+# value of the middle of a bucket, within RELATIVE_ACCURACY of any value
+# counted in it
+def get_bucket_value(index):
+    if index == ZERO_INDEX:
+        return 0.0
+    return 2 * GAMMA ** index / (GAMMA + 1)
+
+
+# mergeable quantile sketch, counts of values per logarithmic bucket. counts
+# only add up, so sketches of pages, runs and days are merged by adding
+# their buckets, in memory or with $inc on their documents
+class QuantileSketch:
+    __slots__ = ('buckets',)
+
+    def __init__(self, buckets=None):
+        self.buckets = buckets if buckets is not None else {}
+
+    def __len__(self):
+        return sum(_ for _ in self.buckets.values() if _ > 0)
+
+    def __eq__(self, other):
+        return isinstance(other, QuantileSketch) and \
+            self.to_document() == other.to_document()
+
+    def add(self, value, count=1):
+        index = get_index(value)
+        self.buckets[index] = self.buckets.get(index, 0) + count
+
+    def update(self, values):
+        for value in values:
+            self.add(value)
+        return self
+
+    # count of -1 takes a value counted before out again
+    def remove(self, value):
+        self.add(value, -1)
+
+    def merge(self, other):
+        buckets = self.buckets
+        for index, count in other.buckets.items():
+            buckets[index] = buckets.get(index, 0) + count
+        return self
+
+    # value below which a q fraction of the values fall, None when empty
+    def get_quantile(self, q):
+        buckets = sorted((index, count) for index, count in self.buckets.items()
+                         if count > 0)
+        total = sum(count for _, count in buckets)
+        if not total:
+            return None
+        rank = q * (total - 1)
+        seen = 0
+        for index, count in buckets:
+            seen += count
+            if seen > rank:
+                return get_bucket_value(index)
+        return get_bucket_value(buckets[-1][0])
+
+    def get_quantiles(self, quantiles=QUANTILES):
+        return {'p%g' % (q * 100): self.get_quantile(q) for q in quantiles}
+
+    # bucket counts by index string, as stored in mongo
+    def to_document(self):
+        return {str(index): count for index, count in self.buckets.items()
+                if count}
+
+    @classmethod
+    def from_document(cls, document):
+        return cls({int(index): count
+                    for index, count in (document or {}).items()})
+
+
+# sketch of the values of every key, bucket indices are computed in one
+# numpy pass when numpy is available
+def get_sketches(keys, values):
+    if numpy is None:
+        sketches = {}
+        for key, value in zip(keys, values):
+            sketch = sketches.get(key)
+            if sketch is None:
+                sketch = sketches[key] = QuantileSketch()
+            sketch.add(value)
+        return sketches
+
+    key_names = sorted(set(keys))
+    key_ids = dict(zip(key_names, count()))
+    values = numpy.asarray(values, dtype=numpy.float64)
+    indices = numpy.full(len(values), ZERO_INDEX, dtype=numpy.int64)
+    counted = values >= MIN_VALUE
+    indices[counted] = numpy.minimum(
+        numpy.ceil(numpy.log(values[counted]) / LOG_GAMMA), MAX_INDEX)
+    # (key id, bucket) pairs counted in a single unique
+    span = MAX_INDEX - ZERO_INDEX + 1
+    pairs, counts = numpy.unique(
+        numpy.fromiter(map(key_ids.__getitem__, keys), dtype=numpy.int64,
+                       count=len(values)) * span + indices - ZERO_INDEX,
+        return_counts=True)
+    sketches = {key: QuantileSketch() for key in key_names}
+    for pair, bucket_count in zip(pairs.tolist(), counts.tolist()):
+        key_id, index = divmod(pair, span)
+        sketches[key_names[key_id]].buckets[index + ZERO_INDEX] = bucket_count
+    return sketches
+
+
+# hyperloglog registers, 2 ** HLL_PRECISION bytes for a standard error of
+# 1.04 / sqrt(2 ** HLL_PRECISION), about 1.6%
+HLL_PRECISION = 12
+HLL_REGISTERS = 2 ** HLL_PRECISION
+HLL_ALPHA = 0.7213 / (1 + 1.079 / HLL_REGISTERS)
+
+
+# stable 64 bit hash of a string, the same in every process and run
+def get_hash(value):
+    return int.from_bytes(blake2b(value.encode(), digest_size=8).digest(), 'big')
+
+
+# approximate distinct count of strings. sketches of days, pages and runs
+# are merged by taking the maximum of every register, so adding a value
+# twice or merging the same sketch again changes nothing
+class HyperLogLog:
+    __slots__ = ('registers',)
+
+    def __init__(self, registers=None):
+        self.registers = bytearray(registers or HLL_REGISTERS)
+
+    def __len__(self):
+        return round(self.get_estimate())
+
+    def __eq__(self, other):
+        return isinstance(other, HyperLogLog) and \
+            self.registers == other.registers
+
+    def add(self, value):
+        hashed = get_hash(value)
+        register = hashed >> (64 - HLL_PRECISION)
+        rank = 64 - HLL_PRECISION - \
+            (hashed & (1 << (64 - HLL_PRECISION)) - 1).bit_length() + 1
+        if rank > self.registers[register]:
+            self.registers[register] = rank
+
+    # registers of all the values are updated in one numpy pass when numpy
+    # is available, frexp gives the exact bit length of the 52 bit remainders
+    def update(self, values):
+        if numpy is None:
+            for value in values:
+                self.add(value)
+            return self
+        hashes = numpy.frombuffer(b''.join([
+            blake2b(value.encode(), digest_size=8).digest() for value in values
+        ]), dtype='>u8').astype(numpy.uint64)
+        remainders = hashes & numpy.uint64((1 << (64 - HLL_PRECISION)) - 1)
+        ranks = 64 - HLL_PRECISION + 1 - numpy.frexp(
+            remainders.astype(numpy.float64))[1]
+        registers = numpy.frombuffer(self.registers, dtype=numpy.uint8).copy()
+        numpy.maximum.at(registers,
+                         (hashes >> numpy.uint64(64 - HLL_PRECISION)).astype(numpy.intp),
+                         ranks.astype(numpy.uint8))
+        self.registers = bytearray(registers.tobytes())
+        return self
+
+    def merge(self, other):
+        if numpy is not None:
+            self.registers = bytearray(numpy.maximum(
+                numpy.frombuffer(self.registers, dtype=numpy.uint8),
+                numpy.frombuffer(other.registers, dtype=numpy.uint8)).tobytes())
+        else:
+            self.registers = bytearray(map(max, self.registers, other.registers))
+        return self
+
+    def get_estimate(self):
+        estimate = HLL_ALPHA * HLL_REGISTERS ** 2 / math.fsum(
+            2.0 ** -_ for _ in self.registers)
+        zeros = self.registers.count(0)
+        # linear counting is more accurate for small counts
+        if estimate <= 2.5 * HLL_REGISTERS and zeros:
+            return HLL_REGISTERS * math.log(HLL_REGISTERS / zeros)
+        return estimate
+
+    # registers as bytes, stored as binary in mongo
+    def to_document(self):
+        return bytes(self.registers)
+
+    @classmethod
+    def from_document(cls, document):
+        return cls(document) if document else cls()
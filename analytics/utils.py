@@ -1,12 +1,24 @@
 # validate date string
+import bz2
+import gzip
+import io
 import json
+import lzma
+import mmap
 import os
 import re
-from datetime import datetime
+from datetime import datetime, timedelta
+from functools import lru_cache
 
 from bson import json_util
 
-RECOMMENDATION_LOG_LINE_GROUP_LENGTH = PAGE_CRAWLED_LOG_LINE_GROUP_LENGTH = 5
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+RECOMMENDATION_LOG_LINE_GROUP_LENGTH = 5
+PAGE_CRAWLED_LOG_LINE_GROUP_LENGTH = 4
 CRAWLER_FREQUENCY_LOG_LINE_GROUP_LENGTH = 5
 PAGE_CRAWL_ERROR_LOG_LINE_GROUP_LENGTH = 3
 PAGE_CRAWL_ERROR_RE_PATTERN = re.compile(
@@ -20,6 +32,17 @@ RECOMMENDATION_ENGINE_RE_PATTERN = re.compile(
     '^(.*) (\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}),\d+ \[INFO\] recommendation_engine top1: (.*) top10: (.*) top50: (.*)$'
 )
 
+PAGE_CRAWLED_MARKER = 'PAGE_CRAWLED:'
+PAGE_CRAWL_ERROR_MARKER = 'PAGE_CRAWL_ERROR:'
+CRAWLER_FREQUENCY_MARKER = 'logstats:Crawled'
+RECOMMENDATION_ENGINE_MARKER = 'recommendation_engine'
+
+LOG_TIMESTAMP_LENGTH = len('YYYY-MM-DD HH:MM:SS')
+LOG_TIMESTAMP_CACHE_SIZE = 4096
+READ_BLOCK_SIZE = 8 * 1024 * 1024
+LOG_EVENT_BATCH_SIZE = 64 * 1024
+EPOCH = datetime(1970, 1, 1)
+
 ERROR_LOG_FILENAME = 'error.log.%s'
 INFO_LOG_FILENAME = 'info.log.%s'
 DATE_FORMAT = '%Y-%m-%d'
@@ -30,12 +53,38 @@ class LogLevel:
     ERROR = 2
 
 
+class LogLineType:
+    PAGE_CRAWLED = 1
+    PAGE_CRAWL_ERROR = 2
+    CRAWLER_FREQUENCY = 3
+    RECOMMENDATION_ENGINE = 4
+
+
 LogLevelFileMapper = {
     LogLevel.INFO: INFO_LOG_FILENAME,
     LogLevel.ERROR: ERROR_LOG_FILENAME
 }
 
 
+# binary reader or writer, like the other openers for mode 'rb' or 'wb'
+def _open_zstd(file_path, mode='rb'):
+    if zstandard is None:
+        raise ImportError('zstandard is required to open %s' % file_path)
+    if 'w' in mode:
+        return zstandard.ZstdCompressor().stream_writer(open(file_path, 'wb'),
+                                                        closefd=True)
+    return zstandard.ZstdDecompressor().stream_reader(open(file_path, 'rb'),
+                                                      closefd=True)
+
+
+CompressedFileOpener = {
+    '.gz': gzip.open,
+    '.bz2': bz2.open,
+    '.xz': lzma.open,
+    '.zst': _open_zstd
+}
+
+
 def validate_date_string(date_string, date_format):
     try:
         return datetime.strptime(date_string, date_format)
@@ -48,17 +97,158 @@ def is_valid_date_string(date_string, date_format):
     return bool(validate_date_string(date_string, date_format))
 
 
+# build datetime from fixed width YYYY-MM-DD HH:MM:SS log timestamp,
+# lines logged within the same second share one cached result
+@lru_cache(maxsize=LOG_TIMESTAMP_CACHE_SIZE)
+def _decode_log_timestamp(timestamp):
+    return datetime(int(timestamp[0:4]), int(timestamp[5:7]),
+                    int(timestamp[8:10]), int(timestamp[11:13]),
+                    int(timestamp[14:16]), int(timestamp[17:19]))
+
+
+def decode_log_timestamp(timestamp):
+    return _decode_log_timestamp(timestamp[:LOG_TIMESTAMP_LENGTH])
+
+
+# whole seconds since epoch of naive log timestamp
+@lru_cache(maxsize=LOG_TIMESTAMP_CACHE_SIZE)
+def get_epoch_seconds(timestamp):
+    return (timestamp - EPOCH) // timedelta(seconds=1)
+
+
+def from_epoch_seconds(seconds):
+    return EPOCH + timedelta(seconds=seconds)
+
+
 # read file generator
 def read_lines_from_file(file_path):
     if not os.path.exists(file_path):
         raise FileNotFoundError(
             'File you\'re trying to read at %s does not exist' % file_path)
-    with open(file_path) as fp:
+    with open_log_file(file_path) as fp:
         for line in fp:
             yield line
         fp.close()
 
 
+# check if file is one of the compressed log formats
+def is_compressed_file(file_path):
+    return os.path.splitext(file_path)[1] in CompressedFileOpener
+
+
+# open log file as text, compressed files are decoded while streaming
+# through a large read buffer
+def open_log_file(file_path):
+    opener = CompressedFileOpener.get(os.path.splitext(file_path)[1])
+    if not opener:
+        return open(file_path)
+    return io.TextIOWrapper(
+        io.BufferedReader(opener(file_path), buffer_size=READ_BLOCK_SIZE))
+
+
+# split file into newline aligned (start, end) byte ranges
+def get_file_byte_ranges(file_path, ranges_count):
+    if not os.path.exists(file_path):
+        raise FileNotFoundError(
+            'File you\'re trying to read at %s does not exist' % file_path)
+    file_size = os.path.getsize(file_path)
+    if not file_size:
+        return []
+    byte_ranges = []
+    with open(file_path, 'rb') as fp, mmap.mmap(
+            fp.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        start = 0
+        for index in range(1, ranges_count + 1):
+            if start >= file_size:
+                break
+            end = file_size * index // ranges_count
+            if end < file_size:
+                newline = mm.find(b'\n', max(end - 1, start))
+                end = file_size if newline == -1 else newline + 1
+            if end > start:
+                byte_ranges.append((start, end))
+                start = end
+    return byte_ranges
+
+
+# read lines of a newline aligned byte range from memory mapped file,
+# decoded in blocks with the same newline handling as read_lines_from_file
+def read_lines_from_byte_range(file_path, start, end):
+    with open(file_path, 'rb') as fp, mmap.mmap(
+            fp.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        while start < end:
+            block_end = min(start + READ_BLOCK_SIZE, end)
+            if block_end < end:
+                newline = mm.rfind(b'\n', start, block_end)
+                if newline == -1:
+                    newline = mm.find(b'\n', block_end, end)
+                block_end = end if newline == -1 else newline + 1
+            yield from io.TextIOWrapper(io.BytesIO(mm[start:block_end]))
+            start = block_end
+
+
+# complete lines appended to a log file since its checkpoint offset, the
+# offset counts decompressed bytes for compressed files so a day's log
+# rotated into a compressed file resumes where the plain file stopped. a
+# checkpoint with a pending offset is read up to it, so a run that did not
+# complete reads the same lines again
+class AppendedLogLines:
+    def __init__(self, file_path, checkpoint=None):
+        self.file_path = file_path
+        self.inode = os.stat(file_path).st_ino
+        self.offset = 0
+        self.end = None
+        if checkpoint and (checkpoint['inode'] == self.inode or
+                           (is_compressed_file(file_path) and
+                            checkpoint['path'] != file_path)):
+            self.offset = checkpoint['offset']
+            self.end = checkpoint.get('pending_offset')
+
+    def __iter__(self):
+        if is_compressed_file(self.file_path):
+            return self._read_compressed_lines()
+        return self._read_plain_lines()
+
+    def _read_plain_lines(self):
+        file_size = os.path.getsize(self.file_path)
+        if self.end is not None:
+            file_size = min(file_size, self.end)
+        if file_size < self.offset:
+            self.offset = 0
+        if file_size == self.offset:
+            return
+        with open(self.file_path, 'rb') as fp, mmap.mmap(
+                fp.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            end = mm.rfind(b'\n', self.offset, file_size) + 1
+        if end <= self.offset:
+            return
+        yield from read_lines_from_byte_range(self.file_path, self.offset, end)
+        self.offset = end
+
+    def _read_compressed_lines(self):
+        opener = CompressedFileOpener[os.path.splitext(self.file_path)[1]]
+        with io.BufferedReader(opener(self.file_path),
+                               buffer_size=READ_BLOCK_SIZE) as fp:
+            skipped = 0
+            while skipped < self.offset:
+                block = fp.read(min(READ_BLOCK_SIZE, self.offset - skipped))
+                if not block:
+                    return
+                skipped += len(block)
+            for line in fp:
+                if self.end is not None and self.offset >= self.end:
+                    return
+                self.offset += len(line)
+                yield line.decode()
+
+    def get_checkpoint(self):
+        return {
+            'path': self.file_path,
+            'inode': self.inode,
+            'offset': self.offset
+        }
+
+
 # check if it's any log line type
 def _is_log_line_type(line, re_pattern):
     if not isinstance(line, str):
@@ -95,7 +285,7 @@ def write_json_to_file(file_path, file_name, content):
         fp.close()
 
 
-# get log file path for error and info
+# get plain or compressed log file path for error and info
 def get_log_file_path(date_string, logs_path, log_level=LogLevel.INFO):
     if not isinstance(logs_path, str):
         raise ValueError('logs_path should be of str type')
@@ -107,9 +297,10 @@ def get_log_file_path(date_string, logs_path, log_level=LogLevel.INFO):
     log_file_path = os.path.join(
         logs_path,
         LogLevelFileMapper.get(log_level) % date_string)
-    if not os.path.exists(log_file_path):
-        raise FileNotFoundError('Log file not exist at %s' % log_file_path)
-    return log_file_path
+    for extension in ('', *CompressedFileOpener):
+        if os.path.exists(log_file_path + extension):
+            return log_file_path + extension
+    raise FileNotFoundError('Log file not exist at %s' % log_file_path)
 
 
 def get_re_match_group(line, re_string, expected_group_length):
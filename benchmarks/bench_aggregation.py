@@ -0,0 +1,77 @@
+import argparse
+import math
+import os
+import random
+import sys
+import time
+from datetime import datetime
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__),
+                                                os.pardir)))
+
+import analytics
+from analytics import models
+
+REASONS = [None] * 8 + ['HttpError', 'TimeoutError', 'DNSLookupError']
+
+
+def build_page_items(count, domains):
+    page_items = []
+    for i in range(count):
+        reason = random.choice(REASONS)
+        page_items.append(
+            models.PageItem('https://www.example%d.com/%d' % (i % domains, i),
+                            random.randint(1, 5),
+                            'www.example%d.com' % (i % domains),
+                            random.uniform(0, 3000), random.randint(0, 10 ** 6),
+                            None, None, reason is None, reason))
+    return page_items
+
+
+def aggregate(page_items, date):
+    domain_items = analytics.get_domain_items(page_items, date)
+    return domain_items, analytics.get_overview_item(domain_items, page_items,
+                                                     [1], date)
+
+
+# same results, numpy page load speed means only match up to rounding
+def assert_same_results(numpy_result, python_result):
+    (numpy_domains, numpy_overview), (python_domains, python_overview) = \
+        numpy_result, python_result
+    assert [_[:4] + _[5:] for _ in numpy_domains] == \
+        [_[:4] + _[5:] for _ in python_domains]
+    assert all(math.isclose(numpy_item[4], python_item[4], rel_tol=1e-9)
+               for numpy_item, python_item in zip(numpy_domains, python_domains))
+    speed = 'avg_page_load_speed'
+    assert math.isclose(numpy_overview[speed], python_overview[speed],
+                        rel_tol=1e-9)
+    assert {key: value for key, value in numpy_overview.items() if key != speed} == \
+        {key: value for key, value in python_overview.items() if key != speed}
+
+
+def run_benchmark(name, page_items, date):
+    start = time.perf_counter()
+    result = aggregate(page_items, date)
+    elapsed = time.perf_counter() - start
+    print(f'{name:<10} {len(page_items):>10} pages {elapsed:>8.2f}s')
+    return result, elapsed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--pages', type=int, nargs='+',
+                        default=[1000000, 10000000])
+    parser.add_argument('--domains', type=int, default=5000)
+    args = parser.parse_args()
+
+    date = datetime(2021, 3, 12)
+    numpy = analytics.numpy
+    for count in args.pages:
+        page_items = build_page_items(count, args.domains)
+        analytics.numpy = None
+        python_result, python_elapsed = run_benchmark('python', page_items,
+                                                      date)
+        analytics.numpy = numpy
+        numpy_result, numpy_elapsed = run_benchmark('numpy', page_items, date)
+        assert_same_results(numpy_result, python_result)
+        print(f'speedup    {python_elapsed / numpy_elapsed:.2f}x')
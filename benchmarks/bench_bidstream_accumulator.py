@@ -0,0 +1,77 @@
+import argparse
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__),
+                                                os.pardir)))
+
+from analytics.models import BidAccumulator
+
+AD_SLOTS = [(300, 250), (320, 50), (728, 90), (160, 600), (300, 600)]
+GEOS = ['USA', 'GBR', 'IND', 'DEU', 'FRA', 'BRA', 'CAN', 'AUS']
+
+
+# decoded bid requests fields, strings are fresh objects as they are when
+# they come out of json decoding
+def get_bids(count, domains, days):
+    random.seed(0)
+    return [('2021-12-%02d' % (1 + i % days), 'example%d.com' % random.randrange(domains),
+             random.choice(GEOS)) + random.choice(AD_SLOTS) +
+            (round(random.random(), 3),) for i in range(count)]
+
+
+# previous accumulation: string keys and a rebuilt set, list, rounded cpm
+# and dict for every bid
+def accumulate_dicts(bids):
+    records = {}
+    for ingested_on, domain, geo, width, height, bidfloor in bids:
+        record_key = f"{ingested_on}|{domain}|{geo}"
+        record_data = records.get(record_key, {})
+        ad_slots = set(record_data.get("ad_slots", []))
+        ad_slots.add("{}x{}".format(width, height))
+        record_data.update({
+            "ad_slots": list(ad_slots),
+            "total_cpm": round(record_data.get("total_cpm", 0) + bidfloor, 4),
+            "bids_count": record_data.get("bids_count", 0) + 1
+        })
+        records[record_key] = record_data
+    return records
+
+
+def accumulate_slotted(bids):
+    records = BidAccumulator()
+    for bid in bids:
+        records.add(*bid)
+    return records
+
+
+def measure(accumulate, bids):
+    tracemalloc.start()
+    start = time.perf_counter()
+    records = accumulate(bids)
+    elapsed = time.perf_counter() - start
+    memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    # throughput without tracemalloc overhead
+    start = time.perf_counter()
+    accumulate(bids)
+    return records, time.perf_counter() - start, memory
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--bids', type=int, default=1000000)
+    parser.add_argument('--domains', type=int, default=20000)
+    parser.add_argument('--days', type=int, default=1)
+    args = parser.parse_args()
+
+    bids = get_bids(args.bids, args.domains, args.days)
+    for name, accumulate in [('dicts', accumulate_dicts),
+                             ('slotted', accumulate_slotted)]:
+        records, elapsed, memory = measure(accumulate, bids)
+        print(f'{name:<8} {len(records):>8} records  {elapsed:>6.2f}s '
+              f'{args.bids / elapsed:>9.0f} bids/s  '
+              f'{memory / 2 ** 20:>7.1f} MiB')
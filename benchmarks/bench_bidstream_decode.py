@@ -0,0 +1,102 @@
+import argparse
+import json
+import os
+import sys
+import time
+from datetime import datetime
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__),
+                                                os.pardir)))
+
+from analytics import bidstream_parser
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir))
+
+
+# log events of the bid requests in test1.json repeated up to count, with
+# one LambdaContext dump like t.json every lambda_every events
+def get_bid_events(count, lambda_every):
+    with open(os.path.join(ROOT, 'test1.json')) as f:
+        bid_requests = [json.dumps(_) for _ in json.load(f)['data']]
+    with open(os.path.join(ROOT, 't.json')) as f:
+        lambda_message = f.read()
+    ingestion_time = int(datetime(2021, 12, 18).timestamp() * 1000)
+    return [{
+        'ingestionTime': ingestion_time + i,
+        'message': lambda_message if lambda_every and i % lambda_every == 0
+        else bid_requests[i % len(bid_requests)]
+    } for i in range(count)]
+
+
+# previous parsing: every message fully decoded with json.loads
+def parse_full_decode(data):
+    partial_records = {}
+    for record in data:
+        try:
+            message = json.loads(record.get("message"))
+        except json.JSONDecodeError:
+            continue
+        imp = message.get("imp")
+        if not (imp and isinstance(imp, list)):
+            continue
+        domain = message["site"].get("domain")
+        geo = message["device"]["geo"].get("country")
+        timestamp = record.get("ingestionTime")
+        ingested_on = str(datetime.fromtimestamp(timestamp / 1000)).split(" ")[0]
+        record_data = partial_records.setdefault(
+            f"{ingested_on}|{domain}|{geo}",
+            {"ad_slots": set(), "total_cpm": 0, "bids_count": 0})
+        banner = imp[0].get("banner")
+        record_data["ad_slots"].add("{}x{}".format(banner.get("w", 0), banner.get("h", 0)))
+        record_data["total_cpm"] = round(record_data["total_cpm"] + imp[0].get("bidfloor", 0), 4)
+        record_data["bids_count"] += 1
+    return partial_records
+
+
+# documents of partial records of either parser, to compare them
+def get_documents(partial_records):
+    if not isinstance(partial_records, dict):
+        partial_records = {'|'.join(key): document for key, document
+                           in partial_records.get_documents().items()}
+    return {key: (sorted(document['ad_slots']), round(document['total_cpm'], 4),
+                  document['bids_count'])
+            for key, document in partial_records.items()}
+
+
+def measure(parse, pages):
+    start = time.perf_counter()
+    result = [parse(page) for page in pages]
+    return time.perf_counter() - start, [get_documents(_) for _ in result]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--records', type=int, default=100000)
+    parser.add_argument('--page-size', type=int, default=10000)
+    parser.add_argument('--lambda-every', type=int, default=10,
+                        help='One LambdaContext message every n records, 0 for none')
+    args = parser.parse_args()
+
+    events = get_bid_events(args.records, args.lambda_every)
+    pages = [events[i:i + args.page_size]
+             for i in range(0, len(events), args.page_size)]
+
+    baseline, expected = measure(parse_full_decode, pages)
+    print(f'{"json.loads full decode":<24} {baseline:>7.2f}s '
+          f'{args.records / baseline:>9.0f} records/s')
+
+    simdjson, orjson = bidstream_parser.simdjson, bidstream_parser.orjson
+    # installed backends, each with the faster ones disabled
+    backends = [('json', None, None)]
+    if orjson is not None:
+        backends.insert(0, ('orjson', None, orjson))
+    if simdjson is not None:
+        backends.insert(0, ('simdjson selective', simdjson, orjson))
+    for name, simdjson_backend, orjson_backend in backends:
+        bidstream_parser.simdjson, bidstream_parser.orjson = simdjson_backend, orjson_backend
+        elapsed, result = measure(bidstream_parser.parse_bidstream_page, pages)
+        assert result == expected, name
+        print(f'{name:<24} {elapsed:>7.2f}s '
+              f'{args.records / elapsed:>9.0f} records/s  '
+              f'{baseline / elapsed:>5.2f}x')
+    bidstream_parser.simdjson, bidstream_parser.orjson = simdjson, orjson
@@ -0,0 +1,66 @@
+import argparse
+import os
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__),
+                                                os.pardir)))
+
+import analytics
+from analytics import cloudwatch
+
+
+# filter_log_events over generated page crawled events, latency seconds per
+# call like a remote api
+class LatencyLogsClient:
+    def __init__(self, date, count, latency):
+        start = cloudwatch.get_timestamp_milliseconds(date)
+        self.events = [{
+            'timestamp': start + i * 86399000 // count,
+            'message': '%s INFO:default:PAGE_CRAWLED: url '
+                       'https://www.example%d.com/%d took %d.5 ms and %d bytes' %
+                       (date.strftime('%Y-%m-%d 12:00:00'), i % 50, i, i % 3000,
+                        i)
+        } for i in range(count)]
+        self.latency = latency
+
+    def filter_log_events(self, startTime, endTime, limit, nextToken=None,
+                          **kwargs):
+        time.sleep(self.latency)
+        events = [_ for _ in self.events
+                  if startTime <= _['timestamp'] <= endTime]
+        offset = int(nextToken or 0)
+        response = {'events': events[offset:offset + limit]}
+        if offset + limit < len(events):
+            response['nextToken'] = str(offset + limit)
+        return response
+
+
+def run(aws_client, cache):
+    started_at = time.perf_counter()
+    logs = analytics.get_cloudwatch_logs(
+        cloudwatch.ThrottledLogsClient(aws_client, rate=1000, burst=1000),
+        'group', '2021-03-12', {"combined": analytics.COMBINED_FILTER_PATTERN},
+        cache=cache)
+    accumulator, _ = analytics.get_routed_logs_summary(logs["combined_lines"])
+    return len(accumulator), time.perf_counter() - started_at
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--events', type=int, default=200000)
+    parser.add_argument('--latency', type=float, default=0.2)
+    args = parser.parse_args()
+
+    aws_client = LatencyLogsClient(datetime(2021, 3, 12), args.events,
+                                   args.latency)
+    with tempfile.TemporaryDirectory() as directory:
+        cache = cloudwatch.LogPageCache(directory)
+        pages, fetch_elapsed = run(aws_client, cache)
+        replayed_pages, replay_elapsed = run(aws_client, cache)
+        assert replayed_pages == pages
+        print(f'fetch  {fetch_elapsed:>8.2f}s')
+        print(f'replay {replay_elapsed:>8.2f}s  '
+              f'{fetch_elapsed / replay_elapsed:.2f}x')
@@ -0,0 +1,59 @@
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__),
+                                                os.pardir)))
+
+import analytics
+from analytics import utils
+from benchmarks.bench_parallel_parse import write_logs
+
+
+def parse(info_path):
+    page_crawled_attributes, _ = analytics.get_info_and_frequency_logs_summary(
+        info_path)
+    return len(page_crawled_attributes)
+
+
+# previous workflow: decompress to disk first, then parse the plain file
+def decompress_then_parse(compressed_path, directory):
+    plain_path = os.path.join(directory, 'decompressed.log')
+    with utils.CompressedFileOpener[os.path.splitext(compressed_path)[1]](
+            compressed_path) as source, open(plain_path, 'wb') as target:
+        shutil.copyfileobj(source, target, utils.READ_BLOCK_SIZE)
+    try:
+        return parse(plain_path)
+    finally:
+        os.remove(plain_path)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--lines', type=int, default=1000000)
+    parser.add_argument('--formats', nargs='+', default=['.gz', '.bz2', '.xz'])
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        info_path, _ = write_logs(directory, args.lines)
+        for extension in args.formats:
+            compressed_path = info_path + extension
+            with open(info_path, 'rb') as source, \
+                    utils.CompressedFileOpener[extension](compressed_path,
+                                                          'wb') as target:
+                shutil.copyfileobj(source, target, utils.READ_BLOCK_SIZE)
+
+            start = time.perf_counter()
+            decompress_then_parse(compressed_path, directory)
+            two_step_elapsed = time.perf_counter() - start
+
+            start = time.perf_counter()
+            parse(compressed_path)
+            streaming_elapsed = time.perf_counter() - start
+
+            print(f'{extension:<5} decompress then parse {two_step_elapsed:>7.2f}s'
+                  f'  streaming {streaming_elapsed:>7.2f}s'
+                  f'  {two_step_elapsed / streaming_elapsed:>5.2f}x')
@@ -0,0 +1,57 @@
+import argparse
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__),
+                                                os.pardir)))
+
+import analytics
+from analytics import models
+
+
+def build_lines(count):
+    return [
+        '2021-03-12 %02d:%02d:%02d INFO:default:PAGE_CRAWLED: url '
+        'https://www.example%d.com/%d took %d.5 ms and %d bytes\n' %
+        (i // 3600 % 24, i // 60 % 60, i % 60, i % 50, i % 100000, i % 3000, i)
+        for i in range(count)
+    ]
+
+
+# previous representation: one log item tuple per parsed line
+def store_log_items(lines):
+    return analytics.get_info_logs_summary(info_lines=lines)
+
+
+def store_batches(lines):
+    return list(analytics._get_page_crawled_batches(lines))
+
+
+def run_benchmark(name, store_function, lines):
+    tracemalloc.start()
+    start = time.perf_counter()
+    stored = store_function(lines)
+    elapsed = time.perf_counter() - start
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f'{name:<10} {size / len(lines):>8.1f} bytes/event '
+          f'{len(lines) / elapsed:>12,.0f} lines/sec')
+    return stored
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--lines', type=int, default=1000000)
+    args = parser.parse_args()
+
+    lines = build_lines(args.lines)
+    log_items = run_benchmark('log items', store_log_items, lines)
+    batches = run_benchmark('columnar', store_batches, lines)
+    assert len(log_items) == sum(map(len, batches))
+
+    accumulator = models.PageAccumulator(epoch_timestamps=True)
+    assert analytics.get_accumulated_page_items(
+        accumulator.update_batches(batches)) == analytics.get_page_items(
+            log_items)
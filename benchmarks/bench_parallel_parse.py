@@ -0,0 +1,71 @@
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__),
+                                                os.pardir)))
+
+import analytics
+
+
+def write_logs(directory, count):
+    info_path = os.path.join(directory, 'info.log')
+    error_path = os.path.join(directory, 'error.log')
+    with open(info_path, 'w') as info_fp, open(error_path, 'w') as error_fp:
+        for i in range(count):
+            timestamp = '2021-03-12 %02d:%02d:%02d' % (i // 3600 % 24,
+                                                       i // 60 % 60, i % 60)
+            info_fp.write(
+                '%s INFO:default:PAGE_CRAWLED: url https://www.example%d.com/%d '
+                'took %d.5 ms and %d bytes\n' % (timestamp, i % 50, i % 100000,
+                                                 i % 3000, i))
+            if i % 100 == 0:
+                info_fp.write(
+                    '%s INFO:scrapy.extensions.logstats:Crawled %d pages '
+                    '(at 60 pages/min), scraped 0 items (at 0 items/min)\n' %
+                    (timestamp, i))
+            if i % 20 == 0:
+                error_fp.write(
+                    '%s ERROR:default:PAGE_CRAWL_ERROR: HttpError on '
+                    'https://www.example%d.com/%d\n' % (timestamp, i % 50, i))
+    return info_path, error_path
+
+
+def run_serial(info_path, error_path):
+    accumulator = analytics.PageAccumulator(epoch_timestamps=True)
+    accumulator.update_batches(analytics._get_page_crawled_batches(
+        analytics.read_lines_from_file(info_path), {}))
+    accumulator.update_batches(analytics._get_page_crawl_error_batches(
+        analytics.read_lines_from_file(error_path)))
+    return analytics.get_accumulated_page_items(accumulator)
+
+
+def run_parallel(info_path, error_path, workers):
+    accumulator, _ = analytics.get_logs_summary_in_parallel(
+        info_path, error_path, workers)
+    return analytics.get_accumulated_page_items(accumulator)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--lines', type=int, default=2000000)
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4])
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        info_path, error_path = write_logs(directory, args.lines)
+
+        start = time.perf_counter()
+        serial_pages = run_serial(info_path, error_path)
+        serial_elapsed = time.perf_counter() - start
+        print(f'{"serial":<12} {args.lines / serial_elapsed:>12,.0f} lines/sec')
+
+        for workers in args.workers:
+            start = time.perf_counter()
+            pages = run_parallel(info_path, error_path, workers)
+            elapsed = time.perf_counter() - start
+            assert pages == serial_pages
+            print(f'{workers:>2} workers   {args.lines / elapsed:>12,.0f} '
+                  f'lines/sec {serial_elapsed / elapsed:>6.2f}x')
@@ -0,0 +1,69 @@
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__),
+                                                os.pardir)))
+
+import analytics
+from analytics import utils
+
+SAMPLE_LINES = [
+    '2021-03-12 15:49:48 INFO:default:PAGE_CRAWLED: url https://www.example.com/%d '
+    'took 1351.7420291900635 ms and 34073 bytes\n',
+    '2021-03-12 15:50:05 ERROR:default:PAGE_CRAWL_ERROR: HttpError/Ignoring non-200 '
+    'response on https://www.example.com/%d\n',
+    '2021-03-12 15:49:46 INFO:scrapy.extensions.logstats:Crawled %d pages '
+    '(at 7 pages/min), scraped 0 items (at 0 items/min)\n',
+    '2021-03-12 15:49:46 DEBUG:scrapy.core.engine:Crawled (200) '
+    '<GET https://www.example.com/%d> (referer: None)\n',
+]
+
+
+def build_lines(count):
+    return [SAMPLE_LINES[i % len(SAMPLE_LINES)] % i for i in range(count)]
+
+
+# previous path: classify with is_* then extract again with findall
+def parse_old(lines):
+    parsed = 0
+    for line in lines:
+        if utils.is_page_crawled_log_line(line):
+            analytics.get_page_crawled_attributes(line)
+            parsed += 1
+        elif utils.is_page_crawl_error_log_line(line):
+            analytics.get_page_crawl_error_attributes(line)
+            parsed += 1
+        elif utils.is_log_stats_log_line(line):
+            analytics.get_crawler_frequency(line)
+            parsed += 1
+    return parsed
+
+
+def parse_fused(lines):
+    parsed = 0
+    for line in lines:
+        line_type, _ = analytics.parse_log_line(line)
+        if line_type:
+            parsed += 1
+    return parsed
+
+
+def run_benchmark(name, parse_function, lines):
+    start = time.perf_counter()
+    parsed = parse_function(lines)
+    elapsed = time.perf_counter() - start
+    print(f'{name:<8} {parsed:>10} parsed {len(lines) / elapsed:>14,.0f} lines/sec')
+    return elapsed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--lines', type=int, default=500000)
+    args = parser.parse_args()
+
+    lines = build_lines(args.lines)
+    old_elapsed = run_benchmark('old', parse_old, lines)
+    fused_elapsed = run_benchmark('fused', parse_fused, lines)
+    print(f'speedup  {old_elapsed / fused_elapsed:.2f}x')
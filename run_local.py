@@ -1,10 +1,70 @@
 import os
+import sys
+import time
 import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime, timedelta
-from analytics import start_process
+from analytics import start_process, start_incremental_process
+from analytics.utils import DATE_FORMAT
 from dotenv import load_dotenv
 
 
+# process a single day, returns its row for the summary table
+def process_date(date_string, logs_path, parse_workers=None,
+                 incremental=False):
+    started_at = time.perf_counter()
+    try:
+        if incremental:
+            start_incremental_process(date_string=date_string,
+                                      logs_path=logs_path)
+        else:
+            start_process(mode="local", date_string=date_string,
+                          logs_path=logs_path, parse_workers=parse_workers)
+        status = "ok"
+    except Exception as e:
+        status = f"failed: {e}"
+    return date_string, status, time.perf_counter() - started_at
+
+
+def get_date_strings(date_string=None, start_date=None, end_date=None,
+                     dates=None):
+    if dates:
+        return dates
+    if not start_date:
+        return [date_string]
+    start = datetime.strptime(start_date, DATE_FORMAT)
+    end = datetime.strptime(end_date or start_date, DATE_FORMAT)
+    if end < start:
+        raise ValueError('end date should not be before start date')
+    return [(start + timedelta(days=day)).strftime(DATE_FORMAT)
+            for day in range((end - start).days + 1)]
+
+
+def process_dates(date_strings, logs_path, workers=1, parse_workers=None,
+                  incremental=False):
+    if workers <= 1:
+        return [process_date(date_string, logs_path, parse_workers,
+                             incremental)
+                for date_string in date_strings]
+    # spawned workers import analytics, and connect to mongo, once each
+    # instead of once per day
+    with ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=multiprocessing.get_context("spawn")) as executor:
+        return list(executor.map(process_date, date_strings,
+                                 [logs_path] * len(date_strings),
+                                 [parse_workers] * len(date_strings),
+                                 [incremental] * len(date_strings)))
+
+
+def print_summary(results, elapsed):
+    print(f"{'date':<12} {'seconds':>9}  status")
+    for date_string, status, seconds in results:
+        print(f"{date_string:<12} {seconds:>9.2f}  {status}")
+    print(f"{len(results)} days processed in {elapsed:.2f} seconds")
+
+
 def run():
 
     target_date = datetime.now() - timedelta(days=1)
@@ -16,14 +76,50 @@ def run():
                         help='Date to query',
                         default=target_date.strftime('%Y-%m-%d'),
                         required=False)
+    parser.add_argument('--start-date',
+                        dest='start_date',
+                        help='First date of the range to backfill',
+                        required=False)
+    parser.add_argument('--end-date',
+                        dest='end_date',
+                        help='Last date of the range to backfill, inclusive',
+                        required=False)
+    parser.add_argument('--dates',
+                        dest='dates',
+                        nargs='+',
+                        help='Dates to backfill',
+                        required=False)
+    parser.add_argument('--workers',
+                        dest='workers',
+                        type=int,
+                        help='Days processed in parallel',
+                        default=1,
+                        required=False)
+    parser.add_argument('--parse-workers',
+                        dest='parse_workers',
+                        type=int,
+                        help='Processes parsing byte ranges of each log file',
+                        required=False)
+    parser.add_argument('--incremental',
+                        dest='incremental',
+                        action='store_true',
+                        help='Only ingest log lines appended since the last run')
     parser.add_argument('--logs-path',
                         dest='logs_path',
                         help='Logs path',
                         default=logs_path,
                         required=True)
 
-    args = vars(parser.parse_args())
-    start_process(mode="local", **args)
+    args = parser.parse_args()
+    date_strings = get_date_strings(args.date_string, args.start_date,
+                                    args.end_date, args.dates)
+
+    started_at = time.perf_counter()
+    results = process_dates(date_strings, args.logs_path, args.workers,
+                            args.parse_workers, args.incremental)
+    print_summary(results, time.perf_counter() - started_at)
+    if any(status != "ok" for _, status, _ in results):
+        sys.exit(1)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,17 @@
+import mongomock
+import pymongo
+import pytest
+
+# the analytics modules connect to mongo when they are imported, tests
+# never reach a real server whatever BUILD_ENV or the local setup is
+pymongo.MongoClient = mongomock.MongoClient
+
+
+# empty in memory databases with the collections indexes set up
+@pytest.fixture
+def mongo(monkeypatch):
+    from analytics import db
+    monkeypatch.setattr(db, '_m_client', mongomock.MongoClient())
+    monkeypatch.setattr(db, 're_m_client', mongomock.MongoClient())
+    db._setup_db()
+    return db
@@ -1,9 +1,10 @@
 import os
 from statistics import StatisticsError
 
+import mongomock
 import pytest
 import analytics
-from analytics import models
+from analytics import models, sketch, utils
 from datetime import datetime as dt, datetime
 
 SAMPLES_PATH = os.path.abspath(
@@ -222,9 +223,288 @@ def test_get_overview_item():
         'non_compliance_reasons_count': [{
             'reason': 'HttpError',
             'count': 1
-        }]
+        }],
+        'urls_hll': sketch.HyperLogLog().update(
+            [_.url for _ in page_items]).to_document()
     }
 
-    assert analytics.get_overview_item(domain_items, page_items,
-                                       crawler_frequencies,
-                                       date) == expected_overview_item
+    overview_item = analytics.get_overview_item(domain_items, page_items,
+                                                crawler_frequencies, date)
+    assert overview_item == expected_overview_item
+    assert len(sketch.HyperLogLog.from_document(overview_item['urls_hll'])) == 5
+
+
+def test_parse_log_line():
+    page_crawled = '2021-03-12 15:49:48 INFO:default:PAGE_CRAWLED: ' \
+                   'url https://www.example.com/test took 1351.7420291900635 ms and 34073 bytes'
+    assert analytics.parse_log_line(page_crawled) == (
+        utils.LogLineType.PAGE_CRAWLED,
+        analytics.get_page_crawled_attributes(page_crawled))
+    page_crawl_error = '2021-03-12 15:50:05 ERROR:default:PAGE_CRAWL_ERROR: ' \
+                       'HttpError/Ignoring non-200 response on https://www.example.com/test'
+    assert analytics.parse_log_line(page_crawl_error) == (
+        utils.LogLineType.PAGE_CRAWL_ERROR,
+        (dt(2021, 3, 12, 15, 50, 5), 'HttpError/Ignoring non-200 response',
+         'https://www.example.com/test'))
+    log_stats = '2021-03-12 15:49:46 INFO:scrapy.extensions.logstats:' \
+                'Crawled 10 pages (at 7 pages/min), scraped 0 items (at 0 items/min)'
+    assert analytics.parse_log_line(log_stats) == (
+        utils.LogLineType.CRAWLER_FREQUENCY, 7)
+    recommendation = 'app 2021-03-12 15:49:46,123 [INFO] recommendation_engine ' \
+                     'top1: 0.5 top10: 0.25 top50: 0.125'
+    assert analytics.parse_log_line(recommendation) == (
+        utils.LogLineType.RECOMMENDATION_ENGINE,
+        (dt(2021, 3, 12, 15, 49, 46), 0.5, 0.25, 0.125))
+    assert analytics.parse_log_line('') == (None, None)
+    assert analytics.parse_log_line(
+        '2021-03-12 15:49:48 INFO:default:PAGE_CRAWLED: url took 1 ms') == (None, None)
+
+
+def test_get_info_and_frequency_logs_summary(tmp_path):
+    info_log = tmp_path / 'info.log.2021-03-12'
+    info_log.write_text(
+        '2021-03-12 15:49:46 INFO:scrapy.extensions.logstats:'
+        'Crawled 10 pages (at 7 pages/min), scraped 0 items (at 0 items/min)\n'
+        '2021-03-12 15:49:48 INFO:default:PAGE_CRAWLED: '
+        'url https://www.example.com/test took 600.5 ms and 500 bytes\n'
+        '2021-03-12 15:50:01 INFO:default:PAGE_CRAWLED: '
+        'url https://www.example.com/test2 took 400.5 ms and 300 bytes\n'
+        'Traceback line without minute\n'
+        '2021-03-12 15:51:46 INFO:scrapy.extensions.logstats:'
+        'Crawled 30 pages (at 20 pages/min), scraped 0 items (at 0 items/min)\n'
+        '2021-03-12 15:51:50 INFO:scrapy.extensions.logstats:'
+        'Crawled 31 pages (at 1 pages/min), scraped 0 items (at 0 items/min)\n')
+
+    page_crawled_attributes, crawler_frequencies = \
+        analytics.get_info_and_frequency_logs_summary(str(info_log))
+    assert page_crawled_attributes == analytics.get_info_logs_summary(str(info_log))
+    assert crawler_frequencies == analytics.get_frequency_logs_summary(str(info_log))
+    assert crawler_frequencies == [7, 0, 21, 0]
+    assert [_.url for _ in page_crawled_attributes] == [
+        'https://www.example.com/test', 'https://www.example.com/test2'
+    ]
+
+
+def test_get_logs_summary_in_parallel(tmp_path):
+    info_log, error_log = tmp_path / 'info.log', tmp_path / 'error.log'
+    info_lines, error_lines = [], []
+    for i in range(400):
+        timestamp = '2021-03-12 15:%02d:%02d' % (i // 60, i % 60)
+        info_lines.append('%s INFO:default:PAGE_CRAWLED: url https://www.example%d.com/%d '
+                          'took %d.5 ms and %d bytes\n' % (timestamp, i // 4 % 3, i // 4, i, i))
+        if i % 10 == 0:
+            info_lines.append('%s INFO:scrapy.extensions.logstats:Crawled %d pages '
+                              '(at %d pages/min), scraped 0 items (at 0 items/min)\n'
+                              % (timestamp, i, i % 13))
+        if i % 25 == 0:
+            error_lines.append('%s ERROR:default:PAGE_CRAWL_ERROR: HttpError on '
+                               'https://www.example%d.com/error/%d\n' % (timestamp, i % 3, i))
+    info_log.write_text(''.join(info_lines))
+    error_log.write_text(''.join(error_lines))
+
+    accumulator, crawler_frequencies = analytics.get_logs_summary_in_parallel(
+        str(info_log), str(error_log), workers=2)
+    page_crawled_attributes, serial_frequencies = \
+        analytics.get_info_and_frequency_logs_summary(str(info_log))
+    page_items = analytics.get_page_items(
+        page_crawled_attributes + analytics.get_error_logs_summary(str(error_log)))
+    assert crawler_frequencies == serial_frequencies
+    assert analytics.get_accumulated_page_items(accumulator) == page_items
+    with pytest.raises(ValueError):
+        analytics.get_accumulated_page_items([])
+
+
+def test_merge_domain_documents():
+    date = datetime(2018, 1, 1)
+    first_run = [
+        models.PageItem('https://www.example.com/test', 2, 'www.example.com',
+                        600.0, 500, dt(2018, 1, 1, 1), dt(2018, 1, 1, 2), True, None),
+        models.PageItem('https://www.sample.com/test', 1, 'www.sample.com',
+                        0.0, 0, dt(2018, 1, 1, 1), dt(2018, 1, 1, 1), False, 'HttpError')
+    ]
+    second_run = [
+        models.PageItem('https://www.example.com/test2', 3, 'www.example.com',
+                        500.0, 500, dt(2018, 1, 1, 3), dt(2018, 1, 1, 4), True, None),
+        models.PageItem('https://www.sample.com/test', 1, 'www.sample.com',
+                        400.0, 300, dt(2018, 1, 1, 3), dt(2018, 1, 1, 3), True, None)
+    ]
+    changed, domain_documents = analytics.merge_domain_documents([], first_run, {}, date)
+    assert changed == domain_documents
+    previous_pages = {'https://www.sample.com/test': {
+        'page_load_speed': 0.0, 'page_size': 0, 'compliant': False,
+        'non_compliance_reason': 'HttpError', 'last_crawled_at': dt(2018, 1, 1, 1)
+    }}
+    changed, domain_documents = analytics.merge_domain_documents(
+        domain_documents, second_run, previous_pages, date)
+
+    pages = [first_run[0], second_run[0], second_run[1]]
+    expected = analytics.get_domain_items(pages, date)
+    expected[1] = models.DomainItem(*expected[1][:3], 2, *expected[1][4:])
+    assert [{k: v for k, v in _.items()
+             if k not in ('total_page_load_speed', 'page_load_speed_sketch')}
+            for _ in changed] == [_.to_dict() for _ in expected]
+    # the replaced crawl of www.sample.com/test is taken out of the sketch
+    sketches = analytics.get_page_load_speed_sketches(pages)
+    assert [_['page_load_speed_sketch'] for _ in changed] == [
+        sketches[_.domain].to_document() for _ in expected]
+
+
+def test_get_page_items_unordered():
+    page_items = analytics.get_page_items([
+        models.LogItem('url1', '2018-01-02', 600, 500, None),
+        models.LogItem('url2', '2018-01-01', 700, 300, None),
+        models.LogItem('url1', '2018-01-01', 500, 400, None),
+        models.ErrorItem('url2', '2018-01-03', 'HttpError'),
+        models.LogItem('url1', '2018-01-03', 550, 450, None),
+        models.LogItem('url2', '2018-01-02', 800, 200, None)
+    ])
+    assert page_items == [
+        models.PageItem('url1', 3, '', 550.0, 450, '2018-01-01', '2018-01-03',
+                        True, None),
+        models.PageItem('url2', 3, '', 0.0, 0, '2018-01-01', '2018-01-03',
+                        False, 'HttpError')
+    ]
+
+
+def test_page_accumulator_batches():
+    first_batch, second_batch = models.LogEventBatch(), models.LogEventBatch()
+    first_batch.append('url1', 86400, 600.5, 500)
+    first_batch.append('url2', 3600, 700.0, 300)
+    first_batch.append('url1', 0, 500.0, 400)
+    second_batch.append('url2', 7200, 0, 0, 'HttpError')
+    second_batch.append('url1', 86400, 550.0, 450)
+    assert len(first_batch) == 3 and first_batch.urls.values == ['url1', 'url2']
+
+    accumulator = models.PageAccumulator(epoch_timestamps=True)
+    accumulator.update_batches([first_batch])
+    accumulator.merge(
+        models.PageAccumulator(epoch_timestamps=True).add_batch(second_batch))
+    assert analytics.get_accumulated_page_items(accumulator) == [
+        models.PageItem('url1', 3, '', 600.5, 500, dt(1970, 1, 1),
+                        dt(1970, 1, 2), True, None),
+        models.PageItem('url2', 2, '', 0.0, 0, dt(1970, 1, 1, 1),
+                        dt(1970, 1, 1, 2), False, 'HttpError')
+    ]
+    with pytest.raises(ValueError):
+        accumulator.add(models.InfoItem('url1', dt(1970, 1, 1), 500.0, 400))
+    with pytest.raises(ValueError):
+        models.PageAccumulator().add_batch(first_batch)
+
+
+def test_get_domain_items_vectorized(monkeypatch):
+    pytest.importorskip('numpy')
+    date = datetime(2018, 1, 1)
+    page_items = [
+        models.PageItem('https://b.com/%d' % i, i % 3 + 1, 'b.com' if i % 2 else 'a.com',
+                        0.1 * i + 450, i * 100, None, None, i % 5 != 0,
+                        None if i % 5 else ('HttpError' if i % 3 else 'Timeout'))
+        for i in range(50)
+    ]
+    domain_items = analytics.get_domain_items(page_items, date)
+    overview_item = analytics.get_overview_item(domain_items, page_items, [1], date)
+    monkeypatch.setattr(analytics, 'numpy', None)
+    # float64 means match statistics.mean up to rounding
+    expected = analytics.get_domain_items(page_items, date)
+    assert [_[4] for _ in domain_items] == pytest.approx([_[4] for _ in expected], rel=1e-12)
+    assert [_[:4] + _[5:] for _ in domain_items] == [_[:4] + _[5:] for _ in expected]
+    assert overview_item == analytics.get_overview_item(domain_items, page_items,
+                                                        [1], date)
+    assert [_.domain for _ in domain_items] == ['a.com', 'b.com']
+    assert domain_items[0].non_compliance_reasons == [
+        {"reason": "HttpError", "count": 3}, {"reason": "Timeout", "count": 2}]
+
+
+def test_start_incremental_process_resumes_after_crash(tmp_path, monkeypatch, mongo):
+    info_log = tmp_path / 'info.log.2021-03-12'
+    error_log = tmp_path / 'error.log.2021-03-12'
+
+    def append_logs(start, stop):
+        info_lines, error_lines = [], []
+        for i in range(start, stop):
+            timestamp = '2021-03-12 15:%02d:%02d' % (i // 60, i % 60)
+            info_lines.append('%s INFO:default:PAGE_CRAWLED: url https://www.example%d.com/%d '
+                              'took %d.5 ms and %d bytes\n' % (timestamp, i % 3, i % 40, i, i))
+            if i % 10 == 0:
+                info_lines.append('%s INFO:scrapy.extensions.logstats:Crawled %d pages '
+                                  '(at %d pages/min), scraped 0 items (at 0 items/min)\n'
+                                  % (timestamp, i, i % 13))
+            if i % 25 == 0:
+                error_lines.append('%s ERROR:default:PAGE_CRAWL_ERROR: HttpError on '
+                                   'https://www.example%d.com/%d\n' % (timestamp, i % 3, i % 40))
+        with open(info_log, 'a') as info_fp, open(error_log, 'a') as error_fp:
+            info_fp.write(''.join(info_lines))
+            error_fp.write(''.join(error_lines))
+
+    def run():
+        analytics.start_incremental_process('2021-03-12', str(tmp_path))
+
+    def get_state():
+        database = mongo._m_client[mongo.DATABASE]
+        ignored = ('_id', 'ingest_run', 'ingest_runs')
+        return {name: sorted((
+            {key: value for key, value in document.items() if key not in ignored}
+            for document in database[name].find()), key=repr)
+            for name in (mongo.CRAWLED_PAGES, mongo.CRAWLED_DOMAINS, mongo.OVERVIEW)}
+
+    def crash_after(name):
+        write = getattr(mongo, name)
+
+        def crash(*args, **kwargs):
+            write(*args, **kwargs)
+            raise RuntimeError('crashed')
+        return crash
+
+    def run_days(crash_at=None):
+        for path in (info_log, error_log):
+            if path.exists():
+                path.unlink()
+        monkeypatch.setattr(mongo, '_m_client', mongomock.MongoClient())
+        mongo._setup_db()
+        append_logs(0, 150)
+        run()
+        append_logs(150, 300)
+        if crash_at:
+            with monkeypatch.context() as patched:
+                patched.setattr(mongo, crash_at, crash_after(crash_at))
+                with pytest.raises(RuntimeError):
+                    run()
+            # lines appended after the crash are left to the next run
+            append_logs(300, 320)
+            run()
+        else:
+            run()
+            append_logs(300, 320)
+        run()
+        return get_state()
+
+    expected = run_days()
+    assert expected[mongo.OVERVIEW][0]['page_count'] == 120
+    for crash_at in ('replace_domain_documents', 'replace_overview_document',
+                     'create_or_update_pages_documents'):
+        assert run_days(crash_at) == expected, crash_at
+    urls = [_['url'] for _ in expected[mongo.CRAWLED_PAGES]]
+    pages = mongo.get_pages_crawled_between(urls, dt(2021, 3, 12), dt(2021, 3, 13))
+    monkeypatch.setattr(mongo, 'URLS_QUERY_CHUNK', 7)
+    chunked_pages = mongo.get_pages_crawled_between(urls, dt(2021, 3, 12), dt(2021, 3, 13))
+    assert sorted(chunked_pages, key=repr) == sorted(pages, key=repr)
+    assert len(pages) == 120
+
+
+def test_start_incremental_process_batches(tmp_path, monkeypatch, mongo):
+    (tmp_path / 'info.log.2021-03-12').write_text(''.join(
+        '2021-03-12 15:%02d:%02d INFO:default:PAGE_CRAWLED: url https://www.example.com/%d '
+        'took 10.5 ms and 100 bytes\n' % (i // 60, i % 60, i) for i in range(100)))
+    (tmp_path / 'error.log.2021-03-12').write_text('')
+    monkeypatch.setattr(analytics, 'LOG_EVENT_BATCH_SIZE', 16)
+    batch_sizes = []
+    add_batch = models.PageAccumulator.add_batch
+
+    def record_batch(self, batch):
+        batch_sizes.append(len(batch))
+        return add_batch(self, batch)
+
+    monkeypatch.setattr(models.PageAccumulator, 'add_batch', record_batch)
+    analytics.start_incremental_process('2021-03-12', str(tmp_path))
+    assert max(batch_sizes) == 16 and sum(batch_sizes) == 100
+    assert mongo.get_log_checkpoint(dt(2021, 3, 12), utils.LogLevel.INFO)[
+        'minute_key'] == '2021-03-12 15:01'
@@ -0,0 +1,349 @@
+import asyncio
+import json
+import multiprocessing
+import os
+import pickle
+import time
+from types import SimpleNamespace
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import pytest
+
+from analytics import bidstream, bidstream_parser, cloudwatch, db, sketch
+from analytics.models import BidAccumulator
+from datetime import datetime as dt, timedelta
+from tests.test_cloudwatch import StubLogsClient
+
+ROOT = os.path.join(os.path.dirname(__file__), os.pardir)
+
+
+def get_bid_events(date, count):
+    start = cloudwatch.get_timestamp_milliseconds(date)
+    return [{
+        'timestamp': start + i,
+        'ingestionTime': start + i,
+        'logStreamName': 'bidder',
+        'message': json.dumps({
+            'imp': [{'banner': {'w': 300, 'h': 250}, 'bidfloor': 0.5}],
+            'site': {'domain': 'example%d.com' % (i % 2)},
+            'device': {'geo': {'country': 'USA'}}
+        })
+    } for i in range(count)]
+
+
+def fetch_pages(client, queue_pages=2):
+    async def fetch():
+        queue = asyncio.Queue(maxsize=queue_pages)
+        pages = []
+
+        async def consume():
+            while True:
+                pages.append(await queue.get())
+                queue.task_done()
+
+        consumer = asyncio.create_task(consume())
+        records_count = await bidstream.fetch_bidstream(
+            cloudwatch.ThrottledLogsClient(client, rate=1000, burst=1000), 'group',
+            '2021-03-12', queue)
+        await queue.join()
+        consumer.cancel()
+        return records_count, pages
+
+    return asyncio.run(fetch())
+
+
+def test_fetch_bidstream(monkeypatch):
+    client = StubLogsClient(get_bid_events(dt(2021, 3, 12), 250), page_size=3,
+                            latency=0)
+    records_count, pages = fetch_pages(client)
+    assert records_count == 250
+    assert sorted(event['timestamp'] for page in pages for event in page) == \
+        sorted(event['timestamp'] for event in client.events)
+
+    monkeypatch.setenv('BIDSTREAM_PAGE_BUDGET', '5')
+    records_count, pages = fetch_pages(client)
+    assert len(pages) == 5 and records_count == 15
+
+    # stopping at the budget waits for the fetches in progress off the loop
+    client.latency = 0.5
+    monkeypatch.setenv('BIDSTREAM_PAGE_BUDGET', '1')
+
+    async def fetch_while_ticking():
+        gaps = []
+
+        async def tick():
+            while True:
+                started_at = time.perf_counter()
+                await asyncio.sleep(0.01)
+                gaps.append(time.perf_counter() - started_at)
+
+        ticker = asyncio.create_task(tick())
+        await bidstream.fetch_bidstream(
+            cloudwatch.ThrottledLogsClient(client, rate=1000, burst=1000), 'group',
+            '2021-03-12', asyncio.Queue())
+        # the tick in progress when fetching returned
+        await asyncio.sleep(0.05)
+        ticker.cancel()
+        return max(gaps)
+
+    assert asyncio.run(fetch_while_ticking()) < 0.25
+
+
+# spawned parse workers import the parser module only, without connecting
+# to mongo or setting its indexes up
+def test_parse_bidstream_page_in_spawned_worker():
+    events = get_bid_events(dt(2021, 3, 12), 8)
+    assert bidstream.parse_bidstream_page.__module__ == 'analytics.bidstream_parser'
+    with ProcessPoolExecutor(max_workers=1,
+                             mp_context=multiprocessing.get_context('spawn')) as executor:
+        partial_records = executor.submit(bidstream.parse_bidstream_page, events).result(30)
+    assert partial_records.get_documents() == \
+        bidstream.parse_bidstream_page(events).get_documents()
+
+
+def test_parse_bidstream(monkeypatch):
+    monkeypatch.setattr(bidstream, 'records', BidAccumulator())
+
+    async def parse(pages, executor):
+        queue = asyncio.Queue()
+        for page in pages:
+            await queue.put(page)
+        consumers = [
+            asyncio.create_task(bidstream.parse_bidstream(queue, executor))
+            for _ in range(2)
+        ]
+        await queue.join()
+        for consumer in consumers:
+            consumer.cancel()
+
+    events = get_bid_events(dt(2021, 3, 12), 8)
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        asyncio.run(parse([events[:3], events[3:], [{'message': 'LambdaContext'}]],
+                          executor))
+    ingested_on = str(dt.fromtimestamp(
+        cloudwatch.get_timestamp_milliseconds(dt(2021, 3, 12)) / 1000).date())
+    bidfloor_sketch = {str(sketch.get_index(0.5)): 4}
+    assert bidstream.records.get_documents() == {
+        (ingested_on, 'example0.com', 'USA'): {
+            'ad_slots': ['300x250'], 'total_cpm': 2.0, 'bids_count': 4,
+            'bidfloor_sketch': bidfloor_sketch},
+        (ingested_on, 'example1.com', 'USA'): {
+            'ad_slots': ['300x250'], 'total_cpm': 2.0, 'bids_count': 4,
+            'bidfloor_sketch': bidfloor_sketch},
+    }
+
+
+# acknowledgement of a bulk write of documents
+def acknowledge(documents):
+    return SimpleNamespace(upserted_count=len(documents), modified_count=0)
+
+
+def test_flush_bidstream_records(monkeypatch, mongo):
+    monkeypatch.setattr(bidstream, 'records', BidAccumulator())
+    monkeypatch.setattr(bidstream, 'domain_sketches', {})
+    flushes = []
+    monkeypatch.setattr(bidstream, 'create_or_update_bidstream_records',
+                        lambda documents: flushes.append(documents) or acknowledge(documents))
+
+    async def parse(pages):
+        queue = asyncio.Queue()
+        stopped = asyncio.Event()
+        flusher = asyncio.create_task(bidstream.flush_bidstream(0.01, stopped))
+        consumer = asyncio.create_task(
+            bidstream.parse_bidstream(queue, flush_keys=2))
+        for page in pages:
+            await queue.put(page)
+            await queue.join()
+        consumer.cancel()
+        await asyncio.sleep(0.05)
+        stopped.set()
+        await flusher
+
+    events = get_bid_events(dt(2021, 3, 12), 8)
+    asyncio.run(parse([events[:1], events[1:2], events[2:3]]))
+    # a flush every two keys, the remaining key by the timer
+    assert [len(_) for _ in flushes] == [2, 1]
+    assert len(bidstream.records) == 0
+    documents = [document for flush in flushes for document in flush.values()]
+    assert sum(_['bids_count'] for _ in documents) == 3
+    assert sum(_['total_cpm'] for _ in documents) == 1.5
+
+    # both flushes add their domains to the day's sketch
+    ingested_on = str(dt.fromtimestamp(
+        cloudwatch.get_timestamp_milliseconds(dt(2021, 3, 12)) / 1000).date())
+    assert bidstream.get_distinct_domain_count(ingested_on, ingested_on) == 2
+    asyncio.run(parse([events[3:]]))
+    assert bidstream.get_distinct_domain_count(ingested_on, ingested_on) == 2
+    assert bidstream.get_distinct_domain_count('2021-03-13', '2021-03-14') == 0
+
+
+def test_flush_bidstream_records_failed_write(monkeypatch, mongo):
+    monkeypatch.setattr(bidstream, 'records', BidAccumulator())
+    monkeypatch.setattr(bidstream, 'domain_sketches', {})
+    writes = []
+
+    # the write fails once, like _bulk_update returning None
+    def write(documents):
+        writes.append(documents)
+        return acknowledge(documents) if len(writes) > 1 else None
+
+    monkeypatch.setattr(bidstream, 'create_or_update_bidstream_records', write)
+    bidstream.records.merge(bidstream.parse_bidstream_page(
+        get_bid_events(dt(2021, 3, 12), 4)))
+    expected = bidstream.records.get_documents()
+    with pytest.raises(RuntimeError):
+        asyncio.run(bidstream.flush_bidstream_records())
+    # nothing is lost, the next flush writes the records of the failed one
+    assert bidstream.records.get_documents() == expected
+    asyncio.run(bidstream.flush_bidstream_records())
+    assert writes == [expected, expected]
+    assert len(bidstream.records) == 0
+
+
+def test_process_bidstream_failed_fetch(monkeypatch, mongo):
+    monkeypatch.setattr(bidstream, 'records', BidAccumulator())
+    monkeypatch.setattr(bidstream, 'domain_sketches', {})
+    monkeypatch.setenv('BIDSTREAM_PARSE_WORKERS', '1')
+    flushes = []
+    monkeypatch.setattr(bidstream, 'create_or_update_bidstream_records',
+                        lambda documents: flushes.append(documents) or acknowledge(documents))
+    events = get_bid_events(dt(2021, 3, 12), 8)
+
+    async def fetch_bidstream(queue, **kwargs):
+        await queue.put(events)
+        await queue.join()
+        raise RuntimeError('throttled')
+
+    monkeypatch.setattr(bidstream, 'fetch_bidstream', fetch_bidstream)
+    with pytest.raises(RuntimeError, match='throttled'):
+        asyncio.run(bidstream.process_bidstream())
+    # the page parsed before the failure is still written
+    assert sum(_['bids_count'] for flush in flushes for _ in flush.values()) == 8
+    assert len(bidstream.records) == 0 and bidstream.domain_sketches == {}
+
+
+def test_update_n_days_records(mongo):
+    collections = mongo.re_m_client[mongo.RE_DATABASE]
+
+    def flush(bids):
+        records = BidAccumulator()
+        for age, domain, geo, width, height, cpm, count in bids:
+            ingested_on = (dt.now() - timedelta(days=age)).strftime('%Y-%m-%d')
+            for _ in range(count):
+                records.add(ingested_on, domain, geo, width, height, cpm)
+        db.create_or_update_bidstream_records(records.get_documents())
+
+    def get_domains():
+        return sorted((_['domain'], round(_['avg_cpm'], 9), _['ad_slots'], _['geo'])
+                      for _ in collections[db.BID_STREAM].find({}, {'_id': 0}))
+
+    def assert_same_as_pipeline(n):
+        bidstream.update_n_days_records(n)
+        domains = get_domains()
+        list(bidstream.aggregate_n_days_records(n))
+        assert domains == get_domains()
+        return domains
+
+    flush([(30, 'a.com', 'USA', 300, 250, 0.5, 3),
+           (27, 'a.com', 'USA', 728, 90, 0.2, 2),
+           (27, 'a.com', 'USA', 300, 250, 0.1, 1),
+           (10, 'a.com', 'GBR', 300, 250, 0.3, 1),
+           (1, 'b.com', 'IND', 300, 250, 0.1, 5),
+           (1, 'b.com', 'USA', 300, 250, 0.4, 1),
+           (29, 'c.com', 'USA', 300, 250, 1.0, 1)])
+    # a record flushed before records were marked pending is backfilled by
+    # the first run
+    collections[db.BID_STREAM_DATEWISE].insert_one({
+        'ingested_on': (dt.now() - timedelta(days=3)).strftime('%Y-%m-%d'),
+        'domain': 'd.com', 'geo': 'USA', 'total_cpm': 0.2, 'bids_count': 2,
+        'ad_slots': ['300x250']})
+    assert [_[0] for _ in assert_same_as_pipeline(28)] == ['a.com', 'b.com', 'd.com']
+    # bid floor sketches of the flushed days
+    today = dt.now().strftime('%Y-%m-%d')
+    quantiles = bidstream.get_bidfloor_quantiles('b.com', '2000-01-01', today)
+    assert quantiles['p50'] == pytest.approx(0.1, rel=sketch.RELATIVE_ACCURACY)
+    assert bidstream.get_bidfloor_quantiles('b.com', '2000-01-01', today, geo='USA')[
+        'p50'] == pytest.approx(0.4, rel=sketch.RELATIVE_ACCURACY)
+    assert bidstream.update_n_days_records(28) == 0
+    # once rolling totals exist only pending records are read
+    legacy = collections[db.BID_STREAM_DATEWISE].insert_one({
+        'ingested_on': (dt.now() - timedelta(days=2)).strftime('%Y-%m-%d'),
+        'domain': 'e.com', 'geo': 'USA', 'total_cpm': 0.2, 'bids_count': 2,
+        'ad_slots': ['300x250']})
+    assert bidstream.update_n_days_records(28) == 0
+    collections[db.BID_STREAM_DATEWISE].delete_one({'_id': legacy.inserted_id})
+
+    # a later run adds to a day already aggregated
+    flush([(1, 'b.com', 'USA', 728, 90, 0.6, 7),
+           (10, 'a.com', 'GBR', 300, 250, 0.3, 2)])
+    assert_same_as_pipeline(28)
+
+    # a.com falls out of the window
+    assert [_[0] for _ in assert_same_as_pipeline(5)] == ['b.com', 'd.com']
+    assert collections[db.BID_STREAM_ROLLING].count_documents(
+        {'domain': 'a.com'}) == 0
+
+    # each run only reads records of the partial pending and applied indexes,
+    # which hold no record older than the window
+    indexes = {tuple(_['key']): _.get('partialFilterExpression') for _ in
+               collections[db.BID_STREAM_DATEWISE].index_information().values()}
+    assert indexes[(('pending', 1),)] == {'pending': True}
+    assert indexes[(('ingested_on', -1),)] == {'applied': {'$exists': True}}
+    target_date = (dt.now() - timedelta(days=5)).strftime('%Y-%m-%d')
+    assert collections[db.BID_STREAM_DATEWISE].count_documents({'$or': [
+        {'pending': True},
+        {'applied': {'$exists': True}, 'ingested_on': {'$lt': target_date}}]}) == 0
+
+
+def test_bid_accumulator():
+    records = BidAccumulator()
+    records.add('2021-03-12', 'a.com', 'USA', 300, 250, 0.1)
+    partial_records = pickle.loads(pickle.dumps(BidAccumulator()))
+    partial_records.add('2021-03-12', 'a.com', 'USA', 728, 90, 0.1)
+    partial_records.add('2021-03-12', 'a.com', 'USA', 728, 90, 0.1)
+    partial_records.add('2021-03-12', 'b.com', 'USA', 728, 90, 0.5)
+    records.merge(pickle.loads(pickle.dumps(partial_records)))
+
+    documents = records.get_documents()
+    assert sorted(documents['2021-03-12', 'a.com', 'USA']['ad_slots']) == \
+        ['300x250', '728x90']
+    # cpm is summed unrounded and rounded once
+    assert records.records['2021-03-12', 'a.com', 'USA'].total_cpm != 0.3
+    assert documents['2021-03-12', 'a.com', 'USA']['total_cpm'] == 0.3
+    assert documents['2021-03-12', 'a.com', 'USA']['bids_count'] == 3
+    assert documents['2021-03-12', 'b.com', 'USA'] == {
+        'ad_slots': ['728x90'], 'total_cpm': 0.5, 'bids_count': 1,
+        'bidfloor_sketch': {str(sketch.get_index(0.5)): 1}}
+    assert documents['2021-03-12', 'a.com', 'USA']['bidfloor_sketch'] == \
+        {str(sketch.get_index(0.1)): 3}
+    # keys of the same day share its date string
+    assert all(key[0] is next(iter(records.records))[0]
+               for key in records.records)
+
+    records.clear()
+    assert len(records) == 0
+
+
+def test_get_bid_request_fields(monkeypatch):
+    with open(os.path.join(ROOT, 'test1.json')) as f:
+        bid_request = json.load(f)['data'][0]
+    with open(os.path.join(ROOT, 't.json')) as f:
+        lambda_message = f.read()
+    messages = [json.dumps(bid_request), lambda_message, '', '{"imp": []}',
+                'LambdaContext([]) {"imp": [{"banner": {}}]}']
+    # bid requests missing their site, geo or banner are dropped
+    malformed = [
+        dict(bid_request, site=None),
+        {key: value for key, value in bid_request.items() if key != 'site'},
+        dict(bid_request, device={}),
+        dict(bid_request, imp=[{'bidfloor': 0.5}]),
+    ]
+    messages += [json.dumps(_) for _ in malformed]
+
+    simdjson, orjson = bidstream_parser.simdjson, bidstream_parser.orjson
+    for backends in [(simdjson, orjson), (None, orjson), (None, None)]:
+        monkeypatch.setattr(bidstream_parser, 'simdjson', backends[0])
+        monkeypatch.setattr(bidstream_parser, 'orjson', backends[1])
+        assert [bidstream.get_bid_request_fields(_) for _ in messages] == [
+            (320, 50, 0.182, 'fridaywereinlove.com', 'SE'),
+            None, None, None, None, None, None, None, None]
@@ -0,0 +1,365 @@
+import threading
+import time
+from collections import Counter
+
+import pytest
+import analytics
+from analytics import cloudwatch, models
+from datetime import datetime as dt
+
+
+# all terms of the pattern, or any of its ?terms, found in the message,
+# quoted terms are matched without their quotes
+def matches_filter_pattern(message, filter_pattern):
+    terms = filter_pattern.split()
+    if terms and all(term.startswith('?') for term in terms):
+        return any(term[1:].strip('"') in message for term in terms)
+    return all(term.strip('"') in message for term in terms)
+
+
+# filter_log_events over in memory events, pages of page_size events and
+# latency seconds per call
+class StubLogsClient:
+    def __init__(self, events, page_size=3, latency=0.01):
+        self.events = events
+        self.page_size = page_size
+        self.latency = latency
+        self.calls = 0
+        self.running = 0
+        self.max_running = 0
+        self.lock = threading.Lock()
+
+    def filter_log_events(self, logGroupName, startTime, endTime, limit,
+                          filterPattern='', nextToken=None, logStreamNames=None):
+        with self.lock:
+            self.calls += 1
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+        time.sleep(self.latency)
+        matches = sorted((
+            event for event in self.events
+            if startTime <= event['timestamp'] <= endTime and
+            matches_filter_pattern(event['message'], filterPattern) and
+            (not logStreamNames or event.get('logStreamName') in logStreamNames)
+        ), key=lambda event: event['timestamp'])
+        offset = int(nextToken or 0)
+        page = matches[offset:offset + min(limit, self.page_size)]
+        response = {'events': page}
+        if offset + len(page) < len(matches):
+            response['nextToken'] = str(offset + len(page))
+        with self.lock:
+            self.running -= 1
+        return response
+
+    # streams of the events by last event time, two per page
+    def describe_log_streams(self, logGroupName, orderBy, descending,
+                             nextToken=None):
+        log_streams = {}
+        for event in self.events:
+            log_stream = log_streams.setdefault(event['logStreamName'], {
+                'logStreamName': event['logStreamName'],
+                'firstEventTimestamp': event['timestamp'],
+                'lastEventTimestamp': event['timestamp']
+            })
+            log_stream['firstEventTimestamp'] = min(log_stream['firstEventTimestamp'],
+                                                    event['timestamp'])
+            log_stream['lastEventTimestamp'] = max(log_stream['lastEventTimestamp'],
+                                                   event['timestamp'])
+        log_streams = sorted(log_streams.values(), key=lambda _: _['lastEventTimestamp'],
+                             reverse=descending)
+        offset = int(nextToken or 0)
+        response = {'logStreams': log_streams[offset:offset + 2]}
+        if offset + 2 < len(log_streams):
+            response['nextToken'] = str(offset + 2)
+        return response
+
+
+def get_events(date, count):
+    start = cloudwatch.get_timestamp_milliseconds(date)
+    events = []
+    for i in range(count):
+        level = 'ERROR PAGE_CRAWL_ERROR' if i % 4 == 0 else 'INFO PAGE_CRAWLED'
+        events.append({
+            'timestamp': start + (count - i) * 86399000 // count,
+            'message': '%s %d' % (level, count - i),
+            'logStreamName': 'crawler-%d' % (i % 5)
+        })
+    return events
+
+
+def test_get_time_slices():
+    assert cloudwatch.get_time_slices(0, 9, 3) == [(0, 2), (3, 5), (6, 9)]
+    assert cloudwatch.get_time_slices(0, 1, 4) == [(0, 0), (1, 1)]
+    assert cloudwatch.get_time_slices(5, 5, 0) == [(5, 5)]
+
+
+def test_get_cloudwatch_logs():
+    date = dt(2021, 3, 12)
+    client = StubLogsClient(get_events(date, 40))
+    filters = {"info": "INFO PAGE_CRAWLED", "error": "ERROR PAGE_CRAWL_ERROR"}
+    logs = {
+        filter_key: list(lines) for filter_key, lines in analytics.get_cloudwatch_logs(
+            cloudwatch.ThrottledLogsClient(client, rate=1000, burst=1000), 'group',
+            '2021-03-12', filters).items()
+    }
+
+    assert logs['info_lines'] == [
+        'INFO PAGE_CRAWLED %d' % i for i in range(1, 41) if (40 - i) % 4
+    ]
+    assert logs['error_lines'] == [
+        'ERROR PAGE_CRAWL_ERROR %d' % i for i in range(1, 41) if (40 - i) % 4 == 0
+    ]
+    assert client.max_running > 1
+
+    sequential_client = StubLogsClient(get_events(date, 40))
+    messages = cloudwatch.fetch_log_messages(
+        cloudwatch.ThrottledLogsClient(sequential_client, rate=1000, burst=1000,
+                                       max_concurrency=1), 'group', date,
+        dt(2021, 3, 12, 23, 59, 59), filters, slices_count=1, workers=1)
+    assert {filter_key: list(lines) for filter_key, lines in messages.items()} == {
+        filter_key[:-len('_lines')]: lines for filter_key, lines in logs.items()
+    }
+    assert sequential_client.max_running == 1
+    assert sequential_client.calls == 10 + 4
+
+
+def test_fetch_log_messages_streaming():
+    class RecordingLogsClient(StubLogsClient):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            self.patterns = Counter()
+
+        def filter_log_events(self, **kwargs):
+            with self.lock:
+                self.patterns[kwargs.get('filterPattern')] += 1
+            return super().filter_log_events(**kwargs)
+
+    date = dt(2021, 3, 12)
+    client = RecordingLogsClient(get_events(date, 100), page_size=2, latency=0)
+    messages = cloudwatch.fetch_log_messages(
+        client, 'group', date, dt(2021, 3, 12, 23, 59, 59),
+        {"info": "INFO PAGE_CRAWLED", "error": "ERROR PAGE_CRAWL_ERROR"},
+        slices_count=1, workers=1)
+    time.sleep(0.2)
+    # every filter is fetched ahead before it is read: the queued pages and
+    # the one waiting to be queued
+    assert client.patterns == {
+        "INFO PAGE_CRAWLED": cloudwatch.LOG_FETCH_QUEUE_PAGES + 1,
+        "ERROR PAGE_CRAWL_ERROR": cloudwatch.LOG_FETCH_QUEUE_PAGES + 1
+    }
+
+    info_lines = messages["info"]
+    assert next(info_lines) == 'INFO PAGE_CRAWLED 1'
+    time.sleep(0.2)
+    # plus the page being read
+    assert client.patterns["INFO PAGE_CRAWLED"] == cloudwatch.LOG_FETCH_QUEUE_PAGES + 2
+    assert client.patterns["ERROR PAGE_CRAWL_ERROR"] == cloudwatch.LOG_FETCH_QUEUE_PAGES + 1
+    info_lines.close()
+    assert len(list(messages["error"])) == 25
+
+
+def test_fetch_log_messages_shutdown():
+    date = dt(2021, 3, 12)
+    threads = threading.active_count()
+    messages = cloudwatch.fetch_log_messages(
+        StubLogsClient(get_events(date, 100), page_size=2, latency=0), 'group', date,
+        dt(2021, 3, 12, 23, 59, 59),
+        {"info": "INFO PAGE_CRAWLED", "error": "ERROR PAGE_CRAWL_ERROR"},
+        slices_count=4, workers=2)
+    executor = messages["info"].executor
+    assert len(list(messages["info"])) == 75
+    assert not executor._shutdown
+    # the pool is shut down once the last filter is closed, read or not
+    messages["error"].close()
+    assert executor._shutdown
+    time.sleep(0.3)
+    assert threading.active_count() == threads
+
+
+def test_fetch_log_messages_error():
+    class FailingLogsClient(StubLogsClient):
+        def filter_log_events(self, **kwargs):
+            raise RuntimeError('throttled')
+
+    messages = cloudwatch.fetch_log_messages(
+        FailingLogsClient([]), 'group', dt(2021, 3, 12), dt(2021, 3, 12, 23, 59, 59),
+        {"info": "INFO PAGE_CRAWLED"})
+    with pytest.raises(RuntimeError):
+        list(messages["info"])
+
+
+def test_get_routed_logs_summary():
+    date = dt(2021, 3, 12)
+    start = cloudwatch.get_timestamp_milliseconds(date)
+    events = []
+    for i in range(60):
+        timestamp = '2021-03-12 15:%02d:%02d' % (i // 20, i % 20)
+        events.append({
+            'timestamp': start + i,
+            'message': '%s INFO:default:PAGE_CRAWLED: url https://www.example.com/%d '
+                       'took %d.5 ms and %d bytes' % (timestamp, i % 7, i, i)})
+        if i % 10 == 0:
+            events.append({
+                'timestamp': start + i,
+                'message': '%s INFO:scrapy.extensions.logstats:Crawled %d pages (at %d '
+                           'pages/min), scraped 0 items (at 0 items/min)' % (timestamp, i, i)})
+        if i % 4 == 0:
+            events.append({
+                'timestamp': start + i,
+                'message': '%s ERROR:default:PAGE_CRAWL_ERROR: HttpError on '
+                           'https://www.example.com/%d' % (timestamp, i % 9)})
+        # engine lines are left out by both the separate and combined filters
+        if i % 5 == 0:
+            events.append({
+                'timestamp': start + i,
+                'message': '%s DEBUG:scrapy.core.engine: Crawled (200) <GET '
+                           'https://www.example.com/%d> (referer: None)' % (timestamp, i)})
+    end = dt(2021, 3, 12, 23, 59, 59)
+    filters = {
+        "info": "INFO PAGE_CRAWLED",
+        "frequency": "INFO Crawled",
+        "error": "ERROR PAGE_CRAWL_ERROR"
+    }
+    separate_counters = cloudwatch.FetchCounters()
+    messages = cloudwatch.fetch_log_messages(StubLogsClient(events, page_size=100), 'group',
+                                             date, end, filters, slices_count=1,
+                                             counters=separate_counters)
+    accumulator = models.PageAccumulator(epoch_timestamps=True)
+    accumulator.update_batches(analytics._get_page_crawled_batches(messages["info"]))
+    crawler_frequencies = analytics.get_frequency_logs_summary(
+        frequency_lines=messages["frequency"])
+    accumulator.update_batches(analytics._get_page_crawl_error_batches(messages["error"]))
+
+    counters = cloudwatch.FetchCounters()
+    messages = cloudwatch.fetch_log_messages(
+        StubLogsClient(events, page_size=100), 'group', date, end,
+        {"combined": analytics.COMBINED_FILTER_PATTERN}, slices_count=1,
+        counters=counters)
+    routed_accumulator, routed_frequencies = analytics.get_routed_logs_summary(
+        messages["combined"], counters.routes)
+
+    assert routed_frequencies == crawler_frequencies
+    assert analytics.get_accumulated_page_items(routed_accumulator) == \
+        analytics.get_accumulated_page_items(accumulator)
+    assert counters.routes == {'info': 60, 'frequency': 6, 'error': 15}
+    assert counters.api_calls == {'combined': 1}
+    assert separate_counters.api_calls == {'info': 1, 'frequency': 1, 'error': 1}
+    assert 'combined              1         81' in counters.get_report()
+
+
+class ThrottlingError(Exception):
+    def __init__(self):
+        super().__init__('Rate exceeded')
+        self.response = {'Error': {'Code': 'ThrottlingException'}}
+
+
+def test_throttled_logs_client(monkeypatch):
+    class ThrottlingLogsClient(StubLogsClient):
+        def filter_log_events(self, **kwargs):
+            if self.calls < 2:
+                self.calls += 1
+                raise ThrottlingError()
+            return super().filter_log_events(**kwargs)
+
+    monkeypatch.setattr(cloudwatch, 'LOG_FETCH_BACKOFF_SECONDS', 0.001)
+    events = get_events(dt(2021, 3, 12), 8)
+    # multi byte messages are counted in bytes, not characters
+    for event in events:
+        event['message'] += ' https://www.example.com/caf\u00e9'
+    client = cloudwatch.ThrottledLogsClient(ThrottlingLogsClient(events, latency=0),
+                                            rate=1000, burst=10, max_concurrency=4)
+    response = client.filter_log_events(logGroupName='group', startTime=0,
+                                        endTime=2 ** 50, filterPattern='INFO',
+                                        limit=10)
+    assert len(response['events']) == 3
+    counters = client.get_counters()
+    assert counters['calls'] == 3 and counters['throttles'] == 2
+    assert counters['concurrency'] == 1
+    assert counters['bytes'] == sum(len(_['message'].encode())
+                                   for _ in response['events'])
+    assert counters['bytes'] > sum(len(_['message']) for _ in response['events'])
+    assert cloudwatch.get_throttled_client(client) is client
+
+    client = cloudwatch.ThrottledLogsClient(ThrottlingLogsClient(events, latency=0),
+                                            rate=1000, max_retries=1)
+    with pytest.raises(ThrottlingError):
+        client.filter_log_events(logGroupName='group', startTime=0, endTime=2 ** 50,
+                                 filterPattern='INFO', limit=10)
+
+
+def test_token_bucket():
+    token_bucket = cloudwatch.TokenBucket(rate=100, capacity=2)
+    started_at = time.monotonic()
+    for _ in range(7):
+        token_bucket.acquire()
+    assert time.monotonic() - started_at >= 0.045
+
+
+def test_log_page_cache(tmp_path):
+    date = dt(2021, 3, 12)
+    end = dt(2021, 3, 12, 23, 59, 59)
+    filters = {"info": "INFO PAGE_CRAWLED"}
+    client = StubLogsClient(get_events(date, 40), latency=0)
+    cache = cloudwatch.LogPageCache(str(tmp_path))
+    fetched = list(cloudwatch.fetch_log_messages(client, 'group', date, end, filters,
+                                                 slices_count=4, cache=cache)["info"])
+    calls = client.calls
+    assert (cache.hits, cache.misses) == (0, 4)
+    assert len(list(tmp_path.iterdir())) == 4
+
+    replayed = list(cloudwatch.fetch_log_messages(client, 'group', date, end, filters,
+                                                  slices_count=4, cache=cache)["info"])
+    assert replayed == fetched
+    assert client.calls == calls
+    assert (cache.hits, cache.misses) == (4, 4)
+
+    sizes = sorted(path.stat().st_size for path in tmp_path.iterdir())
+    cache.max_bytes = sum(sizes[-2:])
+    cache.evict()
+    assert len(list(tmp_path.iterdir())) <= 2
+
+    # windows still receiving events are fetched every time
+    today = dt.now().replace(hour=0, minute=0, second=0, microsecond=0)
+    list(cloudwatch.fetch_log_messages(client, 'group', today, dt.now(), filters,
+                                       slices_count=1, cache=cache)["info"])
+    assert len(list(tmp_path.iterdir())) <= 2
+
+
+def test_fetch_log_messages_per_stream(monkeypatch):
+    date = dt(2021, 3, 12)
+    end = dt(2021, 3, 12, 23, 59, 59)
+    start = cloudwatch.get_timestamp_milliseconds(date)
+    events = get_events(date, 40) + [{
+        'timestamp': start - 3 * cloudwatch.LOG_STREAM_LAG_MILLISECONDS - i,
+        'message': 'INFO PAGE_CRAWLED old',
+        'logStreamName': 'old-crawler-%d' % i
+    } for i in range(3)] + [{
+        # only in the first hours of the day
+        'timestamp': start + cloudwatch.LOG_STREAM_LAG_MILLISECONDS + i,
+        'message': 'INFO PAGE_CRAWLED early %d' % i,
+        'logStreamName': 'early-crawler'
+    } for i in range(3)]
+    client = StubLogsClient(events, latency=0)
+    assert [_[0] for _ in cloudwatch.get_active_log_streams(
+        client, 'group', start, start + 86399000)] == \
+        ['crawler-%d' % i for i in range(5)] + ['early-crawler']
+
+    filters = {"info": "INFO PAGE_CRAWLED"}
+    group_lines = list(cloudwatch.fetch_log_messages(
+        client, 'group', date, end, filters, slices_count=2, per_stream=False)["info"])
+    monkeypatch.setattr(cloudwatch, 'LOG_STREAMS_PER_QUERY', 2)
+    (first_start, first_end), (second_start, second_end) = cloudwatch.get_time_slices(
+        start, start + 86399000, 2)
+    assert cloudwatch.get_log_queries(client, 'group', start, start + 86399000, 2,
+                                      True) == [
+        (first_start, first_end, ['crawler-0', 'crawler-1']),
+        (first_start, first_end, ['crawler-2', 'crawler-3']),
+        (first_start, first_end, ['crawler-4', 'early-crawler']),
+        # streams without events in a slice are not queried
+        (second_start, second_end, ['crawler-0', 'crawler-1']),
+        (second_start, second_end, ['crawler-2', 'crawler-3']),
+        (second_start, second_end, ['crawler-4']),
+    ]
+    stream_lines = list(cloudwatch.fetch_log_messages(
+        client, 'group', date, end, filters, slices_count=2, per_stream=True)["info"])
+    assert sorted(stream_lines) == sorted(group_lines) and len(stream_lines) == 33
@@ -0,0 +1,111 @@
+import time
+from datetime import datetime, timedelta
+from itertools import count
+
+import pytest
+from bson import ObjectId
+
+from analytics import db, reports
+
+ids = count()
+
+
+# documents inserted hours ago
+def insert_documents(documents, hours):
+    timestamp = int(time.time()) - hours * 3600
+    db.re_m_client[db.RE_DATABASE][db.RE_COLLECTION].insert_many([
+        dict(document, _id=ObjectId('%08x%016x' % (timestamp, next(ids))))
+        for document in documents
+    ])
+
+
+@pytest.fixture
+def collections(monkeypatch, mongo):
+    collections = mongo.re_m_client[mongo.RE_DATABASE]
+    monkeypatch.setattr(reports, 'db', collections)
+    return collections
+
+
+def test_incremental_reports(monkeypatch, caplog, collections):
+    monkeypatch.setattr(reports, 'create_or_update_taxonomy_count_document',
+                        lambda document: document)
+    monkeypatch.setattr(reports, 'create_or_update_intent_count_document',
+                        lambda document: document)
+
+    insert_documents([
+        {'lang': 'en', 'taxonomy': [{'label': 'sports_tennis'}, {'label': 'news'}],
+         'intent': ['buy']},
+        {'lang': 'es', 'taxonomy': [{'label': 'sports_tennis'}], 'intent': 'buy'},
+        {'taxonomy': [{'label': 'sports'}], 'intent': []},
+    ], hours=2)
+    # watermark an hour and a half ago
+    monkeypatch.setenv('REPORT_WATERMARK_LAG_SECONDS', '5400')
+    document = reports.get_taxonomy_report()
+    assert sorted(document['languages']) == ['en', 'es']
+    assert document['taxonomies'] == [{
+        'taxonomy': 'news',
+        'total': [{'lang': 'en', 'count': 1}],
+        'sub_categories': []
+    }, {
+        'taxonomy': 'sports',
+        'total': [{'lang': '', 'count': 1}, {'lang': 'en', 'count': 1},
+                  {'lang': 'es', 'count': 1}],
+        'sub_categories': [{
+            'taxonomy': 'tennis',
+            'total': [{'lang': 'en', 'count': 1}, {'lang': 'es', 'count': 1}]
+        }]
+    }]
+    assert reports.get_intent_report()['intents'] == [{
+        'intent': 'buy',
+        'total': [{'lang': 'en', 'count': 1}, {'lang': 'es', 'count': 1}]
+    }]
+
+    # only documents past the watermark are counted and added
+    insert_documents([{'lang': 'en', 'taxonomy': [{'label': 'news'}],
+                       'intent': ['buy', 'sell']}], hours=1)
+    monkeypatch.delenv('REPORT_WATERMARK_LAG_SECONDS')
+    for report in reports.COUNTED_REPORTS:
+        assert reports.update_report_counters(report) == \
+            reports.get_report_counts(report, {})
+    assert reports.get_intent_report()['intents'][1] == {
+        'intent': 'sell', 'total': [{'lang': 'en', 'count': 1}]}
+
+    # updates are only caught by the periodic full recount
+    collections[db.RE_COLLECTION].update_many({}, {'$set': {'lang': 'en'}})
+    assert reports.update_report_counters('taxonomy') != \
+        reports.get_report_counts('taxonomy', {})
+    db.update_report_watermark('taxonomy', {
+        'recounted_at': datetime.utcnow() - timedelta(days=8)})
+    assert reports.update_report_counters('taxonomy') == \
+        reports.get_report_counts('taxonomy', {})
+    assert 'differ from the full recount for 4 keys' in caplog.text
+
+
+def test_report_counters_failed_write(monkeypatch, collections):
+    insert_documents([{'lang': 'en', 'intent': ['buy']}], hours=2)
+    monkeypatch.setenv('REPORT_WATERMARK_LAG_SECONDS', '5400')
+    reports.update_report_counters('intent')
+    monkeypatch.delenv('REPORT_WATERMARK_LAG_SECONDS')
+    insert_documents([{'lang': 'en', 'intent': ['buy', 'sell']}], hours=1)
+
+    # counters and watermark are one write, a run failing before it adds
+    # nothing and the next run adds the same documents once
+    def fail(*args):
+        raise RuntimeError('write failed')
+
+    update_report_watermark = reports.update_report_watermark
+    monkeypatch.setattr(reports, 'update_report_watermark', fail)
+    with pytest.raises(RuntimeError):
+        reports.update_report_counters('intent')
+    monkeypatch.setattr(reports, 'update_report_watermark', update_report_watermark)
+    assert reports.update_report_counters('intent') == {
+        ('buy', 'en'): 2, ('sell', 'en'): 1}
+
+
+def test_report_counters_skip_object_keys(collections, caplog):
+    insert_documents([
+        {'lang': 'en', 'intent': ['buy', {'label': 'sell'}]},
+        {'lang': ['en', 'es'], 'intent': 'buy'},
+    ], hours=1)
+    assert reports.update_report_counters('intent') == {('buy', 'en'): 1}
+    assert 'skip 2 values' in caplog.text
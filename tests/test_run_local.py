@@ -0,0 +1,71 @@
+from datetime import datetime as dt
+
+import pytest
+
+import run_local
+from analytics import db
+from analytics.models import PageItem
+
+
+def test_get_date_strings():
+    assert run_local.get_date_strings('2021-03-12') == ['2021-03-12']
+    assert run_local.get_date_strings('2021-03-12', '2021-02-27', '2021-03-02') == [
+        '2021-02-27', '2021-02-28', '2021-03-01', '2021-03-02']
+    assert run_local.get_date_strings('2021-03-12', '2021-02-27') == ['2021-02-27']
+    assert run_local.get_date_strings(
+        '2021-03-12', '2021-02-27', '2021-03-02', ['2021-01-01', '2021-01-03']) == [
+        '2021-01-01', '2021-01-03']
+    with pytest.raises(ValueError):
+        run_local.get_date_strings('2021-03-12', '2021-03-02', '2021-02-27')
+
+
+def test_process_dates_reports_failed_days(monkeypatch):
+    processed = []
+
+    def start_process(date_string, **kwargs):
+        processed.append(date_string)
+        if date_string == '2021-03-02':
+            raise RuntimeError('no logs')
+
+    monkeypatch.setattr(run_local, 'start_process', start_process)
+    results = run_local.process_dates(
+        ['2021-03-01', '2021-03-02', '2021-03-03'], 'logs')
+    assert processed == ['2021-03-01', '2021-03-02', '2021-03-03']
+    assert [(date_string, status) for date_string, status, _ in results] == [
+        ('2021-03-01', 'ok'), ('2021-03-02', 'failed: no logs'),
+        ('2021-03-03', 'ok')]
+
+
+def test_pages_documents_of_days_in_any_order(mongo):
+    collection = mongo._m_client[db.DATABASE][db.CRAWLED_PAGES]
+    days = [[
+        PageItem('https://www.example.com/a', 2, 'example.com', 120.5, 1000,
+                 dt(2021, 3, 1, 8), dt(2021, 3, 1, 20), True, None),
+        PageItem('https://www.example.com/b', 1, 'example.com', 80.0, 500,
+                 dt(2021, 3, 1, 9), dt(2021, 3, 1, 9), False, 'HttpError'),
+    ], [
+        PageItem('https://www.example.com/a', 3, 'example.com', 90.0, 1200,
+                 dt(2021, 3, 2, 7), dt(2021, 3, 2, 18), False, 'HttpError'),
+        PageItem('https://www.example.com/c', 1, 'example.com', 60.0, 300,
+                 dt(2021, 3, 2, 10), dt(2021, 3, 2, 10), True, None),
+    ]]
+
+    def write(days):
+        collection.delete_many({})
+        for page_items in days:
+            db.create_or_update_pages_documents(page_items)
+        return sorted(collection.find({}, {'_id': 0}), key=lambda _: _['url'])
+
+    pages = write(days)
+    assert write(days[::-1]) == pages
+    # counts add up, the crawl range spans both days and the latest crawl
+    # is the one of the most recent day
+    assert pages[0] == {
+        'url': 'https://www.example.com/a', 'domain': 'example.com',
+        'visit_count': 5, 'first_crawled_at': dt(2021, 3, 1, 8),
+        'last_crawled_at': dt(2021, 3, 2, 18), 'compliant': False,
+        'page_load_speed': 90.0, 'page_size': 1200,
+        'non_compliance_reason': 'HttpError'}
+    assert [_['url'] for _ in pages] == [
+        'https://www.example.com/a', 'https://www.example.com/b',
+        'https://www.example.com/c']
@@ -0,0 +1,77 @@
+import random
+
+from analytics import sketch
+from analytics.sketch import HyperLogLog, QuantileSketch
+
+
+def get_values(count):
+    random.seed(0)
+    return [random.lognormvariate(6, 1.5) for _ in range(count)] + [0.0] * 10
+
+
+def test_quantiles_relative_accuracy():
+    values = get_values(20000)
+    quantiles = QuantileSketch().update(values).get_quantiles()
+    assert list(quantiles) == ['p50', 'p90', 'p99']
+    ordered = sorted(values)
+    for name, q in zip(quantiles, sketch.QUANTILES):
+        exact = ordered[int(q * (len(ordered) - 1))]
+        assert abs(quantiles[name] - exact) <= sketch.RELATIVE_ACCURACY * exact
+    assert QuantileSketch().update([0.0, 0.0]).get_quantile(0.5) == 0.0
+    assert QuantileSketch().get_quantile(0.5) is None
+
+
+def test_merge_and_documents():
+    values = get_values(1000)
+    merged = QuantileSketch().update(values[:300]).merge(
+        QuantileSketch.from_document(
+            QuantileSketch().update(values[300:]).to_document()))
+    assert merged == QuantileSketch().update(values)
+    assert len(merged) == len(values)
+
+    merged.remove(values[0])
+    assert merged == QuantileSketch().update(values[1:])
+
+
+def test_bounded_size():
+    values = [10.0 ** exponent for exponent in range(-12, 13)]
+    buckets = QuantileSketch().update(values).buckets
+    assert min(buckets) == sketch.ZERO_INDEX
+    assert max(buckets) == sketch.MAX_INDEX
+
+
+def test_get_sketches(monkeypatch):
+    values = get_values(2000)
+    keys = ['a.com', 'b.com', 'c.com'] * (len(values) // 3) + \
+        ['a.com'] * (len(values) % 3)
+    sketches = sketch.get_sketches(keys, values)
+    monkeypatch.setattr(sketch, 'numpy', None)
+    assert sketches == sketch.get_sketches(keys, values)
+    assert sketches['a.com'] == QuantileSketch().update(
+        [value for key, value in zip(keys, values) if key == 'a.com'])
+
+
+def test_hyperloglog():
+    urls = ['https://www.example%d.com/%d' % (i % 100, i) for i in range(20000)]
+    hll = HyperLogLog().update(urls)
+    # well within 3 standard errors
+    assert abs(len(hll) - len(urls)) <= 3 * 0.0163 * len(urls)
+    assert len(HyperLogLog().update(urls[:10] * 3)) == 10
+    assert len(HyperLogLog()) == 0
+
+    # union of overlapping days, merging a day twice changes nothing
+    first, second = HyperLogLog().update(urls[:15000]), \
+        HyperLogLog().update(urls[5000:])
+    union = HyperLogLog.from_document(first.to_document()).merge(second)
+    assert union == hll
+    assert HyperLogLog(union.registers).merge(second) == union
+    assert len(union.to_document()) == sketch.HLL_REGISTERS
+
+
+def test_hyperloglog_without_numpy(monkeypatch):
+    urls = ['url%d' % i for i in range(5000)]
+    hll, other = HyperLogLog().update(urls), HyperLogLog().update(urls[::2])
+    union = HyperLogLog(hll.registers).merge(other)
+    monkeypatch.setattr(sketch, 'numpy', None)
+    assert HyperLogLog().update(urls) == hll
+    assert HyperLogLog(hll.registers).merge(other) == union == hll
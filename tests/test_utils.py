@@ -1,3 +1,6 @@
+import bz2
+import gzip
+import lzma
 import os
 
 import pytest
@@ -64,3 +67,72 @@ def test_get_log_file_path():
            == os.path.join(SAMPLES_PATH, 'logs', 'error.log.2018-01-01')
     assert utils.get_log_file_path('2018-01-01', os.path.join(SAMPLES_PATH, 'logs'), LogLevel.INFO) \
            == os.path.join(SAMPLES_PATH, 'logs', 'info.log.2018-01-01')
+
+
+def test_decode_log_timestamp():
+    assert utils.decode_log_timestamp('2021-03-12 15:49:48') == dt(2021, 3, 12, 15, 49, 48)
+    assert utils.decode_log_timestamp('2021-03-12 15:49:48.123') == dt(2021, 3, 12, 15, 49, 48)
+    assert utils.decode_log_timestamp('2021-03-12 15:49:48') is \
+           utils.decode_log_timestamp('2021-03-12 15:49:48,456')
+    with pytest.raises(ValueError):
+        utils.decode_log_timestamp('2021-13-12 15:49:48')
+
+
+def test_get_file_byte_ranges(tmp_path):
+    log_file = tmp_path / 'info.log'
+    lines = ['line %d %s\n' % (i, 'x' * (i % 7)) for i in range(100)]
+    log_file.write_text(''.join(lines))
+    with pytest.raises(FileNotFoundError):
+        utils.get_file_byte_ranges(str(tmp_path / 'missing.log'), 4)
+    for ranges_count in (1, 3, 8, 1000):
+        byte_ranges = utils.get_file_byte_ranges(str(log_file), ranges_count)
+        assert byte_ranges[0][0] == 0
+        assert byte_ranges[-1][1] == log_file.stat().st_size
+        assert all(end == start for (_, end), (start, _) in zip(byte_ranges, byte_ranges[1:]))
+        assert [line for start, end in byte_ranges
+                for line in utils.read_lines_from_byte_range(str(log_file), start, end)] == lines
+    empty_file = tmp_path / 'empty.log'
+    empty_file.write_text('')
+    assert utils.get_file_byte_ranges(str(empty_file), 4) == []
+
+
+@pytest.mark.parametrize('extension, opener', [('.gz', gzip.open), ('.bz2', bz2.open), ('.xz', lzma.open)])
+def test_read_compressed_log_file(tmp_path, extension, opener):
+    lines = ['line %d\n' % i for i in range(1000)]
+    log_file_path = str(tmp_path / ('info.log.2018-01-01' + extension))
+    with opener(log_file_path, 'wt') as fp:
+        fp.writelines(lines)
+    assert utils.is_compressed_file(log_file_path)
+    assert utils.get_log_file_path('2018-01-01', str(tmp_path)) == log_file_path
+    assert list(utils.read_lines_from_file(log_file_path)) == lines
+
+    (tmp_path / 'info.log.2018-01-01').write_text(''.join(lines))
+    assert utils.get_log_file_path('2018-01-01', str(tmp_path)) == \
+           str(tmp_path / 'info.log.2018-01-01')
+
+
+def test_appended_log_lines(tmp_path):
+    log_file = tmp_path / 'info.log.2018-01-01'
+    log_file.write_text('line 1\nline 2\nline')
+    appended_lines = utils.AppendedLogLines(str(log_file))
+    assert list(appended_lines) == ['line 1\n', 'line 2\n']
+    checkpoint = appended_lines.get_checkpoint()
+    assert checkpoint['offset'] == len('line 1\nline 2\n')
+
+    with open(log_file, 'a') as fp:
+        fp.write(' 3\nline 4\n')
+    appended_lines = utils.AppendedLogLines(str(log_file), checkpoint)
+    assert list(appended_lines) == ['line 3\n', 'line 4\n']
+    checkpoint = appended_lines.get_checkpoint()
+    assert list(utils.AppendedLogLines(str(log_file), checkpoint)) == []
+
+    # rotated into a compressed file, resumes after the lines already read
+    with open(log_file, 'a') as fp:
+        fp.write('line 5\n')
+    with open(log_file, 'rb') as source, gzip.open(str(log_file) + '.gz', 'wb') as target:
+        target.write(source.read())
+    log_file.unlink()
+    appended_lines = utils.AppendedLogLines(str(log_file) + '.gz', checkpoint)
+    assert list(appended_lines) == ['line 5\n']
+    assert list(utils.AppendedLogLines(str(log_file) + '.gz',
+                                       appended_lines.get_checkpoint())) == []